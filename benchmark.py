@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+"""Benchmarks of the storage engine, run in-process against a scratch image
+with no FUSE mount. Each benchmark gets a freshly formatted volume, times its
+operations one at a time, and reports ops/s, latency percentiles and the block
+I/O done by each layer of the device, as JSON:
+
+    python benchmark.py --quick --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from constants import DEFAULT_BLOCK_SIZE, DEFAULT_JOURNAL_BLOCKS
+from disktools import (
+    DEVICE_MODES,
+    device_stats,
+    get_device,
+    get_superblock,
+    mount_device,
+    unmount_device,
+)
+from format import format_image
+from structures.Directory import Directory
+from structures.File import File
+from structures.Filesystem import Filesystem
+from structures.ReadAhead import stop_readahead
+from structures.Superblock import FEATURE_EXTENTS, Superblock
+from util.FMLog import FMLog
+
+KIB = 1024
+MIB = 1024 * KIB
+
+# Bytes moved by each read or write, as FUSE would hand them over
+CHUNK = 4 * KIB
+FILE_SIZES = (4 * KIB, 64 * KIB, 1 * MIB)
+
+
+class Volume(object):
+    """A scratch image, formatted afresh for each benchmark."""
+
+    def __init__(self, args: argparse.Namespace, path: str) -> None:
+        self.args = args
+        self.path = path
+
+    def fresh(self) -> Filesystem:
+        format_image(
+            Superblock.create(
+                self.args.blocks,
+                self.args.block_size,
+                label="bench",
+                features=FEATURE_EXTENTS,
+                journal_blocks=self.args.journal_blocks,
+            ),
+            self.path,
+        )
+        return self.remount()
+
+    def remount(self) -> Filesystem:
+        """Mount the image again, starting with cold caches."""
+        self.unmount()
+        mount_device(self.path, mode=self.args.io, cache_size=self.args.cache_size)
+        return Filesystem()
+
+    def unmount(self) -> None:
+        stop_readahead()
+        unmount_device()
+
+
+class Run(object):
+    """Times operations one at a time, each as a transaction as a FUSE
+    operation would be, and counts the block I/O done from start to finish."""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.before = device_stats()
+        self.settle = 0.0
+
+    def time(self, operation: Callable[[], Any]) -> Any:
+        device = get_device()
+        start = time.perf_counter()
+        with device.transaction():
+            result = operation()
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def finish(self) -> Dict[str, Any]:
+        """Flush what the operations left behind, so that its I/O is counted,
+        and summarise."""
+        start = time.perf_counter()
+        get_device().flush()
+        self.settle = time.perf_counter() - start
+        after = device_stats()
+
+        total = sum(self.latencies)
+        ordered = sorted(self.latencies)
+        return {
+            "ops": len(ordered),
+            "seconds": round(total, 6),
+            "ops_per_sec": round(len(ordered) / total, 1) if total else None,
+            "latency_us": {
+                "mean": micros(total / len(ordered)) if ordered else None,
+                "p50": micros(percentile(ordered, 50)),
+                "p90": micros(percentile(ordered, 90)),
+                "p99": micros(percentile(ordered, 99)),
+                "max": micros(ordered[-1]) if ordered else None,
+            },
+            "flush_seconds": round(self.settle, 6),
+            "io": {
+                layer: {
+                    name: value - self.before.get(layer, {}).get(name, 0)
+                    for (name, value) in counters.items()
+                }
+                for (layer, counters) in after.items()
+            },
+        }
+
+
+def percentile(ordered: List[float], percent: float) -> Optional[float]:
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+    return ordered[index]
+
+
+def micros(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1e6, 1)
+
+
+def read_chunk(fs: Filesystem, block: int, offset: int, size: int) -> bytes:
+    """Read as Small.read does, readahead included."""
+    data = bytes(File(block).read_contents(offset, size))
+    start = get_superblock().header_size + offset
+    fs.readahead.accessed(block, start, start + len(data))
+    return data
+
+
+def make_file(fs: Filesystem, path: str, size: int) -> int:
+    """Create a file of size bytes, written a chunk at a time."""
+    block = fs.create_file(path, 0o644).block
+    for offset in range(0, size, CHUNK):
+        fs.edit_file(block, os.urandom(min(CHUNK, size - offset)), offset)
+    return block
+
+
+def label(size: int) -> str:
+    return f"{size // MIB}m" if size >= MIB else f"{size // KIB}k"
+
+
+# Each benchmark sets up what it needs on a fresh volume, then times its
+# operations with a Run, which it returns.
+Benchmark = Callable[[Volume, int], Iterator[Tuple[str, Run]]]
+
+
+def bench_create(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    fs = volume.fresh()
+    run = Run()
+    for i in range(scale):
+        run.time(lambda: fs.create_file(f"/f{i}", 0o644))
+    yield ("create_fanout", run)
+
+    fs = volume.fresh()
+    run = Run()
+    for i in range(scale):
+        run.time(lambda: fs.create_dir(f"/d{i}", 0o755))
+    yield ("mkdir_fanout", run)
+
+
+def bench_resolve(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    fs = volume.fresh()
+    depth = 32
+    path = ""
+    for level in range(depth):
+        path += f"/l{level}"
+        fs.create_dir(path, 0o755)
+    path += "/leaf"
+    fs.create_file(path, 0o644)
+
+    run = Run()
+    for _ in range(scale):
+        fs.dentries.forget("/l0")
+        run.time(lambda: fs.path_resolver(path))
+    yield (f"resolve_depth{depth}_cold", run)
+
+    run = Run()
+    for _ in range(scale):
+        run.time(lambda: fs.path_resolver(path))
+    yield (f"resolve_depth{depth}_warm", run)
+
+
+def bench_sequential(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    for size in FILE_SIZES:
+        # enough files of each size to make about scale operations
+        count = max(1, scale * CHUNK // size)
+        fs = volume.fresh()
+        # a file written and read untimed first, so that the timed ones do not
+        # pay for warming up
+        warm = make_file(fs, "/warm", size)
+        blocks = [fs.create_file(f"/seq{i}", 0o644).block for i in range(count)]
+        run = Run()
+        for block in blocks:
+            for offset in range(0, size, CHUNK):
+                data = os.urandom(CHUNK)
+                run.time(lambda: fs.edit_file(block, data, offset))
+        yield (f"seq_write_{label(size)}", run)
+
+        fs = volume.remount()
+        for offset in range(0, size, CHUNK):
+            read_chunk(fs, warm, offset, CHUNK)
+        run = Run()
+        for block in blocks:
+            for offset in range(0, size, CHUNK):
+                run.time(lambda: read_chunk(fs, block, offset, CHUNK))
+        yield (f"seq_read_{label(size)}", run)
+
+
+def bench_random(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    rng = random.Random(0)
+    for size in FILE_SIZES:
+        fs = volume.fresh()
+        block = make_file(fs, "/rand", size)
+        chunks = size // CHUNK
+        count = max(scale // 4, chunks)
+        fs = volume.remount()
+
+        run = Run()
+        for _ in range(count):
+            offset = rng.randrange(chunks) * CHUNK
+            run.time(lambda: read_chunk(fs, block, offset, CHUNK))
+        yield (f"rand_read_{label(size)}", run)
+
+        run = Run()
+        for _ in range(count):
+            offset = rng.randrange(chunks) * CHUNK
+            data = os.urandom(CHUNK)
+            run.time(lambda: fs.edit_file(block, data, offset))
+        yield (f"rand_write_{label(size)}", run)
+
+
+def bench_readdir(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    fs = volume.fresh()
+    fs.create_dir("/big", 0o755)
+    for i in range(scale):
+        fs.create_file(f"/big/entry{i}", 0o644)
+    block = fs.path_resolver("/big")
+
+    run = Run()
+    for _ in range(20):
+        run.time(lambda: Directory(block).get_files(strip_null=True))
+    yield (f"readdir_{scale}", run)
+
+
+def bench_churn(volume: Volume, scale: int) -> Iterator[Tuple[str, Run]]:
+    fs = volume.fresh()
+    root = get_superblock().root_block
+    for i in range(scale):
+        fs.create_file(f"/c{i}", 0o644)
+    locations = [fs.path_resolver(f"/c{i}") for i in range(scale)]
+
+    def rename(i: int) -> None:
+        directory = Directory(root)
+        directory.unlink_file(locations[i])
+        directory.link_file(locations[i], f"r{i}")
+        fs.dentries.remove(f"/c{i}")
+        fs.dentries.insert(f"/r{i}", locations[i])
+
+    def unlink(i: int) -> None:
+        Directory(root).remove_file(locations[i])
+        fs.dentries.remove(f"/r{i}", recursive=False)
+
+    run = Run()
+    for i in range(scale):
+        run.time(lambda: rename(i))
+    yield ("rename_churn", run)
+
+    run = Run()
+    for i in range(scale):
+        run.time(lambda: unlink(i))
+    yield ("unlink_churn", run)
+
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    "create": bench_create,
+    "resolve": bench_resolve,
+    "sequential": bench_sequential,
+    "random": bench_random,
+    "readdir": bench_readdir,
+    "churn": bench_churn,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="fewer operations")
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=sorted(BENCHMARKS),
+        help="run just this benchmark; may be given more than once",
+    )
+    parser.add_argument("--io", choices=sorted(DEVICE_MODES), default="file")
+    parser.add_argument(
+        "--cache-size", type=int, default=0, help="bytes of block cache, 0 for none"
+    )
+    parser.add_argument("--blocks", type=int, default=16384)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--journal-blocks", type=int, default=DEFAULT_JOURNAL_BLOCKS)
+    parser.add_argument("--image", help="scratch image to use (default: a temp file)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    scale = 200 if args.quick else 1000
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory(prefix="fmfs-bench-") as scratch:
+        volume = Volume(args, args.image or os.path.join(scratch, "bench-disk"))
+        try:
+            for name in args.only or BENCHMARKS:
+                for (result, run) in BENCHMARKS[name](volume, scale):
+                    results[result] = run.finish()
+                    FMLog.info("%s: %s ops/s", result, results[result]["ops_per_sec"])
+        finally:
+            volume.unmount()
+
+    report = {
+        "config": {
+            "io": args.io,
+            "cache_size": args.cache_size,
+            "blocks": args.blocks,
+            "block_size": args.block_size,
+            "journal_blocks": args.journal_blocks,
+            "scale": scale,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
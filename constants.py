@@ -17,10 +17,29 @@ RESERVED_SPACE = 0xFE
 
 FILE_TABLE_SPACE = 0x30
 
+# Geometry of version 1 volumes, which have no superblock
 NUM_BLOCKS = 16
 BLOCK_SIZE = 64
 DISK_NAME = "my-disk"
 
+# The filetable has one byte per block, and takes as many blocks from block 0
+# as it needs. The root directory follows it.
+FILE_TABLE_BLOCKS = (NUM_BLOCKS + BLOCK_SIZE - 1) // BLOCK_SIZE
+ROOT_BLOCK = FILE_TABLE_BLOCKS
+
 START_OF_METADATA = 0
 END_OF_METADATA = 39
 START_OF_CONTENT = 39
+
+# Version 2 volumes describe themselves in a superblock at block 0, and their
+# filetable entries are 32 bits wide. A zeroed table is entirely free space.
+WIDE_END_OF_FILE = 0xFFFFFFFF
+WIDE_RESERVED_SPACE = 0xFFFFFFFE
+WIDE_FREE_SPACE = 0
+
+WIDE_HEADER_SIZE = 64
+
+DEFAULT_NUM_BLOCKS = 4096
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_JOURNAL_BLOCKS = 256
+MIN_BLOCK_SIZE = 128
@@ -13,23 +13,64 @@
 
 from __future__ import division, print_function
 
+import mmap
 import os
-from typing import Any
+from contextlib import contextmanager
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+from constants import BLOCK_SIZE, DISK_NAME, NUM_BLOCKS
+from structures.Superblock import FEATURE_JOURNAL, SUPERBLOCK_SIZE, Superblock
 from util.FMLog import FMLog
 
-NUM_BLOCKS = 16
-BLOCK_SIZE = 64
-DISK_NAME = "my-disk"
+Block = Union[bytearray, memoryview]
 
+T = TypeVar("T")
 
-def low_level_format() -> None:
-    """Creates the file system space on disk.
+# (block number, buffer) pairs for the vectored transfers. A buffer starts at
+# the start of its block, and may run on into the blocks after it.
+BlockIO = Sequence[Tuple[int, Any]]
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+
+def low_level_format(
+    superblock: Optional[Superblock] = None,
+    path: str = DISK_NAME,
+    preallocate: bool = False,
+) -> None:
+    """Creates the file system space on disk. Given a superblock, the image
+    takes its geometry and the superblock is written to block 0; otherwise
+    the image is a blank version 1 volume. The image is sparse, reading as
+    zeros until written, unless preallocate asks for its space to be reserved
+    up front.
     Warning: calling this erases any existing data in the file system.
     """
-    with open(DISK_NAME, "w+b") as disk:
-        for _ in range(NUM_BLOCKS):
-            block = bytearray([0] * BLOCK_SIZE)
-            disk.write(block)
+    geometry = superblock or Superblock.legacy()
+    size = geometry.num_blocks * geometry.block_size
+    with open(path, "w+b") as disk:
+        disk.truncate(size)
+        if preallocate and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(disk.fileno(), 0, size)
+        if superblock is not None:
+            disk.write(superblock.encode())
         disk.flush()
 
 
@@ -53,6 +94,426 @@ def write_block(block_num: int, data: Any) -> None:
         disk.write(data)
 
 
+class Device(object):
+    """Anything the filesystem structures can read and write blocks through.
+    The superblock describes the volume on it."""
+
+    superblock: Superblock
+
+    def read_block(self, block_num: int) -> Block:
+        raise NotImplementedError
+
+    def write_block(self, block_num: int, data: Any, offset: int = 0) -> None:
+        raise NotImplementedError
+
+    def read_run(self, block_num: int, count: int) -> Block:
+        """Reads count consecutive blocks starting at block_num."""
+        data = bytearray()
+        for block in range(block_num, block_num + count):
+            data += self.read_block(block)
+        return data
+
+    def write_run(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes data across consecutive blocks, starting offset bytes into
+        the block_num block."""
+        block_size = self.superblock.block_size
+        written = 0
+        while written < len(data):
+            (index, in_block) = divmod(offset + written, block_size)
+            piece = min(len(data) - written, block_size - in_block)
+            self.write_block(
+                block_num + index, data[written : written + piece], in_block
+            )
+            written += piece
+
+    def write_data(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes file contents, as write_run does. They need not reach the
+        disk with the metadata written alongside them, so devices that commit
+        writes together may leave them out."""
+        self.write_run(block_num, data, offset)
+
+    def read_blocks(self, reads: BlockIO) -> None:
+        """Fills each buffer from its block, and the blocks after it if the
+        buffer is longer than a block."""
+        block_size = self.superblock.block_size
+        for (block_num, buffer) in reads:
+            size = len(buffer)
+            data = self.read_run(block_num, (size + block_size - 1) // block_size)
+            memoryview(buffer)[:] = data[:size]
+
+    def write_blocks(self, writes: BlockIO) -> None:
+        """Writes each buffer from the start of its block."""
+        for (block_num, data) in writes:
+            self.write_run(block_num, data)
+
+    def prefetch(self, block_num: int, count: int) -> None:
+        """Hints that count consecutive blocks from block_num will be read
+        soon. Devices that cannot use the hint ignore it."""
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of what the device has done, for those that keep any."""
+        return {}
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Groups the writes of one operation, for devices that commit them
+        together. Others have nothing to do."""
+        yield
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Calls callback once the writes so far are committed and home.
+        Devices that do not commit writes together call it straight away."""
+        callback()
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class BlockDevice(Device):
+    """A disk image held open for the lifetime of a mount. Blocks are moved
+    with pread/pwrite on the held descriptor, rather than opening the image for
+    every transfer. A read-only device fails every write."""
+
+    def __init__(self, path: str = DISK_NAME, read_only: bool = False) -> None:
+        self.path = path
+        self.read_only = read_only
+        self.fd: Optional[int] = os.open(path, os.O_RDONLY if read_only else os.O_RDWR)
+        self.superblock = (
+            Superblock.decode(os.pread(self.fd, SUPERBLOCK_SIZE, 0))
+            or Superblock.legacy()
+        )
+        self.block_size = self.superblock.block_size
+        self.num_blocks = self.superblock.num_blocks
+
+        # transfers and syncs, however many blocks each moved
+        self.reads = 0
+        self.writes = 0
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.syncs = 0
+
+    def _descriptor(self) -> int:
+        if self.fd is None:
+            raise IOError("Block device is closed")
+        return self.fd
+
+    def read_block(self, block_num: int) -> Block:
+        """Reads block_num block from the device.
+        Return: a bytearray of the block size
+        """
+        if block_num >= self.num_blocks:
+            raise IOError("Block number out of range")
+        self.reads += 1
+        self.read_bytes += self.block_size
+        return bytearray(
+            os.pread(
+                self._descriptor(), self.block_size, block_num * self.block_size
+            )
+        )
+
+    def write_block(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes data to the block_num block of the device, starting offset
+        bytes into the block."""
+        if block_num >= self.num_blocks:
+            raise IOError("Block number out of range")
+        self.writes += 1
+        self.written_bytes += len(data)
+        os.pwrite(self._descriptor(), data, block_num * self.block_size + offset)
+
+    def read_run(self, block_num: int, count: int) -> Block:
+        """Reads count consecutive blocks in a single pread."""
+        if block_num + count > self.num_blocks:
+            raise IOError("Block number out of range")
+        self.reads += 1
+        self.read_bytes += count * self.block_size
+        return bytearray(
+            os.pread(
+                self._descriptor(), count * self.block_size, block_num * self.block_size
+            )
+        )
+
+    def write_run(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes data across consecutive blocks in a single pwrite."""
+        start = block_num * self.block_size + offset
+        if start + len(data) > self.superblock.image_size:
+            raise IOError("Block number out of range")
+        self.writes += 1
+        self.written_bytes += len(data)
+        os.pwrite(self._descriptor(), data, start)
+
+    def read_blocks(self, reads: BlockIO) -> None:
+        """Fills the buffers with one preadv per run of adjacent blocks."""
+        fd = self._descriptor()
+        for (offset, buffers) in self._runs(reads):
+            self.reads += 1
+            self.read_bytes += sum(len(buffer) for buffer in buffers)
+            if hasattr(os, "preadv"):
+                os.preadv(fd, buffers, offset)
+                continue
+            data = os.pread(fd, sum(len(buffer) for buffer in buffers), offset)
+            for buffer in buffers:
+                size = len(buffer)
+                memoryview(buffer)[:] = data[:size]
+                data = data[size:]
+
+    def write_blocks(self, writes: BlockIO) -> None:
+        """Writes the buffers with one pwritev per run of adjacent blocks."""
+        fd = self._descriptor()
+        for (offset, buffers) in self._runs(writes):
+            self.writes += 1
+            self.written_bytes += sum(len(buffer) for buffer in buffers)
+            if hasattr(os, "pwritev"):
+                os.pwritev(fd, buffers, offset)
+            else:
+                os.pwrite(fd, b"".join(buffers), offset)
+
+    def _runs(self, transfers: BlockIO) -> List[Tuple[int, List[Any]]]:
+        """Sorts the transfers by block and merges those that meet end to end
+        into runs of (byte offset, buffers), each short enough for one
+        vectored call."""
+        runs: List[Tuple[int, List[Any]]] = []
+        end = -1
+        for (block_num, buffer) in sorted(transfers, key=lambda pair: pair[0]):
+            start = block_num * self.block_size
+            if start + len(buffer) > self.superblock.image_size:
+                raise IOError("Block number out of range")
+            if start == end and len(runs[-1][1]) < IOV_MAX:
+                runs[-1][1].append(buffer)
+            else:
+                runs.append((start, [buffer]))
+            end = start + len(buffer)
+        return runs
+
+    def prefetch(self, block_num: int, count: int) -> None:
+        """Asks the kernel to start reading the blocks into the page cache."""
+        if hasattr(os, "posix_fadvise") and self.fd is not None:
+            os.posix_fadvise(
+                self.fd,
+                block_num * self.block_size,
+                count * self.block_size,
+                os.POSIX_FADV_WILLNEED,
+            )
+
+    def flush(self) -> None:
+        """Forces all written blocks down to the disk image."""
+        if self.fd is not None:
+            self.syncs += 1
+            os.fsync(self.fd)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "read_bytes": self.read_bytes,
+            "written_bytes": self.written_bytes,
+            "syncs": self.syncs,
+        }
+
+    def close(self) -> None:
+        """Flushes and releases the disk image. Closing twice is harmless."""
+        if self.fd is None:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.fd = None
+
+
+class MmapBlockDevice(BlockDevice):
+    """A disk image mapped into memory. Reads are memoryview slices of the
+    mapping and writes copy straight into it, so neither costs a syscall.
+    Changes reach the image on flush (msync) or when the mapping is closed."""
+
+    def __init__(self, path: str = DISK_NAME, read_only: bool = False) -> None:
+        super().__init__(path, read_only)
+        self.map: Optional[mmap.mmap] = mmap.mmap(
+            self._descriptor(),
+            self.superblock.image_size,
+            access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE,
+        )
+        self.view = memoryview(self.map)
+
+    def read_block(self, block_num: int) -> Block:
+        """Reads block_num block from the mapping.
+        Return: a memoryview of the block size, which aliases the mapped image
+        """
+        if block_num >= self.num_blocks:
+            raise IOError("Block number out of range")
+        self.reads += 1
+        self.read_bytes += self.block_size
+        start = block_num * self.block_size
+        return self.view[start : start + self.block_size]
+
+    def write_block(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Copies data into the block_num block of the mapping, starting
+        offset bytes into the block."""
+        if block_num >= self.num_blocks:
+            raise IOError("Block number out of range")
+        self.writes += 1
+        self.written_bytes += len(data)
+        start = block_num * self.block_size + offset
+        self.view[start : start + len(data)] = data
+
+    def read_run(self, block_num: int, count: int) -> Block:
+        """Reads count consecutive blocks as one view of the mapping."""
+        if block_num + count > self.num_blocks:
+            raise IOError("Block number out of range")
+        self.reads += 1
+        self.read_bytes += count * self.block_size
+        start = block_num * self.block_size
+        return self.view[start : start + count * self.block_size]
+
+    def write_run(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Copies data across consecutive blocks of the mapping."""
+        start = block_num * self.block_size + offset
+        if start + len(data) > self.superblock.image_size:
+            raise IOError("Block number out of range")
+        self.writes += 1
+        self.written_bytes += len(data)
+        self.view[start : start + len(data)] = data
+
+    # copying to and from the mapping costs no syscall, so there is nothing to
+    # gain by merging transfers
+    read_blocks = Device.read_blocks
+    write_blocks = Device.write_blocks
+
+    def prefetch(self, block_num: int, count: int) -> None:
+        """Asks the kernel to fault the blocks' pages into the mapping."""
+        if self.map is None or not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        # madvise wants a page aligned start
+        start = block_num * self.block_size
+        aligned = start - start % mmap.PAGESIZE
+        self.map.madvise(
+            mmap.MADV_WILLNEED, aligned, start - aligned + count * self.block_size
+        )
+
+    def flush(self) -> None:
+        """msyncs the mapping to the disk image."""
+        if self.map is not None:
+            self.syncs += 1
+            self.map.flush()
+
+    def close(self) -> None:
+        if self.map is None:
+            return
+        self.flush()
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # a block view is still held somewhere; the mapping is released
+            # when it is garbage collected, and the data is already synced
+            FMLog.warn("Disk mapping still in use at close")
+        self.map = None
+        super().close()
+
+
+DEVICE_MODES: Dict[str, Type[BlockDevice]] = {
+    "file": BlockDevice,
+    "mmap": MmapBlockDevice,
+}
+
+_device: Optional[Device] = None
+
+
+def mount_device(
+    path: str = DISK_NAME,
+    mode: str = "file",
+    cache_size: int = 0,
+    read_only: bool = False,
+) -> Device:
+    """Opens the disk image as the device used by the filesystem structures,
+    closing any previously mounted device first. The mode is a key of
+    DEVICE_MODES. If cache_size is given, blocks are cached in front of the
+    device using at most that many bytes. A volume with a journal has its
+    writes go through it, replaying what a crash left there first, unless it
+    is mounted read_only, when the image is never written."""
+    from structures.BlockCache import BlockCache
+    from structures.Journal import Journal
+
+    global _device
+    unmount_device()
+    device: Device = DEVICE_MODES[mode](path, read_only)
+    if cache_size > 0:
+        device = BlockCache(device, cache_size)
+    if device.superblock.has_feature(FEATURE_JOURNAL):
+        device = Journal(device, read_only=read_only)
+    _device = device
+    return _device
+
+
+def get_device() -> Device:
+    """Returns the mounted device, mounting the default disk if needed."""
+    if _device is None:
+        return mount_device()
+    return _device
+
+
+def get_superblock() -> Superblock:
+    """Returns the superblock of the mounted device."""
+    return get_device().superblock
+
+
+class PerDevice(Generic[T]):
+    """One of a structure for the mounted device, such as its caches and lock
+    table, made by factory from the device on first use, and made again once
+    another device is mounted. Close, if given, is called on the one left
+    behind."""
+
+    def __init__(
+        self,
+        factory: Callable[[Device], T],
+        close: Optional[Callable[[T], None]] = None,
+    ) -> None:
+        self.factory = factory
+        self.close = close
+        self.lock = Lock()
+        self.device: Optional[Device] = None
+        self.instance: Optional[T] = None
+
+    def get(self) -> T:
+        device = get_device()
+        with self.lock:
+            if self.instance is None or self.device is not device:
+                self._drop()
+                self.instance = self.factory(device)
+                self.device = device
+            return self.instance
+
+    def reset(self) -> None:
+        """Drop the one made, if any, closing it."""
+        with self.lock:
+            self._drop()
+
+    def _drop(self) -> None:
+        if self.instance is not None and self.close is not None:
+            self.close(self.instance)
+        self.instance = None
+        self.device = None
+
+
+def device_stats() -> Dict[str, Dict[str, int]]:
+    """The counters of the mounted device, and of each device it sits in
+    front of, by the name of their class."""
+    stats: Dict[str, Dict[str, int]] = {}
+    layer: Any = get_device()
+    while isinstance(layer, Device):
+        stats[type(layer).__name__] = layer.stats()
+        layer = getattr(layer, "device", None)
+    return stats
+
+
+def unmount_device() -> None:
+    """Flushes and closes the mounted device, if there is one."""
+    global _device
+    if _device is not None:
+        _device.close()
+        _device = None
+
+
 def print_block(block_num: int) -> None:
     """Prints block_num block data."""
     data = read_block(block_num)
@@ -74,7 +535,7 @@ def int_to_bytes(value: int, num_bytes: int) -> bytearray:
     return bytes
 
 
-def bytes_to_int(bytes: bytearray) -> int:
+def bytes_to_int(bytes: Block) -> int:
     """Convert a big-endian bytearray into a positive integer."""
     value = 0
     for i in bytes[:-1]:
@@ -90,8 +551,8 @@ def str_to_bytes(value: str, num_bytes: int) -> bytearray:
     return bytearray(value.encode("ascii"))
 
 
-def bytes_to_str(bytes_in: bytearray) -> str:
-    return bytes_in.decode("ascii")
+def bytes_to_str(bytes_in: Block) -> str:
+    return bytes(bytes_in).decode("ascii")
 
 
 if __name__ == "__main__":
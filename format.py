@@ -12,45 +12,118 @@
 # ************************************************************************
 
 import os
-from structures.factories.MetadataFactory import MetadataFactory
-from time import time
-from disktools import BLOCK_SIZE, NUM_BLOCKS, write_block
-from constants import END_OF_FILE, FREE_SPACE
+import struct
 from stat import S_IFDIR
+from time import time
+from typing import Dict, Optional
+
+from constants import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_JOURNAL_BLOCKS,
+    DEFAULT_NUM_BLOCKS,
+    DISK_NAME,
+)
+from disktools import low_level_format, mount_device, unmount_device
+from structures.DirectoryTable import DirectoryTable
+from structures.factories.MetadataFactory import MetadataFactory
+from structures.Superblock import FEATURE_EXTENTS, Superblock
 from util.FMLog import FMLog
 
-# Filetable
-initial_table_block = bytearray([FREE_SPACE] * NUM_BLOCKS)
-initial_table_block[0] = END_OF_FILE
-initial_table_block[1] = END_OF_FILE
-
-FMLog.warn("✔  Created filetable in disk block 0")
-
-now = time()
-dir_meta = (
-    MetadataFactory()
-    .set_with_params(
-        LOCATION=0x01,
-        MODE=(S_IFDIR | 0o755),
-        ATIME=int(now),
-        CTIME=int(now),
-        MTIME=int(now),
-        NLINKS=2,
-        GID=os.getgid(),
-        UID=os.getuid(),
-        NAME="FMFS",
-        TYPE=0,
-        SIZE=64,
+
+def default_superblock() -> Superblock:
+    """The layout of a volume made without being told otherwise."""
+    return Superblock.create(
+        DEFAULT_NUM_BLOCKS,
+        DEFAULT_BLOCK_SIZE,
+        label="FMFS",
+        features=FEATURE_EXTENTS,
+        journal_blocks=DEFAULT_JOURNAL_BLOCKS,
     )
-    .construct()
-    .form_bytes()
-)
 
-root_dir = bytearray([0] * (BLOCK_SIZE - len(dir_meta)))
-write_block(0, initial_table_block)
-write_block(1, dir_meta + root_dir)
 
-FMLog.warn("✔  Created root directory in disk block 1")
+def chain(entries: Dict[int, int], start: int, count: int, end: int) -> None:
+    """Link count blocks from start into one chain, as a file's blocks are."""
+    for block in range(start, start + count - 1):
+        entries[block] = block + 1
+    entries[start + count - 1] = end
+
+
+def encode_entries(superblock: Superblock, entries: Dict[int, int]) -> bytes:
+    """The start of the filetable, up to the last of entries, as on disk."""
+    table = [superblock.free_space] * (max(entries) + 1)
+    for (block, entry) in entries.items():
+        table[block] = entry
+    if superblock.pointer_width == 1:
+        return bytes(table)
+    return struct.pack(f">{len(table)}I", *table)
+
 
+def format_image(
+    superblock: Optional[Superblock] = None,
+    path: str = DISK_NAME,
+    preallocate: bool = False,
+) -> None:
+    """Make a new, empty volume at path laid out as superblock says. Only the
+    superblock, the used start of the filetable and the root directory are
+    written, so this takes as long for a big volume as for a small one.
+    Warning: this erases anything already in the image."""
+    superblock = superblock or default_superblock()
+    low_level_format(superblock, path, preallocate)
+    device = mount_device(path)
 
-FMLog.trace("🚀 Installation and initialization of the FM Filesystem is complete!")
\ No newline at end of file
+    # The superblock is reserved, and the filetable is chained through its own
+    # blocks. The rest of the table is free space, as the image reads zeros.
+    end = superblock.end_of_file
+    entries = {0: superblock.reserved_space}
+    chain(entries, superblock.table_start, superblock.table_blocks, end)
+    table_end = superblock.table_start + superblock.table_blocks - 1
+
+    FMLog.warn(
+        "✔  Created filetable in disk blocks %d to %d",
+        superblock.table_start,
+        table_end,
+    )
+
+    # and so is the journal
+    if superblock.journal_blocks:
+        journal_start = superblock.journal_start
+        journal_end = journal_start + superblock.journal_blocks - 1
+        chain(entries, journal_start, superblock.journal_blocks, end)
+
+        FMLog.warn(
+            "✔  Created journal in disk blocks %d to %d", journal_start, journal_end
+        )
+
+    now = time()
+    dir_meta = (
+        MetadataFactory()
+        .set_with_params(
+            LOCATION=superblock.root_block,
+            MODE=(S_IFDIR | 0o755),
+            ATIME=int(now),
+            CTIME=int(now),
+            MTIME=int(now),
+            NLINKS=2,
+            GID=os.getgid(),
+            UID=os.getuid(),
+            NAME="FMFS",
+            TYPE=0,
+            SIZE=64,
+        )
+        .construct()
+        .form_bytes()
+    )
+
+    entries[superblock.root_block] = end
+    device.write_block(superblock.root_block, dir_meta + DirectoryTable().to_bytes())
+    device.write_run(superblock.table_start, encode_entries(superblock, entries))
+    unmount_device()
+
+    FMLog.warn("✔  Created root directory in disk block %d", superblock.root_block)
+
+
+if __name__ == "__main__":
+    format_image()
+    FMLog.success(
+        "🚀 Installation and initialization of the FM Filesystem is complete!"
+    )
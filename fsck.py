@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+"""Check an unmounted FMFS volume, and optionally repair it. The filetable is
+loaded as one array and every chain followed at once, so an image of millions
+of blocks is checked in seconds:
+
+    python fsck.py --repair my-disk
+
+Without --repair the image is only read, never written. Transactions a crash
+left in the journal are then reported as a problem rather than replayed, and
+the volume is checked as it is on disk, without them. With --repair they are
+replayed first, as a mount would, and what is found is fixed in place.
+
+Exits 0 if the volume was clean, 1 if every problem was repaired, and 4 if
+problems were left.
+"""
+
+import argparse
+import struct
+import sys
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Set, Tuple
+
+from disktools import device_stats, get_superblock, mount_device, unmount_device
+from structures.DirectoryTable import DirectoryTable
+from structures.ExtentMap import EXTENT_FIELDS_OFFSET, OVERFLOW_HEADER, ExtentMap
+from structures.Metadata import header_dtype
+from structures.Superblock import (
+    FEATURE_EXTENTS,
+    FEATURE_ITEM_COUNT,
+    SUPERBLOCK_SIZE,
+    Superblock,
+)
+from util.FMLog import FMLog
+
+try:
+    import numpy
+except ImportError:  # checked for in main
+    numpy = None
+
+CLEAN = 0
+REPAIRED = 1
+UNREPAIRED = 4
+
+# (name, location, type) of a directory entry
+Child = Tuple[str, int, int]
+
+
+class Checker(object):
+    """Checks the volume in an image against itself. Every chain in the
+    filetable is labelled with its first block by pointer doubling, in a
+    number of passes that grows with the log of the longest chain, and
+    headers are decoded in bulk through a structured view of the image. Only
+    the walk of the directory tree goes one directory at a time.
+
+    Problems are noted as they are found. When repairing, leaked blocks are
+    freed, chains that run into another are cut, directory entries that point
+    nowhere are removed, and link counts, sizes, extent maps and the item count
+    are made to agree with what is on disk."""
+
+    def __init__(self, path: str, superblock: Superblock, repair: bool) -> None:
+        self.superblock = superblock
+        self.repair = repair
+        self.problems: List[str] = []
+        self.unrepaired = 0
+        # whether some directory could not be read, so that its children
+        # would look leaked
+        self.incomplete = False
+
+        self.num_blocks = superblock.num_blocks
+        self.block_size = superblock.block_size
+        self.image = numpy.memmap(
+            path,
+            dtype=numpy.uint8,
+            mode="r+" if repair else "r",
+            shape=(self.num_blocks * self.block_size,),
+        )
+        width = superblock.pointer_width
+        start = superblock.table_start * self.block_size
+        self.table = self.image[start : start + self.num_blocks * width].view(
+            ">u4" if width == 4 else "u1"
+        )
+        self.entries = self.table.astype(numpy.int64)
+        self.original = self.entries.copy()
+        self.headers = self.image.view(
+            header_dtype(self.block_size, superblock.version)
+        )
+        self.extents = self.image.view(
+            numpy.dtype(
+                {
+                    "names": ["first_run", "overflow"],
+                    "formats": [">u4", ">u4"],
+                    "offsets": [EXTENT_FIELDS_OFFSET, EXTENT_FIELDS_OFFSET + 4],
+                    "itemsize": self.block_size,
+                }
+            )
+        )
+        self.blocks = numpy.arange(self.num_blocks, dtype=numpy.int64)
+
+        # filled in as the check goes
+        self.next = numpy.full(self.num_blocks, -1, dtype=numpy.int64)
+        self.used = numpy.zeros(self.num_blocks, dtype=bool)
+        self.referenced = numpy.zeros(self.num_blocks, dtype=bool)
+        self.directories: List[int] = []
+        self.references: List[int] = []
+        self.subdirectories: Dict[int, int] = {}
+
+    def problem(self, message: str, repairable: bool = True) -> None:
+        self.problems.append(message)
+        if not (self.repair and repairable):
+            self.unrepaired += 1
+
+    def check(self) -> None:
+        self.check_reserved()
+        self.scan_table()
+        self.walk_directories()
+        self.detach_referenced()
+        self.label_chains()
+        self.check_cross_links()
+        self.check_extent_maps()
+        self.check_links()
+        self.check_sizes()
+        self.check_leaks()
+        self.check_item_count()
+        if self.repair:
+            changed = numpy.flatnonzero(self.entries != self.original)
+            self.table[changed] = self.entries[changed]
+            self.image.flush()
+
+    def set_entries(self, blocks: Any, value: Any) -> None:
+        """Change entries of the table, and the links followed from them."""
+        self.entries[blocks] = value
+        self.next[blocks] = numpy.where(
+            self.pointers(self.entries[blocks]), self.entries[blocks], -1
+        )
+
+    def free(self, blocks: Any) -> None:
+        """Free blocks. What they hold is left, as the filesystem overwrites
+        whole blocks when it hands them out again."""
+        self.set_entries(blocks, self.superblock.free_space)
+
+    def pointers(self, entries: Any) -> Any:
+        """Which entries point at another block."""
+        superblock = self.superblock
+        return (
+            (entries != superblock.free_space)
+            & (entries != superblock.reserved_space)
+            & (entries != superblock.end_of_file)
+        )
+
+    def check_reserved(self) -> None:
+        """The superblock, the filetable and the journal are chains the table
+        always has. Any other value their entries have is put right."""
+        superblock = self.superblock
+        regions = [(superblock.table_start, superblock.table_blocks)]
+        if superblock.journal_blocks:
+            regions.append((superblock.journal_start, superblock.journal_blocks))
+        for (start, count) in regions:
+            blocks = numpy.arange(start, start + count)
+            values = blocks + 1
+            values[-1] = superblock.end_of_file
+            wrong = int((self.entries[blocks] != values).sum())
+            if wrong:
+                self.problem(f"{wrong} blocks of the region at {start} are not chained")
+                self.entries[blocks] = values
+            self.referenced[start] = True
+        if superblock.version > 1:
+            if self.entries[0] != superblock.reserved_space:
+                self.problem("The superblock is not reserved")
+                self.entries[0] = superblock.reserved_space
+            self.referenced[0] = True
+
+    def scan_table(self) -> None:
+        """Find the used blocks, and where each chain goes next. A pointer off
+        the volume or to a free block ends its chain there."""
+        entries = self.entries
+        self.used = entries != self.superblock.free_space
+        pointer = self.pointers(entries)
+        target = numpy.clip(entries, 0, self.num_blocks - 1)
+        broken = pointer & ((entries >= self.num_blocks) | ~self.used[target])
+        for block in numpy.flatnonzero(broken):
+            self.problem(
+                f"Chain broken at block {block}, which points to {entries[block]}"
+            )
+        self.entries[broken] = self.superblock.end_of_file
+        self.next = numpy.where(pointer & ~broken, entries, -1)
+
+    def block(self, block: int) -> Any:
+        return self.image[block * self.block_size : (block + 1) * self.block_size]
+
+    def chain(self, first: int) -> List[int]:
+        """The blocks of the chain from first, in order, stopping at a loop."""
+        blocks = [first]
+        seen = {first}
+        block = int(self.next[first])
+        while block >= 0 and block not in seen:
+            blocks.append(block)
+            seen.add(block)
+            block = int(self.next[block])
+        return blocks
+
+    def read_file(self, first: int) -> Tuple[List[int], bytearray]:
+        blocks = self.chain(first)
+        data = bytearray()
+        for block in blocks:
+            data += self.block(block).tobytes()
+        return (blocks, data)
+
+    def read_directory(self, block: int) -> List[Child]:
+        """The entries of the directory at block, from its table, or in the
+        old format from the pointers it holds."""
+        (_, data) = self.read_file(block)
+        content = data[self.superblock.header_size :]
+        version = self.superblock.version
+        if DirectoryTable.is_hashed(content):
+            table = DirectoryTable.from_bytes(content, version)
+            return [
+                (name, location, kind) for (_, location, kind, name) in table.entries()
+            ]
+        if version > 1:
+            raise ValueError("not a directory table")
+        types = self.headers["TYPE"]
+        return [
+            ("", location, int(types[location]) if location < self.num_blocks else -1)
+            for location in content
+            if location
+        ]
+
+    def walk_directories(self) -> None:
+        """Visit every directory from the root, checking that each entry
+        points at the header of a file or directory of its type."""
+        root = self.superblock.root_block
+        self.referenced[root] = True
+        pending: Deque[Tuple[int, str]] = deque([(root, "")])
+        visited: Set[int] = {root}
+        while pending:
+            (block, path) = pending.popleft()
+            self.directories.append(block)
+            try:
+                children = self.read_directory(block)
+            except (ValueError, struct.error, UnicodeDecodeError):
+                self.problem(f"Directory {path or '/'} cannot be read", False)
+                self.incomplete = True
+                continue
+
+            locations = numpy.array(
+                [location for (_, location, _) in children], dtype=numpy.int64
+            )
+            kinds = numpy.array([kind for (_, _, kind) in children], dtype=numpy.int64)
+            inside = (locations >= self.superblock.root_block) & (
+                locations < self.num_blocks
+            )
+            clipped = numpy.where(inside, locations, 0)
+            valid = (
+                inside
+                & self.used[clipped]
+                & (self.headers["LOCATION"][clipped] == clipped)
+                & (self.headers["TYPE"][clipped] == kinds)
+            )
+
+            remove: List[int] = []
+            subdirectories = 0
+            for ((name, location, kind), ok) in zip(children, valid.tolist()):
+                name = name or str(location)
+                if not ok:
+                    self.problem(
+                        f"{path}/{name} points to block {location}, not a file"
+                    )
+                    remove.append(location)
+                elif kind == 0 and location in visited:
+                    self.problem(f"Directory {path}/{name} is linked more than once")
+                    remove.append(location)
+                elif kind == 0:
+                    visited.add(location)
+                    subdirectories += 1
+                    pending.append((location, f"{path}/{name}"))
+                    self.referenced[location] = True
+                else:
+                    self.references.append(location)
+                    self.referenced[location] = True
+            self.subdirectories[block] = subdirectories
+            if remove and self.repair:
+                self.remove_entries(block, remove)
+
+    def remove_entries(self, block: int, locations: List[int]) -> None:
+        (blocks, data) = self.read_file(block)
+        header_size = self.superblock.header_size
+        content = data[header_size:]
+        if DirectoryTable.is_hashed(content):
+            table = DirectoryTable.from_bytes(content, self.superblock.version)
+            for location in locations:
+                table.remove(location)
+            content[: len(table.to_bytes())] = table.to_bytes()
+        else:
+            content = bytearray(0 if byte in locations else byte for byte in content)
+        data[header_size:] = content
+        for (index, block) in enumerate(blocks):
+            self.block(block)[:] = numpy.frombuffer(
+                data, numpy.uint8, self.block_size, index * self.block_size
+            )
+
+    def detach_referenced(self) -> None:
+        """A file or directory starts a chain of its own, so a chain running
+        into one is cut short before it."""
+        into = numpy.flatnonzero(self.next >= 0)
+        into = into[self.referenced[self.next[into]]]
+        for block in into:
+            self.problem(
+                f"Chain through block {block} runs into file at {self.next[block]}"
+            )
+        self.set_entries(into, self.superblock.end_of_file)
+
+    def label_chains(self) -> None:
+        """Label every block with the first block of its chain, by following
+        links back in doubling steps, and count the blocks in each chain."""
+        linked = self.next >= 0
+        self.indegree = numpy.bincount(self.next[linked], minlength=self.num_blocks)
+        previous = numpy.full(self.num_blocks, -1, dtype=numpy.int64)
+        previous[self.next[linked]] = self.blocks[linked]
+        self.previous = previous
+
+        first = numpy.where(previous >= 0, previous, self.blocks)
+        for _ in range(self.num_blocks.bit_length() + 1):
+            further = first[first]
+            if numpy.array_equal(further, first):
+                break
+            first = further
+        self.first = first
+        # blocks that never lead back to a start are on a loop, or off one
+        self.looped = self.used & (previous[first] >= 0)
+        chained = self.used & ~self.looped
+        self.lengths = numpy.bincount(first[chained], minlength=self.num_blocks)
+        # how many of the following blocks are each the next in the chain, so
+        # that a run of contiguous blocks from b has length ahead[b] + 1
+        breaks = numpy.where(self.next != self.blocks + 1, self.blocks, self.num_blocks)
+        self.ahead = numpy.minimum.accumulate(breaks[::-1])[::-1] - self.blocks
+
+    def check_cross_links(self) -> None:
+        """Two chains pointing at the same block share a tail. The one found
+        first keeps it, and the other is cut short."""
+        sources = numpy.flatnonzero(self.next >= 0)
+        sources = sources[self.indegree[self.next[sources]] > 1]
+        losers = sources[self.previous[self.next[sources]] != sources]
+        for block in losers:
+            target = self.next[block]
+            self.problem(
+                f"Block {target} is in the chains of both "
+                f"{self.first[self.previous[target]]} and {self.first[block]}"
+            )
+        self.set_entries(losers, self.superblock.end_of_file)
+        self.clear_maps(numpy.unique(self.first[losers]))
+
+    def check_extent_maps(self) -> None:
+        """On volumes that keep them, the extent map in each file's header has
+        to describe its chain exactly. Its overflow block belongs to it."""
+        if not self.superblock.has_feature(FEATURE_EXTENTS):
+            return
+        heads = numpy.unique(
+            numpy.array(self.directories + self.references, dtype=numpy.int64)
+        )
+        first_run = self.extents["first_run"][heads].astype(numpy.int64)
+        overflow = self.extents["overflow"][heads].astype(numpy.int64)
+
+        bad = (first_run == 0) & (overflow != 0)
+        mapped = first_run != 0
+        bad |= mapped & (first_run != self.ahead[heads] + 1)
+        bad |= mapped & (overflow == 0) & (first_run != self.lengths[heads])
+        for index in numpy.flatnonzero(mapped & ~bad & (overflow != 0)):
+            matches = self.overflow_matches(
+                heads[index], first_run[index], overflow[index]
+            )
+            bad[index] = not matches
+        for head in heads[bad]:
+            self.problem(f"Extent map of file at {head} does not match its chain")
+        self.clear_maps(heads[bad])
+
+        good = overflow[mapped & ~bad & (overflow != 0)]
+        self.referenced[good] = True
+
+    def overflow_matches(self, head: int, first_run: int, overflow: int) -> bool:
+        if not (
+            self.superblock.root_block < overflow < self.num_blocks
+            and self.entries[overflow] == self.superblock.end_of_file
+            and self.indegree[overflow] == 0
+            and not self.referenced[overflow]
+        ):
+            return False
+        data = self.block(overflow).tobytes()
+        (count,) = OVERFLOW_HEADER.unpack_from(data, 0)
+        if count > ExtentMap.overflow_capacity(self.block_size):
+            return False
+        last = head + first_run - 1
+        total = first_run
+        for (start, length) in ExtentMap.decode_runs(data):
+            if (
+                not 0 < start < self.num_blocks
+                or self.next[last] != start
+                or self.ahead[start] + 1 != length
+            ):
+                return False
+            last = start + length - 1
+            total += length
+        return total == self.lengths[head] and self.next[last] < 0
+
+    def clear_maps(self, heads: Any) -> None:
+        """Drop the extent maps of files, so that their chains are followed
+        instead. Overflow blocks are then leaked, and freed with the rest."""
+        if not self.repair or not self.superblock.has_feature(FEATURE_EXTENTS):
+            return
+        overflow = self.extents["overflow"][heads].astype(numpy.int64)
+        self.referenced[overflow[(overflow > 0) & (overflow < self.num_blocks)]] = False
+        self.extents["first_run"][heads] = 0
+        self.extents["overflow"][heads] = 0
+
+    def check_links(self) -> None:
+        """A file has a link for each entry naming it, and a directory one
+        from its parent, one of its own, and one from each subdirectory."""
+        files = numpy.array(self.references, dtype=numpy.int64)
+        (blocks, counts) = numpy.unique(files, return_counts=True)
+        # only the directories that could be read have known subdirectories
+        directories = numpy.fromiter(self.subdirectories.keys(), dtype=numpy.int64)
+        subdirectories = numpy.fromiter(self.subdirectories.values(), dtype=numpy.int64)
+        blocks = numpy.concatenate([blocks, directories])
+        expected = numpy.concatenate([counts, 2 + subdirectories])
+        links = self.headers["NLINKS"][blocks].astype(numpy.int64)
+        wrong = numpy.flatnonzero(links != expected)
+        for index in wrong:
+            self.problem(
+                f"File at {blocks[index]} has {links[index]} links, "
+                f"but {expected[index]} are found"
+            )
+            if self.repair:
+                self.headers["NLINKS"][blocks[index]] = expected[index]
+
+    def check_sizes(self) -> None:
+        """A file's chain never has more blocks than its size needs. It may
+        have fewer, the rest reading as zeros."""
+        files = numpy.unique(numpy.array(self.references, dtype=numpy.int64))
+        sizes = self.headers["SIZE"][files].astype(numpy.int64)
+        needed = (
+            self.superblock.header_size + sizes + self.block_size - 1
+        ) // self.block_size
+        lengths = self.lengths[files]
+        for index in numpy.flatnonzero(lengths > needed):
+            head = int(files[index])
+            self.problem(
+                f"File at {head} has {lengths[index]} blocks, "
+                f"but its size needs {needed[index]}"
+            )
+            blocks = self.chain(head)
+            keep = int(needed[index])
+            self.set_entries(blocks[keep - 1], self.superblock.end_of_file)
+            self.free(blocks[keep:])
+            self.used[blocks[keep:]] = False
+            self.clear_maps([head])
+
+    def check_leaks(self) -> None:
+        """Every used block has to be in a chain that something refers to."""
+        leaked = self.used & (self.looped | ~self.referenced[self.first])
+        leaked &= self.entries != self.superblock.free_space
+        if not leaked.any():
+            return
+        chains = numpy.unique(numpy.where(self.looped, -1, self.first)[leaked])
+        looped = int((self.looped & leaked).sum())
+        self.problem(
+            f"Leaked blocks: {int(leaked.sum())}, in {len(chains[chains >= 0])} "
+            f"chains and {looped} on loops",
+            not self.incomplete,
+        )
+        if self.repair and not self.incomplete:
+            self.free(leaked)
+
+    def check_item_count(self) -> None:
+        """A superblock that counts the files and directories has to count the
+        entries found, and the root. It is read again, as replaying the journal
+        may have changed it."""
+        stored = Superblock.decode(bytes(self.image[:SUPERBLOCK_SIZE]))
+        if stored is None or not stored.has_feature(FEATURE_ITEM_COUNT):
+            return
+        found = len(self.directories) + len(self.references)
+        if stored.items == found or self.incomplete:
+            return
+        self.problem(f"Superblock counts {stored.items} items, but {found} are found")
+        if self.repair:
+            stored.items = found
+            data = stored.encode()
+            self.image[: len(data)] = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+
+    def summary(self) -> Dict[str, Any]:
+        """Figures for the volume as it is on disk, which is only as the check
+        left it when repairing."""
+        entries = self.entries if self.repair else self.original
+        used = int((entries != self.superblock.free_space).sum())
+        return {
+            "blocks": self.num_blocks,
+            "used_blocks": used,
+            "directories": len(self.directories),
+            "files": len(set(self.references)),
+            "problems": len(self.problems),
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("image")
+    parser.add_argument(
+        "--repair", action="store_true", help="fix what is found, in place"
+    )
+    args = parser.parse_args()
+    if numpy is None:
+        parser.error("numpy is required to check a volume")
+
+    start = time.perf_counter()
+    # replaying the journal first, as a mount would, leaves the volume as the
+    # last complete operations made it; a check alone leaves it untouched
+    mount_device(args.image, read_only=not args.repair)
+    superblock = get_superblock()
+    journal = device_stats().get("Journal", {})
+    unmount_device()
+
+    checker = Checker(args.image, superblock, args.repair)
+    if journal.get("unreplayed", 0):
+        checker.problem(
+            f"Journal holds {journal['unreplayed']} transactions not yet replayed",
+            repairable=False,
+        )
+    if journal.get("replayed", 0):
+        checker.problem(f"Journal held {journal['replayed']} transactions, replayed")
+    checker.check()
+    for problem in checker.problems:
+        print(problem)
+    summary = checker.summary()
+    FMLog.success(
+        "%s: %d of %d blocks used, %d directories, %d files, %d problems in %.2f s",
+        args.image,
+        summary["used_blocks"],
+        summary["blocks"],
+        summary["directories"],
+        summary["files"],
+        summary["problems"],
+        time.perf_counter() - start,
+    )
+    FMLog.flush()
+
+    if not checker.problems:
+        sys.exit(CLEAN)
+    sys.exit(UNREPAIRED if checker.unrepaired else REPAIRED)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+"""Make a new FMFS volume in a disk image. The image is created sparse, and
+only the superblock, the start of the filetable and the root directory are
+written, so a big volume formats as quickly as a small one:
+
+    python mkfs.py --size 4G --label scratch my-disk
+"""
+
+import argparse
+import re
+import time
+
+from constants import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_JOURNAL_BLOCKS,
+    DEFAULT_NUM_BLOCKS,
+    DISK_NAME,
+    MIN_BLOCK_SIZE,
+)
+from format import format_image
+from structures.Superblock import FEATURE_EXTENTS, Superblock
+from util.FMLog import FMLog
+
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: str) -> int:
+    """Bytes in a size such as 4096, 64M or 2G (powers of 1024)."""
+    match = re.fullmatch(r"(\d+)\s*([KMGT]?)(?:i?B)?", text.strip(), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"not a size: {text!r}")
+    return int(match.group(1)) * UNITS[match.group(2).upper()]
+
+
+def parse_block_size(text: str) -> int:
+    """A size, as parse_size reads it, that a volume can have blocks of."""
+    size = parse_size(text)
+    if size < MIN_BLOCK_SIZE or size & (size - 1):
+        raise argparse.ArgumentTypeError(
+            f"not a power of two of at least {MIN_BLOCK_SIZE} bytes: {text!r}"
+        )
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("image", nargs="?", default=DISK_NAME)
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument(
+        "--size", type=parse_size, help="size of the volume, such as 512M or 4G"
+    )
+    size.add_argument(
+        "--blocks",
+        type=int,
+        help=f"blocks in the volume (default {DEFAULT_NUM_BLOCKS})",
+    )
+    parser.add_argument(
+        "--block-size", type=parse_block_size, default=DEFAULT_BLOCK_SIZE
+    )
+    parser.add_argument("--label", default="FMFS")
+    parser.add_argument(
+        "--journal-blocks",
+        type=int,
+        default=DEFAULT_JOURNAL_BLOCKS,
+        help="blocks of write-ahead journal, 0 for none",
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help="reserve the space of the whole image now rather than as it is used",
+    )
+    args = parser.parse_args()
+
+    if args.size is not None:
+        blocks = args.size // args.block_size
+    else:
+        blocks = args.blocks or DEFAULT_NUM_BLOCKS
+    try:
+        superblock = Superblock.create(
+            blocks,
+            args.block_size,
+            label=args.label,
+            features=FEATURE_EXTENTS,
+            journal_blocks=args.journal_blocks,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    format_image(superblock, args.image, preallocate=args.preallocate)
+    FMLog.success(
+        "Made %s: %d blocks of %d bytes, label %r, in %.3f s",
+        args.image,
+        superblock.num_blocks,
+        superblock.block_size,
+        superblock.label,
+        time.perf_counter() - start,
+    )
+    FMLog.flush()
+
+
+if __name__ == "__main__":
+    main()
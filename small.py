@@ -15,128 +15,289 @@
 
 from __future__ import absolute_import, division, print_function
 
-import logging
 import os
 import platform
-import sys
-from errno import ENOENT, ENOTEMPTY
-from stat import S_IFDIR, S_IFREG
-from time import time
-from typing import Any, Optional, Tuple
-
-from fuse import FUSE, FuseOSError, LoggingMixIn, Operations
-
-from constants import END_OF_METADATA
+import signal
+from errno import ENODATA, ENOTEMPTY, EROFS, errorcode
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fuse import FUSE, FuseOSError, Operations
+
+from constants import DISK_NAME
+from disktools import (
+    DEVICE_MODES,
+    get_device,
+    get_superblock,
+    mount_device,
+    unmount_device,
+)
 from structures.Directory import Directory
+from structures.DirectoryTable import MAX_NAME_LENGTH
 from structures.Filesystem import Filesystem
 from structures.Filetable import FileTable
-from structures.Metadata import Metadata
-from util.FMLog import FMLog
-
+from structures.ReadAhead import stop_readahead
+from structures.StatsFile import XATTR_PREFIX, StatsFile
+from structures.Superblock import FEATURE_JOURNAL
+from util.FMLog import LEVELS, FMLog
+from util.Metrics import get_metrics
+
+# Operations that do not join the journal's running transaction: mounting and
+# unmounting, and those that commit it
+OUTSIDE_TRANSACTIONS = frozenset(("init", "destroy", "flush", "fsync", "fsyncdir"))
+
+# Operations that may be given a path in the stats directory, which is read-only
+STATS_OPERATIONS = frozenset(
+    ("getattr", "open", "read", "readdir", "flush", "release", "getxattr", "listxattr")
+)
+
+
+def describe(args: Tuple[Any, ...]) -> str:
+    """The arguments of an operation for its trace, without file contents."""
+    return repr(
+        tuple(
+            f"<{len(arg)} bytes>" if isinstance(arg, (bytes, bytearray)) else arg
+            for arg in args
+        )
+    )
+
+
+class Small(Operations):
+    """The FUSE operations. They may be called from many threads at once: each
+    holds the locks of the files and directories it touches (see
+    Filesystem.locked), and the filetable and caches lock themselves. Each runs
+    as part of a journal transaction, so that it reaches the disk whole, and
+    then frees whatever it let go of that was too big for that transaction.
+    Its latency is recorded in the metrics shown in the stats file, and a
+    sample of them is traced to the log."""
+
+    def __init__(
+        self, io_mode: str = "file", cache_size: int = 0, image: str = DISK_NAME
+    ):
+        self.io_mode = io_mode
+        self.cache_size = cache_size
+        self.image = image
+        self.stats = StatsFile()
+
+    def __call__(self, op: str, *args: Any) -> Any:
+        if op not in STATS_OPERATIONS and any(
+            isinstance(arg, str) and StatsFile.is_virtual(arg) for arg in args[:2]
+        ):
+            raise FuseOSError(EROFS)
+        metrics = get_metrics()
+        traced = FMLog.sampled()
+        outcome = "ok"
+        start = perf_counter()
+        try:
+            if op in OUTSIDE_TRANSACTIONS:
+                return super().__call__(op, *args)
+            try:
+                with get_device().transaction():
+                    return super().__call__(op, *args)
+            finally:
+                FileTable().release_deferred()
+        except FuseOSError as e:
+            metrics.count(f"op.{op}.errors")
+            outcome = errorcode.get(e.errno, str(e.errno))
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            metrics.observe(f"op.{op}", elapsed)
+            if traced:
+                FMLog.sample(
+                    "%s%s %s in %.0f us", op, describe(args), outcome, elapsed * 1e6
+                )
+
+    def init(self, path: str):
+        mount_device(self.image, mode=self.io_mode, cache_size=self.cache_size)
+        fs = Filesystem()
+        migrated = fs.migrate_directories()
+        if migrated:
+            FMLog.info("Migrated %d directories to the hashed format", migrated)
+        # counted now, before any operation can change it
+        fs.item_count()
 
-class Small(LoggingMixIn, Operations):
-    def __init__(self):
-        self.fd = 0
+    def destroy(self, path: str):
+        FileTable().release_deferred()
+        stop_readahead()
+        unmount_device()
 
     def create(self, path: str, mode: int, fi: Any = ...):
         fs = Filesystem()
-        fs.create_file(path, mode)
+        item = fs.create_file(path, mode)
+        # fusepy only passes the open flags along with raw_fi
+        flags = getattr(fi, "flags", os.O_WRONLY | os.O_CREAT)
+        return fs.handles.open(item.block, flags)
 
-        self.fd += 1
+    def flush(self, path: str, fh):
+        # closing a file does not promise it is on disk, and a journal commits
+        # by itself, so only fsync has to wait for one
+        if not get_superblock().has_feature(FEATURE_JOURNAL):
+            get_device().flush()
 
-        return self.fd
+    def fsync(self, path: str, datasync: int, fh):
+        get_device().flush()
 
     def getattr(self, path: str, fh=None):
+        if StatsFile.is_virtual(path):
+            return self.stats.getattr(path)
         fs = Filesystem()
-        item = fs.smart_resolver(path)
-        return item.get_metadata().to_st_form()
+        with fs.locked_file(path, fh) as (block, _):
+            return fs.get_attributes(block)
 
     def getxattr(self, path: str, name: str, position: int = 0):
-        return bytes()
+        if not name.startswith(XATTR_PREFIX) or StatsFile.is_virtual(path):
+            return bytes()
+        fs = Filesystem()
+        with fs.locked(path) as (block,):
+            attributes = fs.layout_attributes(block)
+        if name not in attributes:
+            raise FuseOSError(ENODATA)
+        return attributes[name].encode("ascii")
+
+    def listxattr(self, path: str):
+        if StatsFile.is_virtual(path):
+            return []
+        fs = Filesystem()
+        with fs.locked(path) as (block,):
+            return list(fs.layout_attributes(block))
 
     def mkdir(self, path: str, mode: int):
-        fs = Filesystem()
-        fs.create_dir(path, mode)
+        Filesystem().create_dir(path, mode)
 
     def open(self, path: str, flags):
-        self.fd += 1
-        return self.fd
+        fs = Filesystem()
+        if StatsFile.is_virtual(path):
+            return fs.handles.open(-1, flags)
+        with fs.locked(path) as (block,):
+            return fs.handles.open(block, flags)
 
     def read(self, path: str, size: int, offset: int, fh):
+        if StatsFile.is_virtual(path):
+            return self.stats.read(path, size, offset)
         fs = Filesystem()
 
-        item = fs.smart_resolver(path)
-        contents = item.get_contents()
-        offsetted = contents[offset : offset + size]
-
-        return bytes(Directory.clear_nulls_from_bytes(offsetted))
+        with fs.locked_file(path, fh) as (block, handle):
+            data = bytes(fs.read_file(block, offset, size, handle))
+        start = get_superblock().header_size + offset
+        stream = handle.stream if handle is not None else None
+        fs.readahead.accessed(block, start, start + len(data), stream)
+        return data
 
     def readdir(self, path: str, fh):
+        if StatsFile.is_virtual(path):
+            return self.stats.readdir(path)
         fs = Filesystem()
 
-        files = fs.smart_resolver(path).get_files(strip_null=True)
-        names = list(map(lambda x: x[0], files))
-
-        return [".", ".."] + names
+        # the attributes of every entry are read together and cached, so the
+        # getattr calls that usually follow a listing are served from the
+        # cache. The kernel still makes those calls: without readdirplus,
+        # libfuse2 takes no more than the file type and inode number from the
+        # attributes passed here.
+        # Offsets are all 0, as the whole listing is returned in one go.
+        with fs.locked(path) as (block,):
+            files = fs.item_from_block(block).get_files(strip_null=True)
+            attributes = fs.list_attributes([block] + [x[1] for x in files])
+
+        entries: List[Tuple[str, Optional[Dict[str, Any]], int]] = [
+            (".", attributes[0], 0),
+            ("..", None, 0),
+        ]
+        for ((name, _, _), attrs) in zip(files, attributes[1:]):
+            entries.append((name, attrs, 0))
+        return entries
+
+    def release(self, path: str, fh):
+        Filesystem().handles.release(fh)
 
     def rename(self, old: str, new: str):
         fs = Filesystem()
         (old_path, _) = fs.get_path_and_base(old)
         (new_path, new_name) = fs.get_path_and_base(new)
 
-        old_parent = fs.smart_resolver(old_path).upcast_dir()
-        new_parent = fs.smart_resolver(new_path).upcast_dir()
+        with fs.locked_for_replace(old_path, old, target=new) as (blocks, existing):
+            (new_parent_block, old_parent_block, file_location) = blocks
+            old_parent = fs.item_from_block(old_parent_block).upcast_dir()
+            new_parent = fs.item_from_block(new_parent_block).upcast_dir()
+
+            if existing not in (-1, file_location):
+                replaced = fs.item_from_block(existing)
+                if replaced.get_files():
+                    raise FuseOSError(ENOTEMPTY)
+                # the file being replaced goes, rather than being orphaned
+                new_parent.remove_file(existing)
 
-        file_location = fs.path_resolver(old)
+            old_parent.unlink_file(file_location)
+            new_parent.link_file(file_location, new_name)
 
-        old_parent.unlink_file(file_location)
-        new_parent.link_file(file_location, new_name)
+            fs.dentries.remove(old)
+            fs.dentries.forget(new)
+            fs.dentries.insert(new, file_location)
 
     def rmdir(self, path: str):
         # with multiple level support, need to raise ENOTEMPTY if contains any files
         fs = Filesystem()
-        dir_to_remove = fs.dir_from_block(fs.path_resolver(path))
-        if not dir_to_remove.deleteable():
-            raise FuseOSError(ENOTEMPTY)
-
         (parent_path, _) = fs.get_path_and_base(path)
-        parent_loc = fs.path_resolver(parent_path)
-        parent_dir = fs.dir_from_block(parent_loc)
-        parent_dir.remove_file(dir_to_remove.block)
+        with fs.locked(parent_path, path, write=True) as (parent_loc, block):
+            dir_to_remove = fs.dir_from_block(block)
+            if not dir_to_remove.deleteable():
+                raise FuseOSError(ENOTEMPTY)
 
-        current_links = (
-            Metadata.build_metadata(parent_dir.get_dir_data()[0]).NLINKS or 2
-        )
-        parent_dir.update_metadata(Metadata(NLINKS=current_links - 1))
+            # removing the entry takes away the parent's link from ".."
+            parent_dir = fs.dir_from_block(parent_loc)
+            parent_dir.remove_file(dir_to_remove.block)
+            fs.dentries.remove(path)
 
     def statfs(self, path: str):
-        return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
+        # every file and directory takes at least a block, so there is room
+        # for as many more as there are free blocks
+        superblock = get_superblock()
+        resident = FileTable.resident()
+        with resident.lock:
+            free = resident.free_space.free_count
+        items = Filesystem().item_count()
+        return dict(
+            f_bsize=superblock.block_size,
+            f_frsize=superblock.block_size,
+            f_blocks=superblock.num_blocks,
+            f_bfree=free,
+            f_bavail=free,
+            f_files=items + free,
+            f_ffree=free,
+            f_favail=free,
+            f_namemax=MAX_NAME_LENGTH,
+        )
+
+    def truncate(self, path: str, length: int, fh=None):
+        fs = Filesystem()
+        with fs.locked_file(path, fh, write=True) as (block, _):
+            fs.truncate_file(block, length)
 
     def unlink(self, path: str):
         fs = Filesystem()
         (dir_path, _) = fs.get_path_and_base(path)
 
-        directory_block = fs.path_resolver(dir_path)
-        file_dir = Directory(directory_block)
-
-        file_location = fs.path_resolver(path)
-        file_dir.remove_file(file_location)
+        with fs.locked(dir_path, path, write=True) as blocks:
+            (directory_block, file_location) = blocks
+            file_dir = Directory(directory_block)
+            file_dir.remove_file(file_location)
+            fs.dentries.remove(path, recursive=False)
 
     def utimens(self, path: str, times: Optional[Tuple[float, float]] = None):
         now = time()
         atime, mtime = times if times else (now, now)
         fs = Filesystem()
-        block_location = fs.path_resolver(path)
-        metadata = fs.get_block_metadata(block_location)
-        metadata.ATIME = int(atime)
-        metadata.MTIME = int(mtime)
-        metadata.save_to_block(block_location)
+        with fs.locked(path, write=True) as (block_location,):
+            metadata = fs.get_block_metadata(block_location)
+            metadata.ATIME = int(atime)
+            metadata.MTIME = int(mtime)
+            metadata.save_to_block(block_location)
 
     def write(self, path: str, data: bytes, offset: int, fh):
         fs = Filesystem()
 
-        block_of_interest = fs.path_resolver(path)
-        size = fs.edit_file(block_of_interest, data, offset)
+        with fs.locked_file(path, fh, write=True) as (block_of_interest, handle):
+            size = fs.edit_file(block_of_interest, data, offset, handle)
 
         return size
 
@@ -152,7 +313,54 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("mount")
+    parser.add_argument(
+        "--image",
+        default=os.environ.get("FMFS_IMAGE", DISK_NAME),
+        help="disk image to mount, by default FMFS_IMAGE or " + DISK_NAME,
+    )
+    parser.add_argument(
+        "--io",
+        choices=sorted(DEVICE_MODES),
+        default="file",
+        help="how the disk image is accessed: pread/pwrite, or memory-mapped",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="bytes of write-back block cache to keep in memory, 0 to disable",
+    )
+    parser.add_argument(
+        "--single-threaded",
+        action="store_true",
+        help="handle one operation at a time instead of one per FUSE thread",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(LEVELS, key=LEVELS.__getitem__),
+        help="least severe messages to log; SIGUSR1 and SIGUSR2 log more and less",
+    )
+    parser.add_argument(
+        "--trace-sample",
+        type=float,
+        default=0.0,
+        help="fraction of operations to trace with their latency, 0 to 1",
+    )
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(Small(), args.mount, foreground=True)
+    if args.log_level:
+        FMLog.set_level(args.log_level)
+    FMLog.set_sampling(args.trace_sample)
+    signal.signal(signal.SIGUSR1, lambda *_: FMLog.step_level(-1))
+    signal.signal(signal.SIGUSR2, lambda *_: FMLog.step_level(1))
+    fuse = FUSE(
+        Small(
+            io_mode=args.io,
+            cache_size=args.cache_size,
+            # opened once mounted, from wherever FUSE is running then
+            image=os.path.abspath(args.image),
+        ),
+        args.mount,
+        foreground=True,
+        nothreads=args.single_threaded,
+    )
@@ -12,13 +12,15 @@
 # ************************************************************************
 
 from errno import EINVAL
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-from constants import END_OF_METADATA, START_OF_CONTENT, START_OF_METADATA
+from disktools import get_superblock
 from fuse import FuseOSError
 from util.FMLog import FMLog
 
 import structures.Directory
+from structures.AttrCache import AttrCache
+from structures.ExtentMap import ExtentMap
 from structures.Filetable import FileTable
 from structures.Metadata import Metadata
 
@@ -30,11 +32,27 @@ class AbstractItem(object):
 
     def get_metadata(self) -> Metadata:
         data = FileTable().read_block(self.block)
-        return Metadata.build_metadata(data[START_OF_METADATA:END_OF_METADATA])
+        return Metadata.build_metadata(data)
 
     def get_contents(self) -> bytearray:
         data = FileTable().read_full_file(self.block)
-        return data[START_OF_CONTENT:]
+        return data[get_superblock().header_size :]
+
+    def read_contents(
+        self, offset: int, size: int, extents: Optional[ExtentMap] = None
+    ) -> bytearray:
+        """Read up to size bytes of content from offset, reading only the
+        blocks that hold them. Reads stop at the end of the file, and read
+        zeros where the file was grown past the end of its chain."""
+        end = min(offset + size, self.get_metadata().SIZE or 0)
+        if offset >= end:
+            return bytearray()
+        header_size = get_superblock().header_size
+        data = FileTable().read_file_range(
+            self.block, header_size + offset, header_size + end, extents
+        )
+        data += bytearray(end - offset - len(data))
+        return data
 
     def get_files(self, strip_null: bool = False) -> List[Tuple[str, int, int]]:
         return []
@@ -48,11 +66,16 @@ class AbstractItem(object):
         blocks_from_dir = filetable.get_file_blocks(self.block)
 
         locations = filetable.write_bytes_to_block(new_data, blocks_from_dir)
+        # free whatever the old chain had past the new end
+        filetable.truncate_chain(self.block, len(locations))
 
         if not metadata_only_change:
-            self.update_metadata(Metadata(SIZE=len(locations) * 64))
+            self.update_metadata(
+                Metadata(SIZE=len(locations) * get_superblock().block_size)
+            )
 
         filetable.write_to_table(locations)
+        AttrCache.mounted().invalidate(self.block)
 
     def update_metadata(self, new_metadata: Metadata) -> None:
         (existing_metadata, normal_data) = self.get_data()
@@ -0,0 +1,100 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from disktools import Device, PerDevice
+
+# Seconds an item's attributes are served from the cache
+ATTR_TTL = 1.0
+
+# Past this many entries, the expired ones are dropped, and then all of them
+MAX_ENTRIES = 65536
+
+Attributes = Dict[str, Any]
+
+
+class AttrCache(object):
+    """The stat attributes of items, by the block of their header, as read
+    by a listing or a getattr, so that listing a directory and then stating
+    each entry reads each header once. Entries last ttl seconds, and anything
+    that rewrites a header drops its entry first. The cache is shared between
+    threads."""
+
+    def __init__(self, device: Device, ttl: float = ATTR_TTL) -> None:
+        self.device = device
+        self.ttl = ttl
+        self.entries: Dict[int, Tuple[float, Attributes]] = {}
+        self.lock = Lock()
+        # bumped by every invalidation, so that attributes read before one
+        # are not cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def mounted() -> "AttrCache":
+        """The cache for the mounted device, created on first use."""
+        return _mounted.get()
+
+    def lookup(self, block: int) -> Optional[Attributes]:
+        """The attributes of the item at block, if cached and not expired."""
+        with self.lock:
+            entry = self.entries.get(block)
+            if entry is not None and entry[0] > monotonic():
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+            return None
+
+    def token(self) -> int:
+        """Take before reading the headers to insert."""
+        with self.lock:
+            return self.generation
+
+    def insert(self, items: Iterable[Tuple[int, Attributes]], token: int) -> None:
+        """Cache attributes read after token was taken. If a header has been
+        rewritten since then, they may be stale, and nothing is cached."""
+        with self.lock:
+            if token != self.generation:
+                return
+            now = monotonic()
+            if len(self.entries) >= MAX_ENTRIES:
+                self.entries = {
+                    block: entry
+                    for (block, entry) in self.entries.items()
+                    if entry[0] > now
+                }
+                if len(self.entries) >= MAX_ENTRIES:
+                    self.entries.clear()
+            expires = now + self.ttl
+            for (block, attributes) in items:
+                self.entries[block] = (expires, dict(attributes))
+
+    def invalidate(self, block: int) -> None:
+        with self.lock:
+            self.entries.pop(block, None)
+            self.generation += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_mounted = PerDevice(AttrCache)
@@ -0,0 +1,202 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from collections import OrderedDict
+from threading import Event, RLock, Thread
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from disktools import Block, BlockIO, Device
+
+
+class BlockCache(Device):
+    """A write-back cache of blocks in front of a BlockDevice, bounded to a
+    byte budget and evicting the least recently used block first. Dirty blocks
+    reach the device when evicted, on flush, and every flush_interval seconds.
+    The cache is used in place of the device, so it offers the same methods."""
+
+    def __init__(
+        self, device: Device, capacity: int, flush_interval: float = 5.0
+    ) -> None:
+        self.device = device
+        self.superblock = device.superblock
+        self.block_size = device.superblock.block_size
+        self.max_blocks = max(1, capacity // self.block_size)
+        self.blocks: "OrderedDict[int, bytearray]" = OrderedDict()
+        self.dirty: Set[int] = set()
+        # blocks being prefetched, mapped to whether they are still clean
+        self.pending: Dict[int, bool] = {}
+        self.lock = RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+        self.prefetched = 0
+
+        self.stopped = Event()
+        self.flusher = Thread(
+            target=self._flush_periodically,
+            args=(flush_interval,),
+            name="fmfs-writeback",
+            daemon=True,
+        )
+        self.flusher.start()
+
+    def _flush_periodically(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            self.write_back()
+
+    def _fetch(self, block_num: int) -> bytearray:
+        """Get the cached copy of a block, loading it on a miss. Caller holds
+        the lock."""
+        block = self.blocks.get(block_num)
+        if block is not None:
+            self.hits += 1
+            self.blocks.move_to_end(block_num)
+            return block
+        self.misses += 1
+        block = bytearray(self.device.read_block(block_num))
+        self._insert(block_num, block)
+        return block
+
+    def _load(self, block_nums: Iterable[int]) -> Dict[int, bytearray]:
+        """Get the cached copies of blocks, loading every miss with one
+        vectored read. Caller holds the lock."""
+        loaded: Dict[int, bytearray] = {}
+        missing: List[int] = []
+        for block_num in block_nums:
+            block = self.blocks.get(block_num)
+            if block is None:
+                missing.append(block_num)
+                continue
+            self.hits += 1
+            self.blocks.move_to_end(block_num)
+            loaded[block_num] = block
+        if missing:
+            self.misses += len(missing)
+            fetched = [(block_num, bytearray(self.block_size)) for block_num in missing]
+            self.device.read_blocks(fetched)
+            for (block_num, block) in fetched:
+                self._insert(block_num, block)
+                loaded[block_num] = block
+        return loaded
+
+    def _insert(self, block_num: int, block: bytearray) -> None:
+        self.blocks[block_num] = block
+        self.blocks.move_to_end(block_num)
+        while len(self.blocks) > self.max_blocks:
+            (evicted, data) = self.blocks.popitem(last=False)
+            if evicted in self.dirty:
+                self.dirty.discard(evicted)
+                self.device.write_block(evicted, data)
+                self.writebacks += 1
+
+    def read_block(self, block_num: int) -> Block:
+        """Reads a block through the cache. The caller gets its own copy."""
+        with self.lock:
+            return bytearray(self._fetch(block_num))
+
+    def read_run(self, block_num: int, count: int) -> Block:
+        """Reads consecutive blocks through the cache, loading the misses
+        together."""
+        with self.lock:
+            loaded = self._load(range(block_num, block_num + count))
+            return bytearray(b"".join(loaded[block] for block in sorted(loaded)))
+
+    def read_blocks(self, reads: BlockIO) -> None:
+        """Fills the buffers through the cache, loading the misses together."""
+        with self.lock:
+            wanted = set()
+            for (block_num, buffer) in reads:
+                count = (len(buffer) + self.block_size - 1) // self.block_size
+                wanted.update(range(block_num, block_num + count))
+            loaded = self._load(sorted(wanted))
+            for (block_num, buffer) in reads:
+                view = memoryview(buffer)
+                for start in range(0, len(view), self.block_size):
+                    piece = view[start : start + self.block_size]
+                    block = loaded[block_num + start // self.block_size]
+                    piece[:] = block[: len(piece)]
+
+    def write_block(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes (possibly part of) a block into the cache, to be written back
+        later."""
+        with self.lock:
+            if block_num in self.pending:
+                self.pending[block_num] = False
+            if offset == 0 and len(data) >= self.block_size:
+                self._insert(block_num, bytearray(data[: self.block_size]))
+            else:
+                # partial writes keep the rest of the block, as pwrite would
+                self._fetch(block_num)[offset : offset + len(data)] = data
+            self.dirty.add(block_num)
+
+    def prefetch(self, block_num: int, count: int) -> None:
+        """Loads the uncached blocks among count from block_num with a single
+        device read, done without holding the lock. A block written while the
+        read is in flight keeps what was written."""
+        with self.lock:
+            wanted = [
+                block
+                for block in range(block_num, block_num + count)
+                if block not in self.blocks and block not in self.pending
+            ]
+            for block in wanted:
+                self.pending[block] = True
+        if not wanted:
+            return
+        first = wanted[0]
+        data: Optional[Block] = None
+        try:
+            data = self.device.read_run(first, wanted[-1] + 1 - first)
+        finally:
+            with self.lock:
+                for block in wanted:
+                    clean = self.pending.pop(block)
+                    if data is None or not clean or block in self.blocks:
+                        continue
+                    start = (block - first) * self.block_size
+                    end = start + self.block_size
+                    self._insert(block, bytearray(data[start:end]))
+                    self.prefetched += 1
+
+    def write_back(self) -> None:
+        """Writes every dirty block to the device, without syncing it."""
+        with self.lock:
+            self.device.write_blocks(
+                [(block_num, self.blocks[block_num]) for block_num in self.dirty]
+            )
+            self.writebacks += len(self.dirty)
+            self.dirty.clear()
+
+    def flush(self) -> None:
+        """Writes back every dirty block and syncs the device."""
+        with self.lock:
+            self.write_back()
+            self.device.flush()
+
+    def close(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            self.write_back()
+            self.blocks.clear()
+            self.device.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writebacks": self.writebacks,
+            "prefetched": self.prefetched,
+            "cached_blocks": len(self.blocks),
+            "dirty_blocks": len(self.dirty),
+        }
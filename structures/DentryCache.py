@@ -0,0 +1,127 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Set
+
+from disktools import Device, PerDevice
+
+# Past this many entries, the least recently used are dropped
+MAX_ENTRIES = 65536
+
+
+class DentryCache(object):
+    """Remembers which block each resolved path lives at. A block of -1 is a
+    negative entry, meaning the path is known not to exist. Entries are
+    dropped when the filesystem operations that change names say so, and the
+    least recently used once there are more than MAX_ENTRIES. The cache is
+    shared between threads."""
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        # the paths directly beneath each path that are cached, or have cached
+        # paths beneath them, so that forgetting a directory only visits what
+        # is cached under it
+        self.children: Dict[str, Set[str]] = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def mounted() -> "DentryCache":
+        """The cache for the mounted device, created on first use."""
+        return _mounted.get()
+
+    def lookup(self, path: str) -> Optional[int]:
+        """Get the cached block of a path, -1 if it is known not to exist, or
+        None if nothing is known."""
+        with self.lock:
+            block = self.entries.get(path)
+            if block is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(path)
+            return block
+
+    def insert(self, path: str, block: int) -> None:
+        with self.lock:
+            self._insert(path, block)
+
+    def _insert(self, path: str, block: int) -> None:
+        self.entries[path] = block
+        self.entries.move_to_end(path)
+        self._link(path)
+        while len(self.entries) > MAX_ENTRIES:
+            (evicted, _) = self.entries.popitem(last=False)
+            self._unlink(evicted)
+
+    def _link(self, path: str) -> None:
+        """Add path to the children of its parent, and so on up to the first
+        ancestor already there."""
+        while path != "/":
+            parent = os.path.dirname(path)
+            siblings = self.children.setdefault(parent, set())
+            if path in siblings:
+                return
+            siblings.add(path)
+            path = parent
+
+    def _unlink(self, path: str) -> None:
+        """Take path out of the children of its parent, if nothing is cached at
+        or beneath it any more, and so on up."""
+        while path != "/" and path not in self.entries and path not in self.children:
+            parent = os.path.dirname(path)
+            siblings = self.children.get(parent)
+            if siblings is None:
+                return
+            siblings.discard(path)
+            if siblings:
+                return
+            del self.children[parent]
+            path = parent
+
+    def _forget(self, path: str, recursive: bool) -> None:
+        self.entries.pop(path, None)
+        if recursive:
+            beneath = list(self.children.pop(path, ()))
+            while beneath:
+                cached = beneath.pop()
+                self.entries.pop(cached, None)
+                beneath.extend(self.children.pop(cached, ()))
+        self._unlink(path)
+
+    def forget(self, path: str, recursive: bool = True) -> None:
+        """Drop a path, and unless told otherwise, everything beneath it."""
+        with self.lock:
+            self._forget(path, recursive)
+
+    def remove(self, path: str, recursive: bool = True) -> None:
+        """Record that a path (and so everything beneath it) no longer exists."""
+        with self.lock:
+            self._forget(path, recursive)
+            self._insert(path, -1)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
+
+
+_mounted = PerDevice(DentryCache)
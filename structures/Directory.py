@@ -11,28 +11,38 @@
 # obtained from the author.
 # ************************************************************************
 
-from errno import EINVAL, ENOENT
-from typing import List, Optional, Tuple
+from errno import EINVAL, ENAMETOOLONG, ENOENT
+from typing import List, Optional, Tuple, Union
 
-from constants import END_OF_METADATA, START_OF_CONTENT, START_OF_METADATA
-from disktools import int_to_bytes
+from disktools import get_superblock
 from fuse import FuseOSError
 from util.FMLog import FMLog
 
 import structures.Filesystem
 from structures.AbstractItem import AbstractItem
+from structures.AttrCache import AttrCache
+from structures.DirectoryTable import (
+    MAX_NAME_LENGTH,
+    TABLE_HEADER,
+    DirectoryTable,
+    table_entry,
+)
 from structures.File import File
 from structures.Filetable import FileTable
+from structures.HandleTable import HandleTable
+from structures.ItemCount import ItemCount
 from structures.Metadata import Metadata
 
 
 class Directory(AbstractItem):
     """A directory class. Directories are stored as blocks in the filesystem,
-    like normal files. A directory is a list of metadata, followed by several
-    bytes, which point to the block locations of all files within."""
+    like normal files. A directory is a list of metadata, followed by a hash
+    table of its entries (see DirectoryTable), each holding the name, type and
+    block location of a file within. Directories from before the hash table
+    are a list of single byte block locations, and are migrated on mount."""
 
-    def __init__(self, block: int = 1) -> None:
-        super().__init__(block=block)
+    def __init__(self, block: Optional[int] = None) -> None:
+        super().__init__(block=get_superblock().root_block if block is None else block)
 
     def fetch_directory_blocks(self) -> bytearray:
         return FileTable().read_full_file(self.block)
@@ -41,33 +51,116 @@ class Directory(AbstractItem):
         """Fetch the directory data, returns a tuple containing the metadata of
         the directory, and then the actual directory data"""
         directory = FileTable().read_full_file(self.block)
+        header_size = get_superblock().header_size
 
         return (
-            directory[START_OF_METADATA:END_OF_METADATA],
-            directory[START_OF_CONTENT:],
+            directory[:header_size],
+            directory[header_size:],
         )
 
+    def get_table(self) -> DirectoryTable:
+        """Fetch the entries of this directory. An unmigrated directory is
+        converted in memory, which means reading every child."""
+        (_, content) = self.get_dir_data()
+        if DirectoryTable.is_hashed(content):
+            return DirectoryTable.from_bytes(content)
+
+        table = DirectoryTable()
+        fs = structures.Filesystem.Filesystem()
+        for block_index in self.clear_nulls_from_bytes(content, 1):
+            metadata = fs.get_block_metadata(block_index)
+            name = (metadata.NAME or "").rstrip("\x00")
+            table.insert(name, block_index, metadata.TYPE or 0)
+        return table
+
+    def save_table(self, table: DirectoryTable) -> None:
+        """Write the table back. Only the slots that changed are written, unless
+        it is new or has grown, when the whole directory is rewritten."""
+        changed = table.changed_slots()
+        if changed is None:
+            self.save(self.get_metadata().form_bytes() + table.to_bytes())
+            table.saved()
+            return
+        filetable = FileTable()
+        extents = filetable.get_extents(self.block)
+        table_start = get_superblock().header_size + TABLE_HEADER.size
+        block_size = filetable.block_size
+        for (index, data) in changed.items():
+            position = table_start + index * len(data)
+            written = 0
+            # a slot may cross into the next block
+            while written < len(data):
+                (block_index, in_block) = divmod(position + written, block_size)
+                piece = data[written : written + block_size - in_block]
+                filetable.write_block(extents.locate(block_index), piece, in_block)
+                written += len(piece)
+        table.saved()
+
+    def migrate(self) -> bool:
+        """Rewrite this directory as a hash table, if it is not one already.
+        Returns whether anything changed."""
+        (_, content) = self.get_dir_data()
+        if DirectoryTable.is_hashed(content):
+            return False
+        self.save_table(self.get_table())
+        return True
+
+    def lookup(self, name: str) -> Optional[Tuple[int, int]]:
+        """Get the (block location, type) of the named file, or None. Only the
+        blocks holding the slots probed for name are read, so a lookup costs
+        the same however big the directory is."""
+        filetable = FileTable()
+        extents = filetable.get_extents(self.block)
+        table_start = get_superblock().header_size + TABLE_HEADER.size
+        content = filetable.read_file_range(
+            self.block, table_start - TABLE_HEADER.size, table_start, extents
+        )
+        if not DirectoryTable.is_hashed(content):
+            return self.get_table().lookup(name)
+        (_, num_slots) = TABLE_HEADER.unpack_from(content, 0)
+        if num_slots == 0:
+            return None
+        slot_size = table_entry().size
+        block_size = filetable.block_size
+
+        def read_slots(index: int) -> bytes:
+            # the slots from index to the end of its block, or the one slot
+            # crossing into the next
+            start = table_start + index * slot_size
+            in_block = (start // block_size + 1) * block_size - start
+            count = min(num_slots - index, max(1, in_block // slot_size))
+            return bytes(
+                filetable.read_file_range(
+                    self.block, start, start + count * slot_size, extents
+                )
+            )
+
+        return DirectoryTable.probe(name, num_slots, read_slots)
+
     def block_index_from_name(self, name: str) -> int:
-        files = self.get_files()
-        for file in files:
-            (filename, location, _) = file
-            if filename == name:
-                return location
-        raise FuseOSError(ENOENT)
+        entry = self.lookup(name)
+        if entry is None:
+            raise FuseOSError(ENOENT)
+        return entry[0]
 
     def smart_resolve(self, name: Optional[str], block: Optional[int]):
+        item_type: Optional[int] = None
         if name is not None:
-            block = self.block_index_from_name(name)
+            entry = self.lookup(name)
+            if entry is None:
+                raise FuseOSError(ENOENT)
+            (block, item_type) = entry
 
         if block is None:
             raise FuseOSError(EINVAL)
 
-        fs = structures.Filesystem.Filesystem()
-        metadata = fs.get_block_metadata(block)
+        if item_type is None:
+            fs = structures.Filesystem.Filesystem()
+            item_type = fs.get_block_metadata(block).TYPE
 
-        if metadata.TYPE == 1:
+        if item_type == 1:
             return File(block)
-        elif metadata.TYPE == 0:
+        elif item_type == 0:
             return Directory(block)
         else:
             raise FuseOSError(EINVAL)
@@ -75,105 +168,118 @@ class Directory(AbstractItem):
     def get_files(self, strip_null: bool = False) -> List[Tuple[str, int, int]]:
         """Retusn a list of files (name, block location) in the directory.
         Files includes files and directories. If strip_null is set to true, then
-        file names are stripped of all trailing null values."""
-        (_, files) = self.get_dir_data()
+        file names are stripped of all trailing null values. None of the files
+        are read to do this."""
         file_tuples: List[Tuple[str, int, int]] = []
-        fs = structures.Filesystem.Filesystem()
-
-        def fetch_name(block_index: int) -> str:
-            metadata = fs.get_block_metadata(block_index)
-            return metadata.NAME or ""
-
-        def fetch_type(block_index: int) -> int:
-            metadata = fs.get_block_metadata(block_index)
-            file_type = metadata.TYPE
-            if file_type == None:
-                raise FuseOSError(EINVAL)
-            return file_type
-
-        for block_index in files:
-            if block_index == 0:
-                break
-            filename = fetch_name(block_index)
-            filetype = fetch_type(block_index)
-            file_tuples.append((filename, block_index, filetype))
-        if strip_null:
-            return list(map(lambda x: (x[0].rstrip("\x00"), x[1], x[2]), file_tuples))
-
+        for (_, location, filetype, name) in self.get_table().entries():
+            if not strip_null:
+                name = name.ljust(MAX_NAME_LENGTH, "\x00")
+            file_tuples.append((name, location, filetype))
         return file_tuples
 
-    def add_file(self, file_name: str, data: str, metadata: Metadata) -> AbstractItem:
+    @staticmethod
+    def check_name(file_name: str) -> None:
+        if len(file_name.encode("ascii")) > MAX_NAME_LENGTH:
+            raise FuseOSError(ENAMETOOLONG)
+
+    def add_file(
+        self, file_name: str, data: Union[str, bytes], metadata: Metadata
+    ) -> AbstractItem:
         """Add a file to the filesystem, in this directory. This will write the
         file to the disk, add it to this directory entry, and add it to the
         filetable."""
+        self.check_name(file_name)
         filetable = FileTable()
+        table = self.get_table()
 
-        # get a new block to place the file at
-        first_loc = filetable.find_free_block()
-
-        existing = self.ensure_uniqueness(file_name)
-        if existing != -1:
+        existing = table.lookup(file_name)
+        if existing is None:
+            # before anything is written, so a full directory changes nothing
+            table.make_room()
+        else:
             # file with this name exists, so destroy existing data
-            filetable.purge_full_file(existing)
-
-        # set the LOCATION metadata field to this location
-        metadata.LOCATION = first_loc
+            filetable.purge_full_file(existing[0])
+            HandleTable.mounted().removed(existing[0])
+
+        # claim the blocks first, so no other thread can take the first one
+        # before it is recorded as the LOCATION metadata field
+        if isinstance(data, str):
+            data = data.encode(encoding="ascii")
+        blocks_to_write = filetable.allocate_blocks(
+            filetable.blocks_for_bytes(len(metadata.form_bytes()) + len(data))
+        )
+        metadata.LOCATION = blocks_to_write[0]
 
         # Write the data to the blocks, then add these blocks to the filetable
-        blocks_to_write = filetable.write_to_block(data, metadata.form_bytes())
+        filetable.write_in_runs(blocks_to_write, metadata.form_bytes() + data)
         filetable.write_to_table(blocks_to_write)
 
-        location_as_bytes = int_to_bytes(blocks_to_write[0], 1)
-        [dir_metadata, dir_refs] = self.get_dir_data()
-        dir_data = (
-            dir_metadata + self.clear_nulls_from_bytes(dir_refs, 1) + location_as_bytes
-        )
-
-        self.save(dir_data)
+        table.insert(file_name, blocks_to_write[0], metadata.TYPE or 0)
+        self.save_table(table)
+        links = (metadata.TYPE == 0) - (existing is not None and existing[1] == 0)
+        if links:
+            self.add_links(links)
+        # the blocks may have held an item that was removed, or the one replaced
+        attrs = AttrCache.mounted()
+        attrs.invalidate(blocks_to_write[0])
+        if existing is None:
+            ItemCount.mounted().add(1)
+        else:
+            attrs.invalidate(existing[0])
         return self.smart_resolve(block=blocks_to_write[0], name=None)
 
-    # TODO remove NLINKS by one if dir
+    def add_links(self, count: int) -> None:
+        """Change this directory's link count, which has one link for each
+        subdirectory's "..", by count."""
+        metadata = self.get_metadata()
+        metadata.NLINKS = (metadata.NLINKS or 2) + count
+        metadata.save_to_block(self.block)
+
     def remove_file(self, file_location: int) -> None:
         ft = FileTable()
-        (metadata, new_data) = self.get_dir_data()
+        table = self.get_table()
 
-        # get the last item, replace the to-be-deleted with it
-        new_data.remove(file_location)
+        removed = table.remove(file_location)
         ft.purge_full_file(file_location)
-        self.save(metadata + new_data)
+        HandleTable.mounted().removed(file_location)
+        self.save_table(table)
+        AttrCache.mounted().invalidate(file_location)
+        if removed:
+            ItemCount.mounted().add(-1)
+            if removed[2] == 0:
+                self.add_links(-1)
 
     def unlink_file(self, file_location: int) -> None:
         """ Removes the file from this directory, without actually removing any of its data """
-        (metadata, new_data) = self.get_dir_data()
-        new_data.remove(file_location)
-        self.save(metadata + new_data)
+        table = self.get_table()
+        removed = table.remove(file_location)
+        self.save_table(table)
+        if removed and removed[2] == 0:
+            self.add_links(-1)
 
     def link_file(self, file_location: int, with_name: str) -> None:
         """ Links an existing file to this directory """
-        (metadata, dir_data) = self.get_dir_data()
-        new_dir_data = (
-            metadata
-            + self.clear_nulls_from_bytes(dir_data, 1)
-            + int_to_bytes(file_location, 1)
-        )
-        self.save(new_dir_data)
-        FMLog.success(
-            f"Linked file to dirblock {self.block}, with data meta {metadata} and data {self.clear_nulls_from_bytes(dir_data,1)+bytearray(file_location)}"
-        )
-
+        self.check_name(with_name)
         file_meta = structures.Filesystem.Filesystem().get_block_metadata(file_location)
+
+        table = self.get_table()
+        table.insert(with_name, file_location, file_meta.TYPE or 0)
+        self.save_table(table)
+        if file_meta.TYPE == 0:
+            self.add_links(1)
+        FMLog.debug("Linked block %d to dirblock %d", file_location, self.block)
+
         file_meta.NAME = with_name
         file_meta.save_to_block(file_location)
 
     def ensure_uniqueness(self, filename: str) -> int:
-        files = self.get_files(strip_null=True)
-        for name, loc, _ in files:
-            if name == filename:
-                return loc
-        return -1
+        entry = self.lookup(filename)
+        if entry is None:
+            return -1
+        return entry[0]
 
     def deleteable(self) -> bool:
-        return len(self.get_files()) == 0
+        return self.get_table().count == 0
 
     @staticmethod
     def slice_per(
@@ -0,0 +1,262 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+import struct
+import zlib
+from errno import ENOSPC
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from disktools import Block, get_superblock
+
+# First byte of a hashed directory's content. Old directories start with a
+# block pointer or a null, and pointers are always below END_OF_FILE. Version
+# 2 volumes only ever have hashed directories.
+DIRECTORY_MAGIC = 0xFD
+
+MAX_NAME_LENGTH = 16
+
+# magic, number of slots
+TABLE_HEADER = struct.Struct(">BH")
+# The most slots the header can count. Tables double as they grow, so this is
+# the largest power of two that fits.
+MAX_SLOTS = 1 << 15
+# A table grows before an insert would leave it fuller than this, so probe
+# sequences stay short
+MAX_LOAD = 0.75
+# name hash, location (0 for an empty slot), type, name, by format version
+TABLE_ENTRIES: Dict[int, struct.Struct] = {
+    1: struct.Struct(">HBB16s"),
+    2: struct.Struct(">HIB16s"),
+}
+
+Entry = Tuple[int, int, int, str]
+
+
+def table_entry(version: Optional[int] = None) -> struct.Struct:
+    """The slot layout of a format version, by default the mounted one."""
+    return TABLE_ENTRIES[get_superblock().version if version is None else version]
+
+
+def name_hash(name: str) -> int:
+    return zlib.crc32(name.encode("ascii")) & 0xFFFF
+
+
+class DirectoryTable(object):
+    """The entries of a directory, as an open addressed hash table keyed by
+    name. Each slot holds the name hash, location, type and name of a child,
+    so a lookup goes straight to its slot and a listing never has to read the
+    children. Slots are linearly probed, and removal shifts later entries back
+    so that no tombstones are needed. The table doubles once it is MAX_LOAD
+    full, up to MAX_SLOTS slots."""
+
+    def __init__(
+        self,
+        slots: Optional[List[Optional[Entry]]] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        self.slots: List[Optional[Entry]] = slots or [None]
+        self.count = len([slot for slot in self.slots if slot is not None])
+        self.entry = table_entry(version)
+        # the number of slots the table had when read, and which have changed
+        # since, so that only those need writing back
+        self.read_size: Optional[int] = None
+        self.changed: Set[int] = set()
+
+    @staticmethod
+    def is_hashed(content: Block) -> bool:
+        return len(content) > 0 and content[0] == DIRECTORY_MAGIC
+
+    @staticmethod
+    def from_bytes(content: Block, version: Optional[int] = None) -> "DirectoryTable":
+        entry = table_entry(version)
+        (_, num_slots) = TABLE_HEADER.unpack_from(content, 0)
+        slots: List[Optional[Entry]] = []
+        for (hashed, location, item_type, name) in entry.iter_unpack(
+            bytes(
+                content[
+                    TABLE_HEADER.size : TABLE_HEADER.size + num_slots * entry.size
+                ]
+            )
+        ):
+            if location == 0:
+                slots.append(None)
+            else:
+                slots.append(
+                    (hashed, location, item_type, name.rstrip(b"\0").decode("ascii"))
+                )
+        table = DirectoryTable(slots, version)
+        table.read_size = num_slots
+        return table
+
+    @staticmethod
+    def probe(
+        name: str,
+        num_slots: int,
+        read_slots: Callable[[int], bytes],
+        version: Optional[int] = None,
+    ) -> Optional[Tuple[int, int]]:
+        """Get the (location, type) of the named child, or None, without
+        decoding the whole table. read_slots(index) gives the bytes of one or
+        more whole slots from index on, and is called for the slots name is
+        probed through, from its home slot to the first empty one."""
+        entry = table_entry(version)
+        hashed = name_hash(name)
+        index = hashed % num_slots
+        probed = 0
+        while probed < num_slots:
+            for (slot_hash, location, item_type, slot_name) in entry.iter_unpack(
+                read_slots(index)
+            ):
+                if location == 0:
+                    return None
+                if (
+                    slot_hash == hashed
+                    and slot_name.rstrip(b"\0").decode("ascii") == name
+                ):
+                    return (location, item_type)
+                probed += 1
+                index = (index + 1) % num_slots
+                if index == 0 or probed == num_slots:
+                    break
+        return None
+
+    def to_bytes(self) -> bytearray:
+        content = bytearray(TABLE_HEADER.size + len(self.slots) * self.entry.size)
+        TABLE_HEADER.pack_into(content, 0, DIRECTORY_MAGIC, len(self.slots))
+        offset = TABLE_HEADER.size
+        for index in range(len(self.slots)):
+            self.pack_slot(content, offset, index)
+            offset += self.entry.size
+        return content
+
+    def pack_slot(self, content: bytearray, offset: int, index: int) -> None:
+        slot = self.slots[index]
+        if slot is not None:
+            (hashed, location, item_type, name) = slot
+            self.entry.pack_into(
+                content, offset, hashed, location, item_type, name.encode("ascii")
+            )
+
+    def changed_slots(self) -> Optional[Dict[int, bytearray]]:
+        """The bytes of each slot changed since the table was read, by index,
+        or None if the table is new or has been resized, and has to be written
+        whole."""
+        if self.read_size != len(self.slots):
+            return None
+        changed: Dict[int, bytearray] = {}
+        for index in sorted(self.changed):
+            changed[index] = bytearray(self.entry.size)
+            self.pack_slot(changed[index], 0, index)
+        return changed
+
+    def saved(self) -> None:
+        """Note that the table has been written back as it is now."""
+        self.read_size = len(self.slots)
+        self.changed.clear()
+
+    def _set(self, index: int, slot: Optional[Entry]) -> None:
+        self.slots[index] = slot
+        self.changed.add(index)
+
+    def _find(self, name: str) -> int:
+        """Get the slot holding name, or -1."""
+        hashed = name_hash(name)
+        num_slots = len(self.slots)
+        for probe in range(num_slots):
+            index = (hashed + probe) % num_slots
+            slot = self.slots[index]
+            if slot is None:
+                return -1
+            if slot[0] == hashed and slot[3] == name:
+                return index
+        return -1
+
+    def lookup(self, name: str) -> Optional[Tuple[int, int]]:
+        """Get the (location, type) of the named child, or None."""
+        index = self._find(name)
+        if index == -1:
+            return None
+        entry = self.slots[index]
+        assert entry is not None
+        return (entry[1], entry[2])
+
+    def insert(self, name: str, location: int, item_type: int) -> None:
+        """Add a child, replacing any existing child with the same name."""
+        existing = self._find(name)
+        if existing != -1:
+            self._set(existing, None)
+            self.count -= 1
+            self._close_gap(existing)
+        self.make_room()
+        hashed = name_hash(name)
+        index = hashed % len(self.slots)
+        while self.slots[index] is not None:
+            index = (index + 1) % len(self.slots)
+        self._set(index, (hashed, location, item_type, name))
+        self.count += 1
+
+    def remove(self, location: int) -> Optional[Entry]:
+        """Remove the child at a location. Returns its entry, or None if there
+        was none."""
+        for (index, slot) in enumerate(self.slots):
+            if slot is not None and slot[1] == location:
+                self._set(index, None)
+                self.count -= 1
+                self._close_gap(index)
+                return slot
+        return None
+
+    def entries(self) -> Iterator[Entry]:
+        """Iterate over (hash, location, type, name) of every child."""
+        for slot in self.slots:
+            if slot is not None:
+                yield slot
+
+    def make_room(self) -> None:
+        """Grow the table if another entry would make it too full. Raises
+        ENOSPC if it is as big as it can get."""
+        if self.count + 1 <= MAX_LOAD * len(self.slots):
+            return
+        if 2 * len(self.slots) > MAX_SLOTS:
+            raise IOError(ENOSPC, "ENOSPC: Directory is full")
+        self._grow()
+
+    def _grow(self) -> None:
+        old_slots = self.slots
+        self.slots = [None] * (2 * len(old_slots))
+        self.count = 0
+        for slot in old_slots:
+            if slot is not None:
+                (_, location, item_type, name) = slot
+                self.insert(name, location, item_type)
+
+    def _close_gap(self, gap: int) -> None:
+        """Shift entries that probed past an emptied slot back into it."""
+        num_slots = len(self.slots)
+        index = gap
+        for _ in range(num_slots - 1):
+            index = (index + 1) % num_slots
+            slot = self.slots[index]
+            if slot is None:
+                return
+            home = slot[0] % num_slots
+            # leave the entry if its home lies cyclically in (gap, index]
+            if gap < index:
+                stays = gap < home <= index
+            else:
+                stays = gap < home or home <= index
+            if stays:
+                continue
+            self._set(gap, slot)
+            self._set(index, None)
+            gap = index
@@ -0,0 +1,127 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from __future__ import annotations
+
+import struct
+from bisect import bisect_right
+from typing import Iterable, Iterator, List, Tuple
+
+from constants import WIDE_HEADER_SIZE
+
+# length of the first run, overflow block holding the other runs (0 for none).
+# These sit in the spare bytes at the end of a version 2 header; a first run
+# of 0 means no map was recorded, and the chain has to be followed instead.
+EXTENT_FIELDS = struct.Struct(">II")
+EXTENT_FIELDS_OFFSET = WIDE_HEADER_SIZE - EXTENT_FIELDS.size
+
+# number of runs, then (start, length) of each
+OVERFLOW_HEADER = struct.Struct(">I")
+OVERFLOW_RUN = struct.Struct(">II")
+
+Run = Tuple[int, int]
+
+
+class ExtentMap(object):
+    """Where the blocks of a file are, as runs of contiguous blocks. The first
+    run always starts at the file's first block. Finding the block at some
+    position in the file is a binary search over the runs, and a run can be
+    moved in a single transfer."""
+
+    def __init__(self, runs: List[Run], overflow: int = 0) -> None:
+        self.runs = runs
+        self.overflow = overflow
+        # index within the file of the first block of each run
+        self.starts: List[int] = []
+        count = 0
+        for (_, length) in runs:
+            self.starts.append(count)
+            count += length
+        self.block_count = count
+
+    @staticmethod
+    def from_blocks(blocks: Iterable[int]) -> ExtentMap:
+        return ExtentMap(ExtentMap.append_runs([], blocks))
+
+    @staticmethod
+    def append_runs(runs: List[Run], blocks: Iterable[int]) -> List[Run]:
+        """Add blocks to the end of runs, growing the last run where they
+        follow on from it. Returns runs."""
+        for block in blocks:
+            if runs and runs[-1][0] + runs[-1][1] == block:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((block, 1))
+        return runs
+
+    def extended(self, blocks: Iterable[int]) -> ExtentMap:
+        """This map with blocks added to the end of the file. Only the runs
+        are copied, and maps are never changed once made, as they are read
+        without a lock."""
+        return ExtentMap(self.append_runs(list(self.runs), blocks), self.overflow)
+
+    def truncated(self, keep: int) -> ExtentMap:
+        """This map cut down to the first keep blocks of the file."""
+        run = bisect_right(self.starts, keep - 1) - 1
+        (start, _) = self.runs[run]
+        runs = self.runs[:run] + [(start, keep - self.starts[run])]
+        return ExtentMap(runs, self.overflow)
+
+    def last_block(self) -> int:
+        (start, length) = self.runs[-1]
+        return start + length - 1
+
+    @staticmethod
+    def overflow_capacity(block_size: int) -> int:
+        """How many runs fit in an overflow block."""
+        return (block_size - OVERFLOW_HEADER.size) // OVERFLOW_RUN.size
+
+    @staticmethod
+    def decode_runs(overflow: bytes) -> List[Run]:
+        (count,) = OVERFLOW_HEADER.unpack_from(overflow, 0)
+        end = OVERFLOW_HEADER.size + count * OVERFLOW_RUN.size
+        runs = bytes(overflow[OVERFLOW_HEADER.size : end])
+        return list(OVERFLOW_RUN.iter_unpack(runs))
+
+    @staticmethod
+    def encode_runs(runs: List[Run]) -> bytearray:
+        overflow = bytearray(OVERFLOW_HEADER.pack(len(runs)))
+        for run in runs:
+            overflow += OVERFLOW_RUN.pack(*run)
+        return overflow
+
+    def blocks(self) -> Iterator[int]:
+        for (start, length) in self.runs:
+            yield from range(start, start + length)
+
+    def locate(self, index: int) -> int:
+        """The block holding the index-th block of the file."""
+        if not 0 <= index < self.block_count:
+            raise IndexError("Block index past the end of the file")
+        run = bisect_right(self.starts, index) - 1
+        return self.runs[run][0] + index - self.starts[run]
+
+    def runs_between(self, first: int, last: int) -> Iterator[Run]:
+        """The (start, length) runs holding blocks first to last (exclusive)
+        of the file, cut down to just those blocks."""
+        last = min(last, self.block_count)
+        if first >= last:
+            return
+        run = bisect_right(self.starts, first) - 1
+        while first < last:
+            (start, length) = self.runs[run]
+            skip = first - self.starts[run]
+            count = min(length - skip, last - first)
+            yield (start + skip, count)
+            first += count
+            run += 1
@@ -12,29 +12,41 @@
 # ************************************************************************
 
 import os
+from contextlib import contextmanager
 from errno import EINVAL, ENOENT
 from os.path import basename
 from stat import S_IFDIR, S_IFREG
 from structures.factories.DirFactory import DirFactory
 from time import time
-from typing import Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from constants import END_OF_METADATA
-from disktools import read_block
+from disktools import get_device, get_superblock
 from fuse import FuseOSError
 from util.FMLog import FMLog
 
 from structures.AbstractItem import AbstractItem
-from structures.factories.ItemFactory import ItemFactory
+from structures.AttrCache import Attributes, AttrCache
+from structures.DentryCache import DentryCache
+from structures.DirectoryTable import DirectoryTable
 from structures.factories.MetadataFactory import MetadataFactory
 from structures.File import File
 from structures.Filetable import FileTable
+from structures.HandleTable import Handle, HandleTable
+from structures.InodeLocks import InodeLocks
+from structures.ItemCount import ItemCount
 from structures.Metadata import Metadata
+from structures.ReadAhead import ReadAhead
+from structures.StatsFile import XATTR_PREFIX, StatsFile
 
 
 class Filesystem(object):
     def __init__(self) -> None:
         super().__init__()
+        self.dentries = DentryCache.mounted()
+        self.locks = InodeLocks.mounted()
+        self.readahead = ReadAhead.mounted()
+        self.attrs = AttrCache.mounted()
+        self.handles = HandleTable.mounted()
 
     def get_root(self):
         return DirFactory().root()
@@ -46,6 +58,9 @@ class Filesystem(object):
         block = self.path_resolver(path)
         if block == -1:
             raise FuseOSError(ENOENT)
+        return self.item_from_block(block)
+
+    def item_from_block(self, block: int) -> AbstractItem:
         item = AbstractItem(block)
         item_type = item.type_from_metadata()
         if item_type == 0:
@@ -57,23 +72,40 @@ class Filesystem(object):
     def path_resolver(self, path: str) -> int:
         """ Given a path, get the block index of the basename of the path. """
         if path == "/":
-            return 1
+            return get_superblock().root_block
+        if StatsFile.is_virtual(path):
+            # served by StatsFile, and never looked for on disk
+            return -1
 
-        chunks = path.split(os.path.sep)[1:]
+        cached = self.dentries.lookup(path)
+        if cached is not None:
+            return cached
 
-        last_chunk = chunks[-1]
+        chunks = path.split(os.path.sep)[1:]
 
+        # start from the deepest directory on the path that is already known
+        start = 0
         current_dir = self.get_root()
-        found = False
-        final_location = None
-        is_at_end = False
-
-        for chunk in chunks:
-            possible_file = last_chunk == chunk
-            found = False
-            directory_files = current_dir.get_files(strip_null=True)
-            for filename, file_location, filetype in directory_files:
-                if filename == chunk:
+        for depth in range(len(chunks) - 1, 0, -1):
+            ancestor = self.dentries.lookup(os.path.sep.join([""] + chunks[:depth]))
+            if ancestor == -1:
+                return -1
+            if ancestor is not None:
+                start = depth
+                current_dir = self.dir_from_block(ancestor)
+                break
+
+        final_location = -1
+        for depth in range(start, len(chunks)):
+            chunk = chunks[depth]
+            possible_file = depth == len(chunks) - 1
+            final_location = -1
+            # the entry is cached under the directory's lock, so a concurrent
+            # change to the directory cannot be overwritten by a stale entry
+            with self.locks.reading(current_dir.block):
+                entry = current_dir.lookup(chunk)
+                if entry is not None:
+                    (file_location, filetype) = entry
                     # found a valid name
                     if filetype == 1 and not possible_file:
                         # impossible
@@ -82,27 +114,129 @@ class Filesystem(object):
                         )
                         raise FuseOSError(EINVAL)
                     final_location = file_location
-                    found = True
-                    if possible_file:
-                        is_at_end = True
-                    else:
-                        current_dir = self.dir_from_block(file_location)
-                    break
-
-            if not found:
-                return -1
-
-        if not is_at_end:
-            raise FuseOSError(ENOENT)
 
-        if not final_location:
-            return -1
+                self.dentries.insert(
+                    os.path.sep.join([""] + chunks[: depth + 1]), final_location
+                )
+            if final_location == -1:
+                return -1
+            if not possible_file:
+                current_dir = DirFactory(final_location).construct()
 
         return final_location
 
+    @contextmanager
+    def locked(self, *paths: str, write: bool = False) -> Iterator[List[int]]:
+        """Resolve paths and hold the locks of what they name, for reading (one
+        path only) or for writing. Gives the blocks of the paths. If a path is
+        changed while waiting for its lock, everything is resolved again."""
+        while True:
+            blocks = [self.path_resolver(path) for path in paths]
+            if -1 in blocks:
+                raise FuseOSError(ENOENT)
+            if write:
+                held = self.locks.writing(*blocks)
+            else:
+                (block,) = blocks
+                held = self.locks.reading(block)
+            with held:
+                if all(
+                    path == "/" or self.dentries.lookup(path) == block
+                    for (path, block) in zip(paths, blocks)
+                ):
+                    yield blocks
+                    return
+
+    @contextmanager
+    def locked_file(
+        self, path: str, fh: Optional[int], write: bool = False
+    ) -> Iterator[Tuple[int, Optional[Handle]]]:
+        """Hold the lock of the file open as fh, as locked does, without
+        resolving path. If fh is not open, or its file has been removed, path
+        is resolved instead. Gives the file's block, and its handle if used."""
+        handle = self.handles.get(fh)
+        if handle is not None and handle.block != -1:
+            block = handle.block
+            held = self.locks.writing(block) if write else self.locks.reading(block)
+            with held:
+                # a file is only removed with its lock held for writing
+                if handle.block == block:
+                    yield (block, handle)
+                    return
+        with self.locked(path, write=write) as (block,):
+            yield (block, None)
+
+    @contextmanager
+    def locked_for_replace(
+        self, *paths: str, target: str
+    ) -> Iterator[Tuple[List[int], int]]:
+        """Hold for writing the parent of target, then paths, and whatever
+        target names if it exists. Gives the blocks of the parent and paths, in
+        that order, and the block target names, or -1."""
+        (parent_path, name) = self.get_path_and_base(target)
+        while True:
+            existing = self.path_resolver(target)
+            replaced = (target,) if existing != -1 else ()
+            with self.locked(parent_path, *paths, *replaced, write=True) as blocks:
+                entry = self.dir_from_block(blocks[0]).lookup(name)
+                # the parent is held, so this is what target names for good
+                if (entry[0] if entry is not None else -1) == existing:
+                    yield (blocks[: 1 + len(paths)], existing)
+                    return
+
+    def layout_attributes(self, block: int) -> Dict[str, str]:
+        """The user.fmfs.* extended attributes of the file or directory at
+        block, describing how it lies on disk. Fragmentation runs from 0 for a
+        single run of blocks to 1 for no two blocks together."""
+        extents = FileTable().get_extents(block)
+        runs = len(extents.runs)
+        blocks = extents.block_count
+        fragmentation = (runs - 1) / (blocks - 1) if blocks > 1 else 0.0
+        return {
+            XATTR_PREFIX + "inode": str(block),
+            XATTR_PREFIX + "blocks": str(blocks),
+            XATTR_PREFIX + "extents": str(runs),
+            XATTR_PREFIX + "fragmentation": f"{fragmentation:.4f}",
+        }
+
+    def get_attributes(self, block: int) -> Attributes:
+        """The stat attributes of the item at block, from the cache if they
+        were read recently."""
+        attributes = self.attrs.lookup(block)
+        if attributes is None:
+            token = self.attrs.token()
+            attributes = self.get_block_metadata(block).to_st_form()
+            self.attrs.insert([(block, attributes)], token)
+        return attributes
+
+    def list_attributes(self, blocks: List[int]) -> List[Attributes]:
+        """The stat attributes of the items at blocks, as get_attributes gives
+        them. The headers not cached are read together, with one vectored
+        read per run of adjacent blocks, and cached."""
+        found: Dict[int, Attributes] = {}
+        missing: List[int] = []
+        for block in blocks:
+            attributes = self.attrs.lookup(block)
+            if attributes is None:
+                missing.append(block)
+            else:
+                found[block] = attributes
+        if missing:
+            token = self.attrs.token()
+            header_size = get_superblock().header_size
+            headers = [(block, bytearray(header_size)) for block in missing]
+            get_device().read_blocks(headers)
+            read = {
+                block: Metadata.build_metadata(header).to_st_form()
+                for (block, header) in headers
+            }
+            self.attrs.insert(read.items(), token)
+            found.update(read)
+        return [found[block] for block in blocks]
+
     def get_block_metadata(self, block_index: int) -> Metadata:
-        file = read_block(block_index)
-        return Metadata.build_metadata(file[0:END_OF_METADATA])
+        file = FileTable().read_block(block_index)
+        return Metadata.build_metadata(file)
 
     def dir_from_block(self, block_index: int):
         data = self.get_block_metadata(block_index)
@@ -119,21 +253,29 @@ class Filesystem(object):
         return File(block_index)
 
     def internal_item_maker(self, path: str, mode: int, f_type: int) -> AbstractItem:
-        [dirname, filename] = self.get_path_and_base(path)
-        block = self.path_resolver(dirname)
+        [_, filename] = self.get_path_and_base(path)
+        with self.locked_for_replace(target=path) as ((block,), _):
+            item = self.add_item(block, filename, mode, f_type)
+            self.dentries.insert(path, item.block)
+            return item
+
+    def add_item(
+        self, block: int, filename: str, mode: int, f_type: int
+    ) -> AbstractItem:
+        """Make a file or directory in the directory at block, whose lock the
+        caller holds."""
         dirent = self.dir_from_block(block_index=block)
         child_links = 1
         base_mode = S_IFREG
 
         if f_type == 0:
-            current_links = dirent.get_metadata().NLINKS or 0
-            dirent.update_metadata(Metadata(NLINKS=current_links + 1))
+            # the parent's link from the child's ".." is added with its entry
             child_links = 2
             base_mode = S_IFDIR
 
         return dirent.add_file(
             file_name=filename,
-            data="",
+            data="" if f_type == 1 else bytes(DirectoryTable().to_bytes()),
             metadata=MetadataFactory(
                 MODE=(base_mode | mode),
                 ATIME=int(time()),
@@ -154,34 +296,145 @@ class Filesystem(object):
     def create_dir(self, path: str, mode: int):
         return self.internal_item_maker(path, mode, 0)
 
-    def edit_file(self, first_block: int, data: bytes, offset: int) -> int:
+    def read_file(
+        self, block: int, offset: int, size: int, handle: Optional[Handle] = None
+    ) -> bytearray:
+        """Read up to size bytes from offset of the file at block, whose lock
+        the caller holds. Through handle, the item is known to be a file, and
+        the handle's extent map is used."""
+        if handle is None:
+            return self.item_from_block(block).read_contents(offset, size)
+        return File(block).read_contents(offset, size, self.handles.extents(handle))
+
+    def edit_file(
+        self,
+        first_block: int,
+        data: bytes,
+        offset: int,
+        handle: Optional[Handle] = None,
+    ) -> int:
         """
+        Write data at offset into the file, touching only the blocks the write
+        covers, a run of contiguous blocks at a time. Blocks are added to the
+        end of the chain when the write runs past it, and whatever the write
+        leaves of them is zeroed, as they may hold anything; the rest of the
+        file is left as it was. The extent map of handle is used if given.
         Returns the number of bytes written
         """
         filetable = FileTable()
 
-        (metadata, old_data) = ItemFactory(first_block).create().get_data()
-
-        data_to_keep = old_data[0:offset]
-        file_size = len(data + data_to_keep)
-
-        metadata.update_all_times()
-        metadata.SIZE = file_size
+        metadata = self.get_block_metadata(first_block)
 
         if not metadata.LOCATION:
             FMLog.error("Cannot edit file that does not have location in metadata")
             raise FuseOSError(ENOENT)
 
-        to_write = metadata.form_bytes() + data_to_keep + bytearray(data)
-
-        locations = filetable.write_bytes_to_block(
-            to_write,
-            filetable.get_file_blocks(metadata.LOCATION),
+        written = len(data)
+        old_size = metadata.SIZE or 0
+        if offset > old_size:
+            # fill the hole, since blocks past the end may hold stale bytes
+            data = bytes(offset - old_size) + data
+            offset = old_size
+        new_size = max(old_size, offset + len(data))
+
+        if handle is not None:
+            extents = self.handles.extents(handle)
+        else:
+            extents = filetable.get_extents(metadata.LOCATION)
+        block_size = get_superblock().block_size
+        start = get_superblock().header_size + offset
+        blocks_needed = self.blocks_for_size(offset + len(data))
+        if blocks_needed > extents.block_count:
+            chain_end = extents.block_count * block_size
+            filetable.extend_chain(first_block, blocks_needed - extents.block_count)
+            self.handles.changed(first_block)
+            extents = filetable.get_extents(metadata.LOCATION)
+            # a file grown by truncate can be bigger than its chain, so the
+            # new blocks may be read before and after the data
+            if start > chain_end:
+                data = bytes(start - chain_end) + data
+                start = chain_end
+            data += bytes(blocks_needed * block_size - start - len(data))
+
+        filetable.write_file_range(metadata.LOCATION, start, data, extents)
+
+        now = int(time())
+        metadata.MTIME = now
+        metadata.CTIME = now
+        metadata.SIZE = new_size
+        metadata.save_to_block(first_block)
+
+        return written
+
+    def migrate_directories(self) -> int:
+        """Rewrite every directory reachable from the root in the hashed
+        format. Returns how many directories were migrated."""
+        migrated = 0
+        pending = [self.get_root()]
+        while pending:
+            directory = pending.pop()
+            if directory.migrate():
+                migrated += 1
+            for (_, location, filetype) in directory.get_files():
+                if filetype == 0:
+                    pending.append(DirFactory(location).construct())
+        return migrated
+
+    def count_items(self) -> int:
+        """Count the files and directories reachable from the root, the root
+        included, by reading every directory."""
+        items = 1
+        pending = [self.get_root()]
+        while pending:
+            directory = pending.pop()
+            for (_, location, filetype) in directory.get_files():
+                items += 1
+                if filetype == 0:
+                    pending.append(DirFactory(location).construct())
+        return items
+
+    def item_count(self) -> int:
+        """The number of files and directories, counted on first use."""
+        return ItemCount.mounted().get(self.count_items)
+
+    def truncate_file(self, first_block: int, length: int) -> None:
+        """Set the size of a file. Shrinking cuts the chain and frees its tail
+        in one go, visiting only the blocks freed; growing only zeros what is
+        left of the chain past the old end, and reads give zeros past the end
+        of the chain, until a write adds zeroed blocks there."""
+        filetable = FileTable()
+        metadata = self.get_block_metadata(first_block)
+        old_size = metadata.SIZE or 0
+        chain_blocks = filetable.get_extents(first_block).block_count
+
+        if length < old_size:
+            keep = self.blocks_for_size(length)
+            filetable.truncate_chain(first_block, keep)
+            self.handles.changed(first_block)
+            chain_blocks = min(chain_blocks, keep)
+
+        # clear stale bytes between the two sizes that are still in the chain
+        superblock = get_superblock()
+        start = superblock.header_size + min(length, old_size)
+        end = min(
+            superblock.header_size + max(length, old_size),
+            chain_blocks * superblock.block_size,
         )
+        if start < end:
+            filetable.write_file_range(first_block, start, bytes(end - start))
 
-        filetable.write_to_table(locations)
+        now = int(time())
+        metadata.MTIME = now
+        metadata.CTIME = now
+        metadata.SIZE = length
+        metadata.save_to_block(first_block)
 
-        return len(data)
+    @staticmethod
+    def blocks_for_size(size: int) -> int:
+        """The number of blocks in the chain of a file with size bytes."""
+        superblock = get_superblock()
+        block_size = superblock.block_size
+        return (superblock.header_size + size + block_size - 1) // block_size
 
     @staticmethod
     def get_path_and_base(path: str) -> Tuple[str, str]:
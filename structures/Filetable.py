@@ -11,126 +11,542 @@
 # obtained from the author.
 # ************************************************************************
 
-from typing import List
-from constants import BLOCK_SIZE, FREE_SPACE, END_OF_FILE
-from disktools import read_block, write_block
+import sys
+from array import array
+from threading import Lock, RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from disktools import Block, Device, get_device
 from errno import ENOSPC
 from util.FMLog import FMLog
+from util.Metrics import get_metrics
+
+from structures.ExtentMap import EXTENT_FIELDS, EXTENT_FIELDS_OFFSET, ExtentMap, Run
+from structures.FreeSpace import FreeSpace
+from structures.Superblock import FEATURE_EXTENTS
+
+# The most table blocks one batch of freed blocks has entries in, so that each
+# batch fits in a journal transaction
+FREE_BATCH_TABLE_BLOCKS = 16
+
+
+class ResidentTable(object):
+    """The filetable of the mounted device, held in memory. Entries are changed
+    in place and marked dirty; flushing writes back only the dirty ranges. The
+    free space index is built alongside it and kept in step with every entry
+    change. Entries are as wide as the superblock says, but are always held
+    as an array of unsigned ints. The extent maps of files are kept here too,
+    keyed by their first block, as they change with the table. Everything here
+    is shared between threads, and is only touched with lock held."""
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        superblock = device.superblock
+        self.width = superblock.pointer_width
+        self.block_size = superblock.block_size
+        self.table_start = superblock.table_start
+        self.free_entry = superblock.free_space
+
+        raw = bytearray(
+            device.read_run(superblock.table_start, superblock.table_blocks)
+        )
+        del raw[superblock.num_blocks * self.width :]
+        if self.width == 1:
+            self.entries = array("I", iter(raw))
+        else:
+            self.entries = array("I")
+            self.entries.frombytes(bytes(raw))
+            if sys.byteorder == "little":
+                self.entries.byteswap()
+
+        self.lock = RLock()
+        self.dirty: Set[int] = set()
+        self.extents: Dict[int, ExtentMap] = {}
+        # batches of blocks no longer used, but still taken, to be freed after
+        # the operation that let them go (see FileTable.free_blocks)
+        self.deferred: List[List[int]] = []
+        self.free_space = FreeSpace(
+            [entry == self.free_entry for entry in self.entries]
+        )
+
+    def set(self, index: int, value: int) -> None:
+        """Set an entry. A block that was in use stays out of free space when
+        freed, until release hands it back (see FileTable.free_entries)."""
+        was_free = self.entries[index] == self.free_entry
+        if self.entries[index] != value:
+            self.entries[index] = value
+            self.dirty.add(index)
+        if value != self.free_entry:
+            self.free_space.claim(index)
+        elif was_free:
+            self.free_space.release(index)
+
+    def release(self, blocks: List[int]) -> None:
+        """Hand back to free space the blocks whose entries are free."""
+        with self.lock:
+            for block in blocks:
+                if self.entries[block] == self.free_entry:
+                    self.free_space.release(block)
+
+    def encode(self, start: int, end: int) -> bytes:
+        """The on-disk bytes of entries start to end (exclusive)."""
+        if self.width == 1:
+            return bytes(self.entries[start:end].tolist())
+        chunk = self.entries[start:end]
+        if sys.byteorder == "little":
+            chunk.byteswap()
+        return chunk.tobytes()
+
+    def table_blocks(self, index: int) -> range:
+        """The table blocks, counted from the table's start, holding entry
+        index. Entries are packed end to end, as they are loaded, so one may
+        straddle two blocks."""
+        first = index * self.width // self.block_size
+        last = ((index + 1) * self.width - 1) // self.block_size
+        return range(first, last + 1)
+
+    def encode_block(self, table_block: int) -> bytes:
+        """The on-disk bytes of a table block, which are short for the last."""
+        start = table_block * self.block_size
+        first = start // self.width
+        end = min(-(-(start + self.block_size) // self.width), len(self.entries))
+        skip = start - first * self.width
+        return self.encode(first, end)[skip : skip + self.block_size]
+
+    def flush(self) -> None:
+        """Write back every table block holding a dirty entry, adjacent ones
+        in a single transfer."""
+        if not self.dirty:
+            return
+        table_blocks = {
+            table_block
+            for index in self.dirty
+            for table_block in self.table_blocks(index)
+        }
+        self.dirty.clear()
+        metrics = get_metrics()
+        metrics.count("filetable.flushes")
+        metrics.count("filetable.flushed_blocks", len(table_blocks))
+        self.device.write_blocks(
+            [
+                (self.table_start + table_block, self.encode_block(table_block))
+                for table_block in table_blocks
+            ]
+        )
+
+
+_resident: Optional[ResidentTable] = None
+_resident_lock = Lock()
 
 
 class FileTable(object):
     def __init__(self) -> None:
-        self.block = 0
+        superblock = get_device().superblock
+        self.block = superblock.table_start
+        self.block_size = superblock.block_size
+        self.end_of_file = superblock.end_of_file
+        self.free_entry = superblock.free_space
+        self.extents_on_disk = superblock.has_feature(FEATURE_EXTENTS)
+
+    def get_filetable(self) -> "array[int]":
+        """The in-memory filetable. Changes to it must go through set_entry, so
+        that they are flushed."""
+        return self.resident().entries
+
+    @staticmethod
+    def resident() -> ResidentTable:
+        """The filetable of the mounted device, loaded on first use."""
+        global _resident
+        device = get_device()
+        resident = _resident
+        if resident is not None and resident.device is device:
+            return resident
+        with _resident_lock:
+            if _resident is None or _resident.device is not device:
+                _resident = ResidentTable(device)
+            return _resident
+
+    def set_entry(self, index: int, value: int) -> None:
+        resident = self.resident()
+        with resident.lock:
+            resident.set(index, value)
+
+    def flush_table(self) -> None:
+        resident = self.resident()
+        with resident.lock:
+            resident.flush()
 
-    def get_filetable(self) -> bytearray:
-        return self.read_block(self.block)
+    def read_block(self, at_location: int) -> Block:
+        return get_device().read_block(at_location)
 
-    def read_block(self, at_location: int) -> bytearray:
-        return read_block(at_location)
+    def write_block(
+        self, at_location: int, data: Union[bytes, bytearray], offset: int = 0
+    ) -> None:
+        get_device().write_block(at_location, data, offset)
 
     def read_full_file(self, at_location: int) -> bytearray:
-        filetable_snapshot = self.get_filetable()
-        current_block = at_location
-        next_block = filetable_snapshot[at_location]
-        return_array: bytearray = bytearray()
-        while True:
-            return_array += read_block(current_block)
-            current_block = next_block
-            if current_block == END_OF_FILE:
-                break
-            next_block = filetable_snapshot[current_block]
+        extents = self.get_extents(at_location)
+        return_array = bytearray(extents.block_count * self.block_size)
+        self.read_runs(extents.runs, return_array)
         return return_array
 
+    def read_runs(self, runs: Iterable[Run], into: bytearray) -> None:
+        """Fill into from the runs of blocks in turn, in one vectored read."""
+        view = memoryview(into)
+        reads: List[Tuple[int, memoryview]] = []
+        position = 0
+        for (block, length) in runs:
+            end = position + length * self.block_size
+            reads.append((block, view[position:end]))
+            position = end
+        get_device().read_blocks(reads)
+
+    def read_file_range(
+        self,
+        at_location: int,
+        start: int,
+        end: int,
+        extents: Optional[ExtentMap] = None,
+    ) -> bytearray:
+        """Read bytes start to end (exclusive) of the file beginning at
+        at_location, whose extent map may be given. Only the blocks covering
+        the range are read, a run of contiguous blocks at a time."""
+        if extents is None:
+            extents = self.get_extents(at_location)
+        first = start // self.block_size
+        last = (end + self.block_size - 1) // self.block_size
+        runs = list(extents.runs_between(first, last))
+        return_array = bytearray(sum(length for (_, length) in runs) * self.block_size)
+        self.read_runs(runs, return_array)
+        skip = start - first * self.block_size
+        return return_array[skip : skip + end - start]
+
+    def write_file_range(
+        self,
+        at_location: int,
+        start: int,
+        data: bytes,
+        extents: Optional[ExtentMap] = None,
+    ) -> None:
+        """Write data at byte start of the file beginning at at_location, whose
+        extent map may be given, a run of contiguous blocks at a time. The file
+        must already have blocks up to the end of the data."""
+        if extents is None:
+            extents = self.get_extents(at_location)
+        device = get_device()
+        first = start // self.block_size
+        last = (start + len(data) + self.block_size - 1) // self.block_size
+        in_block = start - first * self.block_size
+        written = 0
+        for (block, length) in extents.runs_between(first, last):
+            piece = min(len(data) - written, length * self.block_size - in_block)
+            device.write_data(block, data[written : written + piece], in_block)
+            written += piece
+            in_block = 0
+
     def purge_full_file(self, at_location: int) -> None:
-        current_block = at_location
-        filetable_snapshot = self.get_filetable()
+        extents = self.get_extents(at_location)
+        blocks = list(extents.blocks())
+        if extents.overflow:
+            blocks.append(extents.overflow)
+        resident = self.resident()
+        with resident.lock:
+            resident.extents.pop(at_location, None)
+        self.free_blocks(blocks)
 
-        next_block = filetable_snapshot[at_location]
-        while True:
-            filetable_snapshot[current_block] = FREE_SPACE
-            write_block(current_block, bytearray([0] * BLOCK_SIZE))
-            current_block = next_block
-            if current_block == END_OF_FILE:
-                break
-            next_block = filetable_snapshot[current_block]
-        write_block(0, filetable_snapshot)
+    def free_blocks(self, blocks: List[int]) -> None:
+        """Free blocks in the table and flush it. Only the first batch, whose
+        entries lie in a few table blocks, is freed now, so that an operation
+        freeing a big file still fits in a journal transaction. The rest stay
+        taken until release_deferred frees them, a batch per transaction, once
+        the operation is over; a crash before then leaves them taken but
+        unused, for fsck to reclaim."""
+        batches = list(self.batches(blocks))
+        resident = self.resident()
+        with resident.lock:
+            self.free_entries(batches[0] if batches else [])
+            resident.deferred.extend(batches[1:])
+            self.flush_table()
+
+    def free_entries(self, blocks: List[int]) -> None:
+        """Set the entries of blocks free. The blocks are only handed back for
+        reuse once the transaction freeing them is committed: until then a
+        crash brings back the files that own them, which must find them as
+        they were."""
+        resident = self.resident()
+        with resident.lock:
+            for block in blocks:
+                self.set_entry(block, self.free_entry)
+        get_device().after_commit(lambda: resident.release(blocks))
+
+    def batches(self, blocks: List[int]) -> Iterator[List[int]]:
+        """Split blocks, in order, into batches whose entries lie in at most
+        FREE_BATCH_TABLE_BLOCKS table blocks."""
+        resident = self.resident()
+        batch: List[int] = []
+        table_blocks: Set[int] = set()
+        for block in blocks:
+            spans = set(resident.table_blocks(block))
+            if not spans <= table_blocks:
+                if batch and len(table_blocks | spans) > FREE_BATCH_TABLE_BLOCKS:
+                    yield batch
+                    batch = []
+                    table_blocks = set()
+                table_blocks |= spans
+            batch.append(block)
+        if batch:
+            yield batch
+
+    def release_deferred(self) -> None:
+        """Free the blocks free_blocks left taken, each batch in a journal
+        transaction of its own. Called once an operation is over."""
+        resident = self.resident()
+        while resident.deferred:
+            with resident.lock:
+                if not resident.deferred:
+                    return
+                batch = resident.deferred.pop()
+            with get_device().transaction():
+                with resident.lock:
+                    self.free_entries(batch)
+                    self.flush_table()
 
     def get_file_blocks(self, start_block: int) -> List[int]:
+        return list(self.get_extents(start_block).blocks())
+
+    def follow_chain(self, start_block: int) -> List[int]:
+        """The blocks of a file, found by following its chain in the table."""
         filetable_snapshot = self.get_filetable()
         blocks: List[int] = []
         current_block = start_block
         while True:
             blocks.append(current_block)
             current_block = filetable_snapshot[current_block]
-            if current_block == END_OF_FILE:
+            if current_block == self.end_of_file:
                 break
 
         return blocks
 
-    def find_free_block(self, exclude: List[int] = []):
-        filetable = self.get_filetable()
-        iterator = 0
-        for i in filetable:
-            if i == FREE_SPACE and (not iterator in exclude):
-                return iterator
-            iterator += 1
-        raise IOError(ENOSPC, "ENOSPC: No space left on device")
-
-    def write_to_block(self, data: str, metadata: bytearray) -> List[int]:
-        data_as_bytes = metadata + bytearray(data.encode(encoding="ascii"))
-        size = len(data_as_bytes)
-
-        split_blocks = [
-            data_as_bytes[i * BLOCK_SIZE : (i + 1) * BLOCK_SIZE]
-            for i in range((size + BLOCK_SIZE - 1) // BLOCK_SIZE)
-        ]
-
-        written_blocks: List[int] = []
-
-        for i in split_blocks:
-            free: int = self.find_free_block(written_blocks)
-            write_block(free, i)
-            written_blocks.append(free)
-        return written_blocks
+    def get_extents(self, start_block: int) -> ExtentMap:
+        """The extent map of the file beginning at start_block. It is read from
+        the file's header where the volume keeps one, and otherwise built by
+        following the chain."""
+        resident = self.resident()
+        with resident.lock:
+            extents = resident.extents.get(start_block)
+            if extents is None:
+                extents = self.load_extents(start_block)
+                resident.extents[start_block] = extents
+            return extents
+
+    def load_extents(self, start_block: int) -> ExtentMap:
+        if self.extents_on_disk:
+            (first_run, overflow) = EXTENT_FIELDS.unpack_from(
+                self.read_block(start_block), EXTENT_FIELDS_OFFSET
+            )
+            if first_run:
+                runs = [(start_block, first_run)]
+                if overflow:
+                    runs += ExtentMap.decode_runs(self.read_block(overflow))
+                return ExtentMap(runs, overflow)
+        return ExtentMap.from_blocks(self.follow_chain(start_block))
+
+    def record_extents(self, blocks: List[int]) -> None:
+        """Remember blocks as the whole of a file, which has just been written
+        whole, header and all, as save_extents does."""
+        self.save_extents(blocks[0], ExtentMap.from_blocks(blocks), rewritten=True)
+
+    def save_extents(
+        self, start_block: int, extents: ExtentMap, rewritten: bool = False
+    ) -> None:
+        """Remember extents as the map of the file at start_block, and on
+        volumes that keep extent maps, save the map to the file's header. Runs
+        after the first go in an overflow block; if there are more than fit, no
+        map is saved and the chain is followed instead. Only the parts that
+        differ from the map saved before are written, and the header's fields
+        too if the header has been rewritten since."""
+        resident = self.resident()
+        with resident.lock:
+            if self.extents_on_disk:
+                self.write_extents(
+                    start_block, resident.extents.get(start_block), extents, rewritten
+                )
+            # only complete maps are handed out, as readers use them unlocked
+            resident.extents[start_block] = extents
+
+    def write_extents(
+        self,
+        start_block: int,
+        previous: Optional[ExtentMap],
+        extents: ExtentMap,
+        rewritten: bool = False,
+    ) -> None:
+        """Save extents over previous, the map saved for the file before, if it
+        is known. The header is written if its fields change, and the overflow
+        block if the runs it holds do. The caller holds the table's lock."""
+        capacity = ExtentMap.overflow_capacity(self.block_size)
+        if previous is not None:
+            old_overflow = previous.overflow
+            old_rest: Optional[List[Run]] = previous.runs[1:]
+            old_first = previous.runs[0][1]
+            if len(previous.runs) - 1 > capacity:
+                (old_rest, old_first) = (None, 0)
+        else:
+            (old_first, old_overflow) = EXTENT_FIELDS.unpack_from(
+                self.read_block(start_block), EXTENT_FIELDS_OFFSET
+            )
+            old_rest = None
+
+        first_run = extents.runs[0][1]
+        rest = extents.runs[1:]
+        extents.overflow = 0
+        if len(rest) > capacity:
+            first_run = 0
+        elif rest:
+            extents.overflow = old_overflow
+            if not old_overflow:
+                extents.overflow = self.allocate_blocks(1)[0]
+                self.set_entry(extents.overflow, self.end_of_file)
+            if rest != old_rest or extents.overflow != old_overflow:
+                overflow = bytearray(self.block_size)
+                encoded = ExtentMap.encode_runs(rest)
+                overflow[: len(encoded)] = encoded
+                self.write_block(extents.overflow, overflow)
+        if old_overflow and old_overflow != extents.overflow:
+            self.free_entries([old_overflow])
+        if rewritten or (first_run, extents.overflow) != (old_first, old_overflow):
+            self.write_block(
+                start_block,
+                EXTENT_FIELDS.pack(first_run, extents.overflow),
+                EXTENT_FIELDS_OFFSET,
+            )
+
+    def find_free_block(self, exclude: List[int] = []) -> int:
+        """Get the lowest free block, without claiming it."""
+        resident = self.resident()
+        with resident.lock:
+            free_space = resident.free_space
+            excluded = set(exclude)
+            block = free_space.find_free_after(0)
+            while block in excluded:
+                block = free_space.find_free_after(block + 1)
+            if block == -1:
+                raise IOError(ENOSPC, "ENOSPC: No space left on device")
+            return block
+
+    def allocate_blocks(self, count: int, after: Optional[int] = None) -> List[int]:
+        """Claim count free blocks, as one contiguous run if there is one. If
+        after is given and the blocks straight after it are free, those are
+        taken, so that a file's last run grows in place. The blocks are
+        reserved until written to the table or released."""
+        resident = self.resident()
+        with resident.lock:
+            free_space = resident.free_space
+            metrics = get_metrics()
+            metrics.count("allocator.calls")
+            if count > free_space.free_count:
+                metrics.count("allocator.failures")
+                raise IOError(ENOSPC, "ENOSPC: No space left on device")
+            if (
+                after is not None
+                and after + count < free_space.num_blocks
+                and all(free_space.is_free(after + i) for i in range(1, count + 1))
+            ):
+                start = after + 1
+                metrics.count("allocator.grown_in_place")
+            else:
+                start = free_space.find_run(count)
+            metrics.count("allocator.blocks", count)
+            blocks: List[int] = []
+            if start != -1:
+                blocks = list(range(start, start + count))
+            else:
+                metrics.count("allocator.scattered")
+                block = free_space.find_free_after(0)
+                while len(blocks) < count:
+                    blocks.append(block)
+                    block = free_space.find_free_after(block + 1)
+            for block in blocks:
+                free_space.claim(block)
+            return blocks
+
+    def release_blocks(self, blocks: List[int]) -> None:
+        """Give back claimed blocks that never made it into the table."""
+        self.resident().release(blocks)
+
+    def blocks_for_bytes(self, size: int) -> int:
+        return (size + self.block_size - 1) // self.block_size
 
     def write_bytes_to_block(
         self, data: bytearray, overwrite: List[int] = [], print: bool = False
     ) -> List[int]:
-        # print(overwrite)
-        # print(data)
-        data_as_bytes = data
-        size = len(data_as_bytes)
+        needed = self.blocks_for_bytes(len(data))
 
-        split_blocks = [
-            data_as_bytes[i * BLOCK_SIZE : (i + 1) * BLOCK_SIZE]
-            for i in range((size + BLOCK_SIZE - 1) // BLOCK_SIZE)
-        ]
+        written_blocks = overwrite[:needed]
+        if needed > len(written_blocks):
+            written_blocks += self.allocate_blocks(
+                needed - len(written_blocks),
+                after=written_blocks[-1] if written_blocks else None,
+            )
+        self.write_in_runs(written_blocks, data)
 
-        written_blocks: List[int] = []
-
-        def get_block_to_write(level: int) -> int:
-            if level < len(overwrite):
-                return overwrite[level]
-            return self.find_free_block(written_blocks)
+        return written_blocks
 
-        iterator = 0
+    def write_in_runs(self, blocks: List[int], data: Union[bytes, bytearray]) -> None:
+        """Write data across blocks, in one transfer per run of contiguous
+        blocks. The last block is padded with zeros, as freed blocks are not
+        cleared and may hold what their last owner left."""
+        if len(data) < len(blocks) * self.block_size:
+            data = bytes(data) + bytes(len(blocks) * self.block_size - len(data))
+        view = memoryview(data)
+        get_device().write_blocks(
+            [
+                (block, view[index * self.block_size : (index + 1) * self.block_size])
+                for (index, block) in enumerate(blocks)
+            ]
+        )
 
-        for i in split_blocks:
-            free: int = get_block_to_write(iterator)
-            write_block(free, i)
-            written_blocks.append(free)
-            iterator += 1
+    def extend_chain(self, start_block: int, count: int) -> List[int]:
+        """Claim count more blocks and link them onto the end of the chain of
+        the file at start_block, straight after its last block where there is
+        room. Only the new blocks are touched. Returns the new blocks."""
+        with self.resident().lock:
+            extents = self.get_extents(start_block)
+            last = extents.last_block()
+            new_blocks = self.allocate_blocks(count, after=last)
+            self.set_entry(last, new_blocks[0])
+            self.link_blocks(new_blocks)
+            self.save_extents(start_block, extents.extended(new_blocks))
+            self.flush_table()
+            return new_blocks
 
-        return written_blocks
+    def truncate_chain(self, start_block: int, keep: int) -> List[int]:
+        """Cut the chain of the file at start_block after its first keep
+        blocks, and free the rest with free_blocks. Only the blocks cut off
+        are visited. Returns the freed blocks."""
+        extents = self.get_extents(start_block)
+        if keep >= extents.block_count:
+            return []
+        freed: List[int] = []
+        for (block, length) in extents.runs_between(keep, extents.block_count):
+            freed.extend(range(block, block + length))
+        with self.resident().lock:
+            self.set_entry(extents.locate(keep - 1), self.end_of_file)
+            self.save_extents(start_block, extents.truncated(keep))
+        self.free_blocks(freed)
+        return freed
 
-    def write_to_table(self, locations: List[int]) -> None:
-        filetable = self.get_filetable()
+    def link_blocks(self, locations: List[int]) -> None:
         location_len = len(locations)
         for i in range(location_len):
             location = locations[i]
             if i + 1 == location_len:
-                filetable[location] = END_OF_FILE
+                self.set_entry(location, self.end_of_file)
             else:
-                filetable[location] = locations[i + 1]
-        to_write = filetable
-        write_block(0, to_write)
+                self.set_entry(location, locations[i + 1])
+
+    def write_to_table(self, locations: List[int]) -> None:
+        """Chain locations together as the whole of one file."""
+        with self.resident().lock:
+            self.link_blocks(locations)
+            self.record_extents(locations)
+            self.flush_table()
@@ -0,0 +1,123 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from array import array
+from typing import List
+
+
+class FreeSpace(object):
+    """An index of the free blocks on the volume, as a segment tree over the
+    blocks. Each node knows the longest free run at the start, at the end, and
+    anywhere within its range, so the first free block, or the first free run
+    of some length, is found in O(log n), and a block changes in O(log n)."""
+
+    def __init__(self, free: List[bool]) -> None:
+        self.num_blocks = len(free)
+        self.size = 1
+        while self.size < self.num_blocks:
+            self.size *= 2
+        self.free_count = 0
+
+        # node i has children 2i and 2i+1, the leaves start at self.size. The
+        # arrays are compact, as a big volume has millions of blocks.
+        self.prefix = array("I", [0]) * (2 * self.size)
+        self.suffix = array("I", self.prefix)
+        self.best = array("I", self.prefix)
+
+        for block, is_free in enumerate(free):
+            if is_free:
+                leaf = self.size + block
+                self.prefix[leaf] = self.suffix[leaf] = self.best[leaf] = 1
+                self.free_count += 1
+        for node in range(self.size - 1, 0, -1):
+            self._pull(node)
+
+    def _width(self, node: int) -> int:
+        """The number of blocks under a node."""
+        return self.size >> (node.bit_length() - 1)
+
+    def _pull(self, node: int) -> None:
+        left = 2 * node
+        right = left + 1
+        half = self._width(left)
+        prefix = self.prefix[left]
+        if prefix == half:
+            prefix += self.prefix[right]
+        suffix = self.suffix[right]
+        if suffix == half:
+            suffix += self.suffix[left]
+        self.prefix[node] = prefix
+        self.suffix[node] = suffix
+        self.best[node] = max(
+            self.best[left], self.best[right], self.suffix[left] + self.prefix[right]
+        )
+
+    def _set(self, block: int, is_free: bool) -> None:
+        leaf = self.size + block
+        if (self.best[leaf] == 1) == is_free:
+            return
+        self.free_count += 1 if is_free else -1
+        value = 1 if is_free else 0
+        self.prefix[leaf] = self.suffix[leaf] = self.best[leaf] = value
+        node = leaf // 2
+        while node >= 1:
+            self._pull(node)
+            node //= 2
+
+    def is_free(self, block: int) -> bool:
+        return self.best[self.size + block] == 1
+
+    def claim(self, block: int) -> None:
+        """Mark a block as in use. Claiming a used block does nothing."""
+        self._set(block, False)
+
+    def release(self, block: int) -> None:
+        """Mark a block as free. Releasing a free block does nothing."""
+        self._set(block, True)
+
+    def find_run(self, length: int = 1) -> int:
+        """Get the first block of the lowest run of at least length free
+        blocks, or -1 if there is no such run."""
+        if length < 1 or self.best[1] < length:
+            return -1
+        node = 1
+        start = 0
+        while node < self.size:
+            left = 2 * node
+            if self.best[left] >= length:
+                node = left
+            elif self.suffix[left] + self.prefix[left + 1] >= length:
+                return start + self._width(left) - self.suffix[left]
+            else:
+                start += self._width(left)
+                node = left + 1
+        return start
+
+    def find_free_after(self, block: int) -> int:
+        """Get the first free block at or after the given block, or -1."""
+        if block >= self.num_blocks:
+            return -1
+        if self.is_free(block):
+            return block
+        # climb until there is a right sibling with something free in it
+        node = self.size + block
+        while node > 1:
+            if node % 2 == 0 and self.best[node + 1] > 0:
+                node += 1
+                break
+            node //= 2
+        else:
+            return -1
+        while node < self.size:
+            node = 2 * node if self.best[2 * node] > 0 else 2 * node + 1
+        return node - self.size
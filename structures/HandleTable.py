@@ -0,0 +1,122 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from threading import Lock
+from typing import Dict, Optional, Set
+
+from disktools import Device, PerDevice
+
+from structures.ExtentMap import ExtentMap
+from structures.Filetable import FileTable
+from structures.ReadAhead import Stream
+
+
+class Handle(object):
+    """A file opened by open or create. Block is the file's first block, or -1
+    once the file has been removed, or for a file not on disk, when its path
+    has to be used instead."""
+
+    __slots__ = ("block", "flags", "extents", "stream")
+
+    def __init__(self, block: int, flags: int) -> None:
+        self.block = block
+        self.flags = flags
+        # the file's extent map, loaded on first use, and dropped whenever its
+        # chain changes. Only used with the file's lock held.
+        self.extents: Optional[ExtentMap] = None
+        # where this handle's reads have got to, so that readahead follows
+        # each reader of a file rather than the file as a whole
+        self.stream = Stream()
+
+
+class HandleTable(object):
+    """The files open on the mounted volume, by the fh given to open and
+    create. Reads and writes through a handle go straight to the file's block
+    and extent map, without resolving its path or taking the filetable's lock.
+    Removing a file, or changing its chain, updates the handles open on it."""
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.lock = Lock()
+        self.handles: Dict[int, Handle] = {}
+        # the fh of the handles open on each block
+        self.by_block: Dict[int, Set[int]] = {}
+        self.last_fh = 0
+
+    @staticmethod
+    def mounted() -> "HandleTable":
+        """The handles of the mounted device, created on first use."""
+        return _mounted.get()
+
+    def open(self, block: int, flags: int) -> int:
+        """Open a handle on the file at block, giving its fh."""
+        with self.lock:
+            self.last_fh += 1
+            fh = self.last_fh
+            self.handles[fh] = Handle(block, flags)
+            if block != -1:
+                self.by_block.setdefault(block, set()).add(fh)
+            return fh
+
+    def get(self, fh: Optional[int]) -> Optional[Handle]:
+        """The handle fh, if it is open."""
+        if fh is None:
+            return None
+        with self.lock:
+            return self.handles.get(fh)
+
+    def release(self, fh: int) -> None:
+        with self.lock:
+            handle = self.handles.pop(fh, None)
+            if handle is not None:
+                self.forget(handle.block, fh)
+
+    def forget(self, block: int, fh: int) -> None:
+        """Stop noting that fh is open on block. The caller holds the lock."""
+        open_on = self.by_block.get(block)
+        if open_on is not None:
+            open_on.discard(fh)
+            if not open_on:
+                del self.by_block[block]
+
+    def extents(self, handle: Handle) -> ExtentMap:
+        """The extent map of the file handle is open on, whose lock the caller
+        holds."""
+        extents = handle.extents
+        if extents is None:
+            extents = FileTable().get_extents(handle.block)
+            handle.extents = extents
+        return extents
+
+    def changed(self, block: int) -> None:
+        """The chain of the file at block has changed, so the handles open on
+        it load its extent map again. The caller holds the file's lock."""
+        with self.lock:
+            for fh in self.by_block.get(block, ()):
+                self.handles[fh].extents = None
+
+    def removed(self, block: int) -> None:
+        """The file at block has been removed, so the handles open on it go by
+        their path from now on, and find it gone."""
+        with self.lock:
+            for fh in self.by_block.pop(block, ()):
+                handle = self.handles[fh]
+                handle.block = -1
+                handle.extents = None
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"open": len(self.handles), "files": len(self.by_block)}
+
+
+_mounted = PerDevice(HandleTable)
@@ -0,0 +1,63 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from contextlib import ExitStack, contextmanager
+from threading import Lock
+from typing import Iterator
+from weakref import WeakValueDictionary
+
+from disktools import Device, PerDevice
+from util.RWLock import RWLock
+
+
+class InodeLocks(object):
+    """A reader/writer lock for each file and directory, keyed by its first
+    block, guarding its content and metadata. Locks are made on first use and
+    dropped once nothing holds them. Whoever needs several locks at once takes
+    them all through writing, which orders them by block, and nothing waits for
+    a lock while holding another any other way, so they cannot deadlock."""
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.locks: "WeakValueDictionary[int, RWLock]" = WeakValueDictionary()
+        self.mutex = Lock()
+
+    @staticmethod
+    def mounted() -> "InodeLocks":
+        """The locks for the mounted device, created on first use."""
+        return _mounted.get()
+
+    def lock(self, block: int) -> RWLock:
+        with self.mutex:
+            lock = self.locks.get(block)
+            if lock is None:
+                lock = RWLock()
+                self.locks[block] = lock
+            return lock
+
+    @contextmanager
+    def reading(self, block: int) -> Iterator[None]:
+        with self.lock(block).read():
+            yield
+
+    @contextmanager
+    def writing(self, *blocks: int) -> Iterator[None]:
+        """Hold the write locks of all the given blocks, taken in block
+        order."""
+        with ExitStack() as stack:
+            for block in sorted(set(blocks)):
+                stack.enter_context(self.lock(block).write())
+            yield
+
+
+_mounted = PerDevice(InodeLocks)
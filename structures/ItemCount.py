@@ -0,0 +1,75 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from threading import Lock
+from typing import Callable, Optional
+
+from disktools import Device, PerDevice
+from structures.Superblock import FEATURE_ITEM_COUNT, Superblock
+
+
+class ItemCount(object):
+    """How many files and directories the mounted volume holds. Volumes with
+    FEATURE_ITEM_COUNT keep it in the superblock, which is rewritten with it
+    in the transaction of each operation that changes it, so neither mounting
+    nor statfs walks anything. Other volumes are walked once, on first use,
+    and those that have a superblock then keep the count there too."""
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.lock = Lock()
+        self.count: Optional[int] = None
+        # read again, as the journal may have replayed a newer count
+        stored = Superblock.decode(bytes(device.read_block(0)))
+        if stored is not None and stored.has_feature(FEATURE_ITEM_COUNT):
+            device.superblock.features |= FEATURE_ITEM_COUNT
+            self.count = stored.items
+
+    @staticmethod
+    def mounted() -> "ItemCount":
+        """The count for the mounted device, created on first use."""
+        return _mounted.get()
+
+    def get(self, count_items: Callable[[], int]) -> int:
+        """The number of items, counted with count_items if nothing has stored
+        it. Items added or removed meanwhile wait for the count."""
+        with self.lock:
+            if self.count is not None:
+                return self.count
+        with self.device.transaction():
+            with self.lock:
+                if self.count is None:
+                    self.count = count_items()
+                    if self.device.superblock.version >= 2:
+                        self.device.superblock.features |= FEATURE_ITEM_COUNT
+                        self.save()
+                return self.count
+
+    def add(self, amount: int) -> None:
+        """Note items added, or removed if amount is negative. Until they have
+        been counted there is nothing to change."""
+        with self.lock:
+            if self.count is not None:
+                self.count += amount
+                self.save()
+
+    def save(self) -> None:
+        """Write the count with the superblock, if the volume keeps it there.
+        Caller holds the lock."""
+        superblock = self.device.superblock
+        if superblock.has_feature(FEATURE_ITEM_COUNT):
+            superblock.items = self.count or 0
+            self.device.write_block(0, superblock.encode())
+
+
+_mounted = PerDevice(ItemCount)
@@ -0,0 +1,473 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+import struct
+import zlib
+from contextlib import contextmanager
+from threading import Condition, Event, Lock, RLock, Thread, get_ident
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from disktools import Block, BlockIO, Device
+from util.FMLog import FMLog
+
+# The first block of the journal: magic, sequence of the transaction expected
+# in the block after it
+JOURNAL_HEADER = struct.Struct(">4sQ")
+JOURNAL_MAGIC = b"FMJH"
+
+# A transaction is a descriptor block, an image of each block it updates, then
+# a commit block. The descriptor gives magic, sequence and count, then the
+# number of each block; the commit gives magic, sequence and the crc32 of the
+# descriptor and the images.
+DESCRIPTOR = struct.Struct(">4sQI")
+DESCRIPTOR_MAGIC = b"FMJD"
+TAG = struct.Struct(">I")
+COMMIT = struct.Struct(">4sQI")
+COMMIT_MAGIC = b"FMJC"
+
+# Seconds between commits when nothing asks for one sooner
+COMMIT_INTERVAL = 5.0
+
+# Blocks of the running transaction kept free for each operation in it. An
+# operation joins only if that many are left, and the transaction is committed
+# first otherwise.
+OPERATION_BLOCKS = 32
+
+
+class Journal(Device):
+    """A write-ahead journal in front of a device. Every metadata block written
+    is held in memory as part of the running transaction, which each operation
+    joins for its duration (see transaction). A commit waits for the operations
+    in the running transaction to finish, logs the images of the blocks it
+    updated to the journal region, syncs, and only then writes them to their
+    homes, so after a crash the volume holds either all of an operation's
+    metadata or none of it. File contents (see write_data) go straight to the
+    device, and are synced before the metadata referring to them is logged.
+    An operation only joins a transaction with room left for it, so one
+    transaction is logged whole; one operation writing more blocks than the
+    whole journal holds is the exception, and is written in pieces, with a
+    warning. Commits happen on flush, when the transaction is full, and every
+    commit_interval seconds. A flush that finds its updates already being
+    committed waits for that commit rather than making another, so many
+    operations share each sync. On mount, complete transactions left in the
+    journal are written home again, and incomplete ones are discarded. A
+    read-only journal neither replays nor commits; it only counts the complete
+    transactions waiting to be written home."""
+
+    def __init__(
+        self,
+        device: Device,
+        commit_interval: float = COMMIT_INTERVAL,
+        read_only: bool = False,
+    ):
+        self.device = device
+        self.superblock = device.superblock
+        self.block_size = device.superblock.block_size
+        self.start = device.superblock.journal_start
+        self.log_start = self.start + 1
+        self.log_end = self.start + device.superblock.journal_blocks
+        # the most blocks one logged transaction can update
+        self.capacity = min(
+            self.log_end - self.log_start - 2,
+            (self.block_size - DESCRIPTOR.size) // TAG.size,
+        )
+
+        self.condition = Condition(RLock())
+        self.commit_lock = Lock()
+        # images of the blocks updated by the running transaction, and by the
+        # one being committed, which are not home yet
+        self.blocks: Dict[int, bytearray] = {}
+        self.committing: Dict[int, bytearray] = {}
+        # operations in the running transaction, by thread, and how deeply,
+        # and the blocks kept free for them
+        self.handles: Dict[int, int] = {}
+        self.reserved = 0
+        self.operation_blocks = min(OPERATION_BLOCKS, self.capacity)
+        # whether file contents have been written since the last commit
+        self.unsynced_data = False
+        # called once the running transaction is committed and home
+        self.callbacks: List[Callable[[], None]] = []
+        self.closing = False
+        # transactions are numbered in memory as they run, and on disk as they
+        # are logged
+        self.running = 1
+        self.committed = 0
+        self.sequence = 1
+
+        self.commits = 0
+        self.logged_blocks = 0
+        self.read_only = read_only
+        self.replayed = 0
+        self.unreplayed = 0
+        self.stopped = Event()
+        if read_only:
+            self.unreplayed = sum(1 for _ in self._logged())
+            return
+        self.replayed = self.recover()
+
+        self.committer = Thread(
+            target=self._commit_periodically,
+            args=(commit_interval,),
+            name="fmfs-journal",
+            daemon=True,
+        )
+        self.committer.start()
+
+    def _commit_periodically(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            self.commit()
+
+    def recover(self) -> int:
+        """Write home the complete transactions in the journal, in order, and
+        start a fresh journal after them. Returns how many were replayed."""
+        sequence = self._expected() or 1
+        replayed = 0
+        for transaction in self._logged():
+            self.device.write_blocks(transaction)
+            replayed += 1
+        if replayed:
+            self.device.flush()
+            FMLog.info("Replayed %d journal transactions", replayed)
+        self.sequence = sequence + replayed
+        self._write_header()
+        self.device.flush()
+        return replayed
+
+    def _expected(self) -> Optional[int]:
+        """The sequence of the transaction the header expects next, or None if
+        the journal has never been used."""
+        (magic, sequence) = JOURNAL_HEADER.unpack_from(
+            self.device.read_block(self.start), 0
+        )
+        return sequence if magic == JOURNAL_MAGIC else None
+
+    def _logged(self) -> Iterator[List[Tuple[int, bytes]]]:
+        """The updates of each complete transaction in the journal, in order,
+        from the one the header expects. Nothing is written."""
+        sequence = self._expected()
+        if sequence is None:
+            return
+        position = self.log_start
+        while True:
+            transaction = self._read_transaction(position, sequence)
+            if transaction is None:
+                return
+            yield transaction
+            sequence += 1
+            position += len(transaction) + 2
+
+    def _read_transaction(
+        self, position: int, sequence: int
+    ) -> Optional[List[Tuple[int, bytes]]]:
+        """The updates of the transaction logged at position, if it is the
+        expected one and was committed whole."""
+        if position + 2 > self.log_end:
+            return None
+        descriptor = bytes(self.device.read_block(position))
+        (magic, found, count) = DESCRIPTOR.unpack_from(descriptor, 0)
+        if magic != DESCRIPTOR_MAGIC or found != sequence:
+            return None
+        if count > self.capacity or position + count + 2 > self.log_end:
+            return None
+        images = bytes(self.device.read_run(position + 1, count))
+        (magic, found, checksum) = COMMIT.unpack_from(
+            self.device.read_block(position + count + 1), 0
+        )
+        if magic != COMMIT_MAGIC or found != sequence:
+            return None
+        if zlib.crc32(images, zlib.crc32(descriptor)) != checksum:
+            return None
+        tags = descriptor[DESCRIPTOR.size : DESCRIPTOR.size + count * TAG.size]
+        targets = [tag for (tag,) in TAG.iter_unpack(tags)]
+        return [
+            (block, images[index * self.block_size : (index + 1) * self.block_size])
+            for (index, block) in enumerate(targets)
+        ]
+
+    def _write_header(self) -> None:
+        """Point the journal at the next transaction to be logged. It becomes
+        durable with the next sync; until then, the last transaction logged is
+        written home again after a crash, which is harmless."""
+        header = bytearray(self.block_size)
+        JOURNAL_HEADER.pack_into(header, 0, JOURNAL_MAGIC, self.sequence)
+        self.device.write_block(self.start, header)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Make the writes of an operation part of the running transaction,
+        so they are committed together. A thread may nest these."""
+        me = get_ident()
+        with self.condition:
+            nested = me in self.handles
+            if nested:
+                self.handles[me] += 1
+        while not nested:
+            with self.condition:
+                while self.closing:
+                    self.condition.wait()
+                if self._has_room():
+                    self.handles[me] = 1
+                    self.reserved += self.operation_blocks
+                    break
+            self.commit()
+        try:
+            yield
+        finally:
+            with self.condition:
+                depth = self.handles[me] - 1
+                if depth:
+                    self.handles[me] = depth
+                else:
+                    del self.handles[me]
+                    self.reserved -= self.operation_blocks
+                    self.condition.notify_all()
+
+    def _has_room(self) -> bool:
+        """Whether another operation fits in the running transaction. Caller
+        holds the lock."""
+        if not self.blocks and not self.handles:
+            return True
+        used = len(self.blocks) + self.reserved + self.operation_blocks
+        return used <= self.capacity
+
+    def commit(self) -> None:
+        """Make every write so far durable. Operations still under way are
+        waited for, and new ones wait until the transaction is closed."""
+        me = get_ident()
+        with self.condition:
+            wanted = self.running
+        with self.commit_lock:
+            with self.condition:
+                if self.committed >= wanted:
+                    # committed while waiting for the last commit to finish
+                    return
+                self.closing = True
+                while any(thread != me for thread in self.handles):
+                    self.condition.wait()
+                blocks = self.committing = self.blocks
+                self.blocks = {}
+                running = self.running
+                self.running += 1
+                self.closing = False
+                unsynced_data = self.unsynced_data
+                self.unsynced_data = False
+                callbacks = self.callbacks
+                self.callbacks = []
+                self.condition.notify_all()
+            try:
+                if unsynced_data:
+                    # the contents must be down before what refers to them is
+                    self.device.flush()
+                if blocks:
+                    self._log_and_checkpoint(sorted(blocks.items()))
+            finally:
+                with self.condition:
+                    self.committing = {}
+                    self.committed = running
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Calls callback once the running transaction is committed and its
+        blocks are home, so that no replay can undo it."""
+        with self.condition:
+            self.callbacks.append(callback)
+
+    def _log_and_checkpoint(self, updates: List[Tuple[int, bytearray]]) -> None:
+        """Log the updates, sync, then write them home. Updates too many for
+        the journal are split over several transactions, and are then not
+        atomic: only an operation writing more than the journal holds makes
+        that many."""
+        if len(updates) > self.capacity:
+            FMLog.warn(
+                "Transaction of %d blocks is more than the journal's %d, so it "
+                "is logged in pieces, and a crash may leave part of it",
+                len(updates),
+                self.capacity,
+            )
+        for first in range(0, len(updates), self.capacity):
+            chunk = updates[first : first + self.capacity]
+
+            descriptor = bytearray(self.block_size)
+            DESCRIPTOR.pack_into(
+                descriptor, 0, DESCRIPTOR_MAGIC, self.sequence, len(chunk)
+            )
+            for (index, (block, _)) in enumerate(chunk):
+                TAG.pack_into(descriptor, DESCRIPTOR.size + index * TAG.size, block)
+            checksum = zlib.crc32(bytes(descriptor))
+            for (_, image) in chunk:
+                checksum = zlib.crc32(image, checksum)
+            commit = bytearray(self.block_size)
+            COMMIT.pack_into(commit, 0, COMMIT_MAGIC, self.sequence, checksum)
+
+            records: List[Tuple[int, Any]] = [(self.log_start, descriptor)]
+            for (index, (_, image)) in enumerate(chunk):
+                records.append((self.log_start + 1 + index, image))
+            records.append((self.log_start + 1 + len(chunk), commit))
+            self.device.write_blocks(records)
+            self.device.flush()
+
+            self.device.write_blocks(chunk)
+            self.device.flush()
+            self.sequence += 1
+            self._write_header()
+            self.commits += 1
+            self.logged_blocks += len(chunk)
+
+    def _image(self, block_num: int) -> Optional[bytearray]:
+        """The newest image of a block not home yet. Caller holds the
+        lock."""
+        image = self.blocks.get(block_num)
+        if image is None:
+            image = self.committing.get(block_num)
+        return image
+
+    def _pending(self, block_num: int, count: int) -> bool:
+        """Whether any of the blocks are not home yet. Caller holds the
+        lock."""
+        if not self.blocks and not self.committing:
+            return False
+        return any(
+            self._image(block) is not None
+            for block in range(block_num, block_num + count)
+        )
+
+    def _images(self, block_num: int, count: int) -> Dict[int, bytes]:
+        """Copies of the newest images of the blocks not home yet, by block.
+        Caller holds the lock."""
+        if len(self.blocks) + len(self.committing) < count:
+            candidates: Iterable[int] = {*self.blocks, *self.committing}
+        else:
+            candidates = range(block_num, block_num + count)
+        images: Dict[int, bytes] = {}
+        for block in candidates:
+            if block_num <= block < block_num + count:
+                image = self._image(block)
+                if image is not None:
+                    images[block] = bytes(image)
+        return images
+
+    def _patch(self, block_num: int, data: Block, images: Dict[int, bytes]) -> Block:
+        """Lay over data, read from the device from block_num on, the images
+        copied before the read and any the transaction gained during it. Data is
+        copied first if anything is laid over it, as it may alias the device."""
+        with self.condition:
+            count = (len(data) + self.block_size - 1) // self.block_size
+            images.update(self._images(block_num, count))
+        if not images:
+            return data
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        for (block, image) in images.items():
+            start = (block - block_num) * self.block_size
+            end = min(start + self.block_size, len(data))
+            data[start:end] = image[: end - start]
+        return data
+
+    def read_block(self, block_num: int) -> Block:
+        """Reads a block, from its image if it has one not home yet. The
+        device is read without the lock held."""
+        with self.condition:
+            image = self._image(block_num)
+            if image is not None:
+                return bytearray(image)
+        return self._patch(block_num, self.device.read_block(block_num), {})
+
+    def read_run(self, block_num: int, count: int) -> Block:
+        with self.condition:
+            images = self._images(block_num, count)
+        return self._patch(block_num, self.device.read_run(block_num, count), images)
+
+    def read_blocks(self, reads: BlockIO) -> None:
+        counts = [
+            (len(buffer) + self.block_size - 1) // self.block_size
+            for (_, buffer) in reads
+        ]
+        with self.condition:
+            images = [
+                self._images(block_num, count)
+                for ((block_num, _), count) in zip(reads, counts)
+            ]
+        self.device.read_blocks(reads)
+        for ((block_num, buffer), found) in zip(reads, images):
+            patched = self._patch(block_num, buffer, found)
+            if patched is not buffer:
+                memoryview(buffer)[:] = patched
+    def write_block(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Updates the image of a block in the running transaction."""
+        with self.condition:
+            image = self.blocks.get(block_num)
+            if image is None:
+                base = self.committing.get(block_num)
+                if base is None:
+                    base = self.device.read_block(block_num)
+                image = self.blocks[block_num] = bytearray(base)
+            image[offset : offset + len(data)] = data
+
+    def write_data(self, block_num: int, data: Any, offset: int = 0) -> None:
+        """Writes file contents straight to the device, outside the running
+        transaction. A block with an image not home yet, such as a file's first
+        block, which holds its header, takes its part of the write in the image
+        instead, or the image would later land on top of it."""
+        end = offset + len(data)
+        count = (end + self.block_size - 1) // self.block_size
+        with self.condition:
+            self.unsynced_data = True
+            if not self._pending(block_num, count):
+                pending = False
+            else:
+                pending = True
+                view = memoryview(data)
+                start = offset
+                while start < end:
+                    index = start // self.block_size
+                    in_block = start - index * self.block_size
+                    if self._image(block_num + index) is not None:
+                        stop = min(end, (index + 1) * self.block_size)
+                        piece = view[start - offset : stop - offset]
+                        self.write_block(block_num + index, piece, in_block)
+                    else:
+                        following = index + 1
+                        while following < count and (
+                            self._image(block_num + following) is None
+                        ):
+                            following += 1
+                        stop = min(end, following * self.block_size)
+                        piece = view[start - offset : stop - offset]
+                        self.device.write_run(block_num + index, piece, in_block)
+                    start = stop
+        if not pending:
+            self.device.write_run(block_num, data, offset)
+
+    def prefetch(self, block_num: int, count: int) -> None:
+        self.device.prefetch(block_num, count)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "commits": self.commits,
+            "logged_blocks": self.logged_blocks,
+            "replayed": self.replayed,
+            "unreplayed": self.unreplayed,
+            "running_blocks": len(self.blocks),
+            "reserved_blocks": self.reserved,
+        }
+
+    def flush(self) -> None:
+        """Commits everything written so far."""
+        self.commit()
+
+    def close(self) -> None:
+        self.stopped.set()
+        if not self.read_only:
+            self.commit()
+        self.device.close()
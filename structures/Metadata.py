@@ -13,22 +13,106 @@
 
 from __future__ import annotations
 
+import struct
 from enum import Enum
 from time import time
-from typing import Optional
-
-from constants import START_OF_CONTENT
-from disktools import (
-    bytes_to_int,
-    bytes_to_str,
-    int_to_bytes,
-    str_to_bytes,
-    write_block,
-)
+from typing import Any, Dict, List, Optional, Tuple
+
+from constants import END_OF_METADATA, WIDE_HEADER_SIZE
+from disktools import Block, get_superblock
 from util.FMLog import FMLog
 
+from structures.AttrCache import AttrCache
 from structures.Filetable import FileTable
 
+try:
+    import numpy
+except ImportError:  # only needed for bulk header scans
+    numpy = None
+
+# (field, struct code, numpy format), in the order they sit in a header
+Field = Tuple[str, str, str]
+
+_V1_FIELDS: List[Field] = [
+    ("NAME", "16s", "S16"),
+    ("SIZE", "H", ">u2"),
+    ("NLINKS", "B", "u1"),
+    ("MODE", "H", ">u2"),
+    ("UID", "H", ">u2"),
+    ("GID", "H", ">u2"),
+    ("CTIME", "I", ">u4"),
+    ("MTIME", "I", ">u4"),
+    ("ATIME", "I", ">u4"),
+    ("LOCATION", "B", "u1"),
+    ("TYPE", "B", "u1"),
+]
+
+# version 2 widens the size, links, ids and location, and pads to 64 bytes
+_V2_FIELDS: List[Field] = [
+    ("NAME", "16s", "S16"),
+    ("SIZE", "Q", ">u8"),
+    ("NLINKS", "H", ">u2"),
+    ("MODE", "H", ">u2"),
+    ("UID", "I", ">u4"),
+    ("GID", "I", ">u4"),
+    ("CTIME", "I", ">u4"),
+    ("MTIME", "I", ">u4"),
+    ("ATIME", "I", ">u4"),
+    ("LOCATION", "I", ">u4"),
+    ("TYPE", "B", "u1"),
+]
+
+
+class HeaderLayout(object):
+    """Where each metadata field sits in the header of one format version."""
+
+    __slots__ = ("fields", "struct", "offsets", "sizes", "masks", "fields_size")
+
+    def __init__(self, fields: List[Field], size: int) -> None:
+        codes = [code for (_, code, _) in fields]
+        self.fields = fields
+        self.sizes = [struct.calcsize(">" + code) for code in codes]
+        self.offsets = [sum(self.sizes[:index]) for index in range(len(fields))]
+        # the rest of the header is padding, or on version 2 the extent map
+        self.fields_size = sum(self.sizes)
+        padding = size - self.fields_size
+        self.struct = struct.Struct(">" + "".join(codes) + f"{padding}x")
+        # Values wider than their field wrap around, as they always have
+        self.masks: Tuple[int, ...] = tuple(
+            (1 << (8 * width)) - 1 for width in self.sizes[1:]
+        )
+
+
+HEADER_LAYOUTS: Dict[int, HeaderLayout] = {
+    1: HeaderLayout(_V1_FIELDS, END_OF_METADATA),
+    2: HeaderLayout(_V2_FIELDS, WIDE_HEADER_SIZE),
+}
+
+
+def header_layout(version: Optional[int] = None) -> HeaderLayout:
+    """The header layout of a format version, by default the mounted one."""
+    if version is None:
+        version = get_superblock().version
+    return HEADER_LAYOUTS[version]
+
+
+def header_dtype(stride: Optional[int] = None, version: Optional[int] = None) -> Any:
+    """A NumPy structured dtype for metadata headers that are stride bytes
+    apart, such as one at the start of every block of an image. Decoding a
+    whole image is then numpy.frombuffer(image, dtype=header_dtype()). The
+    stride and version default to those of the mounted volume."""
+    if numpy is None:
+        raise ImportError("numpy is required for bulk metadata decoding")
+    layout = header_layout(version)
+    return numpy.dtype(
+        {
+            "names": [name for (name, _, _) in layout.fields],
+            "formats": [fmt for (_, _, fmt) in layout.fields],
+            "offsets": layout.offsets,
+            "itemsize": get_superblock().block_size if stride is None else stride,
+        }
+    )
+
 
 class MetadataField(Enum):
     NAME = 0
@@ -45,6 +129,20 @@ class MetadataField(Enum):
 
 
 class Metadata:
+    __slots__ = (
+        "MODE",
+        "UID",
+        "GID",
+        "NLINKS",
+        "SIZE",
+        "CTIME",
+        "MTIME",
+        "ATIME",
+        "LOCATION",
+        "NAME",
+        "TYPE",
+    )
+
     def __init__(
         self,
         MODE: Optional[int] = None,
@@ -71,50 +169,81 @@ class Metadata:
         self.NAME = NAME
         self.TYPE = TYPE
 
-    def form_bytes(self) -> bytearray:
-        """ Get the bytearray representation of the metadata """
+    def _packed_values(self, layout: HeaderLayout) -> Tuple[Any, ...]:
+        values = (
+            self.SIZE,
+            self.NLINKS,
+            self.MODE,
+            self.UID,
+            self.GID,
+            self.CTIME,
+            self.MTIME,
+            self.ATIME,
+            self.LOCATION,
+            self.TYPE,
+        )
         return (
-            str_to_bytes(self.NAME or "", 16)
-            + int_to_bytes(self.SIZE or 0, 2)
-            + int_to_bytes(self.NLINKS or 0, 1)
-            + int_to_bytes(self.MODE or 0, 2)
-            + int_to_bytes(self.UID or 0, 2)
-            + int_to_bytes(self.GID or 0, 2)
-            + int_to_bytes(self.CTIME or 0, 4)
-            + int_to_bytes(self.MTIME or 0, 4)
-            + int_to_bytes(self.ATIME or 0, 4)
-            + int_to_bytes(self.LOCATION or 0, 1)
-            + int_to_bytes(self.TYPE or 0, 1)
+            (self.NAME or "").encode("ascii"),
+            *[(value or 0) & mask for (value, mask) in zip(values, layout.masks)],
         )
 
+    def form_bytes(self, version: Optional[int] = None) -> bytearray:
+        """ Get the bytearray representation of the metadata """
+        layout = header_layout(version)
+        return bytearray(layout.struct.pack(*self._packed_values(layout)))
+
+    def pack_into(
+        self, buffer: Any, offset: int = 0, version: Optional[int] = None
+    ) -> None:
+        """ Encode the metadata straight into a writable buffer """
+        layout = header_layout(version)
+        layout.struct.pack_into(buffer, offset, *self._packed_values(layout))
+
     @staticmethod
-    def build_metadata(metadata_bytes: bytearray) -> Metadata:
+    def build_metadata(
+        metadata_bytes: Block, offset: int = 0, version: Optional[int] = None
+    ) -> Metadata:
+        (
+            name,
+            size,
+            nlinks,
+            mode,
+            uid,
+            gid,
+            ctime,
+            mtime,
+            atime,
+            location,
+            item_type,
+        ) = header_layout(version).struct.unpack_from(metadata_bytes, offset)
         return Metadata(
-            NAME=bytes_to_str(metadata_bytes[0:16]),
-            SIZE=bytes_to_int(metadata_bytes[16:18]),
-            NLINKS=bytes_to_int(metadata_bytes[18:19]),
-            MODE=bytes_to_int(metadata_bytes[19:21]),
-            UID=bytes_to_int(metadata_bytes[21:23]),
-            GID=bytes_to_int(metadata_bytes[23:25]),
-            CTIME=bytes_to_int(metadata_bytes[25:29]),
-            MTIME=bytes_to_int(metadata_bytes[29:33]),
-            ATIME=bytes_to_int(metadata_bytes[33:37]),
-            LOCATION=bytes_to_int(metadata_bytes[37:38]),
-            TYPE=bytes_to_int(metadata_bytes[38:39]),
+            NAME=name.decode("ascii"),
+            SIZE=size,
+            NLINKS=nlinks,
+            MODE=mode,
+            UID=uid,
+            GID=gid,
+            CTIME=ctime,
+            MTIME=mtime,
+            ATIME=atime,
+            LOCATION=location,
+            TYPE=item_type,
         )
 
     def print_metadata(self) -> None:
         elements = ""
-        for attr, val in self.__dict__.items():
-            elements += f"{attr}: {val}, "
+        for attr in self.__slots__:
+            elements += f"{attr}: {getattr(self, attr)}, "
 
     def save_to_block(self, block: int) -> None:
-        """ Set the metadata space of the given block (from 0 to 38, inclusive) to this metadata. """
-        full_block = FileTable().read_block(block)
-        data_section = full_block[START_OF_CONTENT:]
-        new_bytes = self.form_bytes() + data_section
-        write_block(block, new_bytes)
-        FMLog.success(f"Wrote new metadata to block {block}")
+        """ Set the metadata space at the start of the given block to this metadata. """
+        # a short write only touches the fields, so the content and any extent
+        # map after them are left alone
+        FileTable().write_block(
+            block, self.form_bytes()[: header_layout().fields_size]
+        )
+        AttrCache.mounted().invalidate(block)
+        FMLog.debug("Wrote new metadata to block %d", block)
 
     def fetch_metadata(self, metadataKey: MetadataField) -> bytearray:
         """ Fetch a value in the metadata """
@@ -141,27 +270,10 @@ class Metadata:
 
     @staticmethod
     def fetch_metadata_static(
-        metadata_object: bytearray, metadataKey: MetadataField
+        metadata_object: bytearray,
+        metadataKey: MetadataField,
+        version: Optional[int] = None,
     ) -> bytearray:
-        if metadataKey == MetadataField.NAME:
-            return metadata_object[0:16]
-        if metadataKey == MetadataField.SIZE:
-            return metadata_object[16:18]
-        if metadataKey == MetadataField.NLINKS:
-            return metadata_object[18:19]
-        if metadataKey == MetadataField.MODE:
-            return metadata_object[19:21]
-        if metadataKey == MetadataField.UID:
-            return metadata_object[21:23]
-        if metadataKey == MetadataField.GID:
-            return metadata_object[23:25]
-        if metadataKey == MetadataField.CTIME:
-            return metadata_object[25:29]
-        if metadataKey == MetadataField.MTIME:
-            return metadata_object[29:33]
-        if metadataKey == MetadataField.ATIME:
-            return metadata_object[33:37]
-        if metadataKey == MetadataField.LOCATION:
-            return metadata_object[37:38]
-        if metadataKey == MetadataField.TYPE:
-            return metadata_object[38:39]
+        layout = header_layout(version)
+        start = layout.offsets[metadataKey.value]
+        return metadata_object[start : start + layout.sizes[metadataKey.value]]
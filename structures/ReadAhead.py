@@ -0,0 +1,131 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+
+from disktools import Device, PerDevice
+from util.FMLog import FMLog
+
+from structures.Filetable import FileTable
+
+# Bytes read ahead when a stream is first seen to be sequential, and the most
+# the window grows to
+MIN_WINDOW = 64 * 1024
+MAX_WINDOW = 1024 * 1024
+
+# How many files have their reads tracked at once
+MAX_STREAMS = 256
+
+
+class Stream(object):
+    """How one file is being read. Positions are blocks within the file."""
+
+    __slots__ = ("next_offset", "window", "fetched_to", "marker")
+
+    def __init__(self) -> None:
+        self.next_offset = -1
+        self.window = 0
+        # blocks before fetched_to have been asked for; reaching marker asks
+        # for the next window
+        self.fetched_to = 0
+        self.marker = 0
+
+
+class ReadAhead(object):
+    """Watches the reads of each file, and once a file is read sequentially,
+    prefetches the blocks ahead of the reader on a background thread pool.
+    The window doubles each time the reader catches up with it, up to
+    MAX_WINDOW, and a read that is not where the last one ended starts the
+    file over. Prefetched blocks land in the block cache, or with no cache,
+    the kernel is told they will be wanted."""
+
+    def __init__(self, device: Device, workers: int = 2) -> None:
+        self.device = device
+        block_size = device.superblock.block_size
+        self.min_window = max(1, MIN_WINDOW // block_size)
+        self.max_window = max(self.min_window, MAX_WINDOW // block_size)
+        self.streams: "OrderedDict[int, Stream]" = OrderedDict()
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="fmfs-readahead")
+
+    @staticmethod
+    def mounted() -> "ReadAhead":
+        """The readahead of the mounted device, created on first use."""
+        return _mounted.get()
+
+    def accessed(
+        self, first_block: int, start: int, end: int, stream: Optional[Stream] = None
+    ) -> None:
+        """Note a read of bytes start to end (exclusive) of the chain of the
+        file at first_block, and prefetch ahead of it if it is sequential. The
+        read is followed in stream if given, such as an open file's, and
+        otherwise in the file's own."""
+        block_size = self.device.superblock.block_size
+        with self.lock:
+            if stream is None:
+                stream = self.streams.get(first_block)
+                if stream is None:
+                    stream = Stream()
+                    self.streams[first_block] = stream
+                    if len(self.streams) > MAX_STREAMS:
+                        self.streams.popitem(last=False)
+                self.streams.move_to_end(first_block)
+
+            sequential = start == stream.next_offset
+            stream.next_offset = end
+            last = (end + block_size - 1) // block_size
+            if not sequential:
+                stream.window = 0
+                stream.fetched_to = stream.marker = last
+                return
+            if last < stream.marker:
+                return
+
+            if stream.window == 0:
+                stream.window = self.min_window
+            elif last >= stream.fetched_to - stream.window // 2:
+                # the reader is keeping up, so give it more room
+                stream.window = min(2 * stream.window, self.max_window)
+            fetch_from = max(stream.fetched_to, last)
+            fetch_to = last + stream.window
+            # ask again once the reader is half way into what is fetched
+            stream.marker = fetch_to - stream.window // 2
+            stream.fetched_to = fetch_to
+        if fetch_from < fetch_to:
+            self.pool.submit(self.prefetch, first_block, fetch_from, fetch_to)
+
+    def prefetch(self, first_block: int, first: int, last: int) -> None:
+        """Prefetch blocks first to last (exclusive) of the file, a run at a
+        time."""
+        try:
+            extents = FileTable().get_extents(first_block)
+            for (block, length) in extents.runs_between(first, last):
+                self.device.prefetch(block, length)
+        except Exception as e:
+            # the file may have gone, or the device been closed, since
+            FMLog.debug("Readahead of block %d stopped: %s", first_block, e)
+
+    def close(self) -> None:
+        """Stop prefetching, waiting for any prefetch under way."""
+        self.pool.shutdown(wait=True)
+
+
+_mounted = PerDevice(ReadAhead, ReadAhead.close)
+
+
+def stop_readahead() -> None:
+    """Stop the readahead of the mounted device, if there is one."""
+    _mounted.reset()
@@ -0,0 +1,112 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+import json
+import os
+from errno import ENOENT
+from stat import S_IFDIR, S_IFREG
+from threading import Lock
+from time import time
+from typing import Any, Dict, List
+
+from disktools import device_stats
+from fuse import FuseOSError
+from util.Metrics import get_metrics
+
+from structures.AttrCache import AttrCache
+from structures.DentryCache import DentryCache
+from structures.Filetable import FileTable
+from structures.HandleTable import HandleTable
+from structures.ItemCount import ItemCount
+
+# A hidden, read-only directory that is never on disk, holding the stats file
+STATS_DIR = "/.fmfs"
+STATS_FILE = STATS_DIR + "/stats"
+
+# Extended attributes every file and directory has, describing its layout
+XATTR_PREFIX = "user.fmfs."
+
+# A read at offset 0 newer than this many seconds after the last one gets the
+# same snapshot, so that reading the file in pieces gives a consistent whole
+SNAPSHOT_AGE = 1.0
+
+
+class StatsFile(object):
+    """The live metrics of the mounted filesystem as a virtual file of JSON:
+    counters, latency histograms of each operation, what each layer of the
+    device has done and how often its caches hit, and the space left."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.snapshot = b""
+        self.taken = 0.0
+
+    @staticmethod
+    def is_virtual(path: str) -> bool:
+        return path == STATS_DIR or path.startswith(STATS_DIR + "/")
+
+    def render(self) -> Dict[str, Any]:
+        stats = get_metrics().snapshot()
+        devices: Dict[str, Dict[str, Any]] = dict(device_stats())
+        devices["DentryCache"] = DentryCache.mounted().stats()
+        devices["AttrCache"] = AttrCache.mounted().stats()
+        devices["HandleTable"] = HandleTable.mounted().stats()
+        for layer in devices.values():
+            if "hits" in layer and "misses" in layer:
+                lookups = layer["hits"] + layer["misses"]
+                layer["hit_rate"] = round(layer["hits"] / lookups, 4) if lookups else 0
+        stats["devices"] = devices
+
+        resident = FileTable.resident()
+        with resident.lock:
+            stats["space"] = {
+                "blocks": resident.free_space.num_blocks,
+                "free_blocks": resident.free_space.free_count,
+                "items": ItemCount.mounted().count,
+            }
+        return stats
+
+    def content(self, fresh: bool) -> bytes:
+        with self.lock:
+            if not self.snapshot or (fresh and time() - self.taken > SNAPSHOT_AGE):
+                self.snapshot = (json.dumps(self.render(), indent=2) + "\n").encode()
+                self.taken = time()
+            return self.snapshot
+
+    def getattr(self, path: str) -> Dict[str, Any]:
+        now = time()
+        attrs: Dict[str, Any] = dict(
+            st_atime=now,
+            st_mtime=now,
+            st_ctime=now,
+            st_uid=os.getuid(),
+            st_gid=os.getgid(),
+        )
+        if path == STATS_DIR:
+            attrs.update(st_mode=S_IFDIR | 0o555, st_nlink=2, st_size=0)
+        elif path == STATS_FILE:
+            size = len(self.content(fresh=True))
+            attrs.update(st_mode=S_IFREG | 0o444, st_nlink=1, st_size=size)
+        else:
+            raise FuseOSError(ENOENT)
+        return attrs
+
+    def read(self, path: str, size: int, offset: int) -> bytes:
+        if path != STATS_FILE:
+            raise FuseOSError(ENOENT)
+        return self.content(fresh=offset == 0)[offset : offset + size]
+
+    def readdir(self, path: str) -> List[str]:
+        if path != STATS_DIR:
+            raise FuseOSError(ENOENT)
+        return [".", "..", os.path.basename(STATS_FILE)]
@@ -0,0 +1,241 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from __future__ import annotations
+
+import struct
+from typing import Optional
+
+from constants import (
+    BLOCK_SIZE,
+    END_OF_FILE,
+    END_OF_METADATA,
+    FILE_TABLE_BLOCKS,
+    FREE_SPACE,
+    MIN_BLOCK_SIZE,
+    NUM_BLOCKS,
+    RESERVED_SPACE,
+    ROOT_BLOCK,
+    WIDE_END_OF_FILE,
+    WIDE_FREE_SPACE,
+    WIDE_HEADER_SIZE,
+    WIDE_RESERVED_SPACE,
+)
+
+SUPERBLOCK_MAGIC = b"FMFS"
+
+# magic, version, block size, number of blocks, first filetable block,
+# filetable blocks, root block, feature flags, label, first journal block,
+# journal blocks. Volumes made before the journal have zeros for its fields.
+SUPERBLOCK_STRUCT = struct.Struct(">4sHIQQQQI32sQQ")
+
+# Feature flags
+FEATURE_EXTENTS = 0x1  # files record their blocks as runs in their header
+FEATURE_JOURNAL = 0x2  # block updates are logged to the journal before landing
+FEATURE_ITEM_COUNT = 0x4  # the superblock counts the files and directories
+
+# Files and directories on the volume, the root included, after the superblock
+# on volumes with FEATURE_ITEM_COUNT
+ITEM_COUNT_STRUCT = struct.Struct(">Q")
+
+# Bytes at the start of block 0 that the superblock may take
+SUPERBLOCK_SIZE = SUPERBLOCK_STRUCT.size + ITEM_COUNT_STRUCT.size
+
+# Bytes of the label the superblock holds, as UTF-8
+LABEL_SIZE = 32
+
+# The journal needs its header, and room for a transaction of at least a block
+MIN_JOURNAL_BLOCKS = 4
+
+
+class Superblock(object):
+    """Describes the geometry and format of a volume. Version 2 volumes store
+    it at the start of block 0; version 1 volumes have none, and get the fixed
+    geometry they were always formatted with."""
+
+    __slots__ = (
+        "version",
+        "block_size",
+        "num_blocks",
+        "table_start",
+        "table_blocks",
+        "root_block",
+        "features",
+        "label",
+        "journal_start",
+        "journal_blocks",
+        "items",
+    )
+
+    def __init__(
+        self,
+        version: int,
+        block_size: int,
+        num_blocks: int,
+        table_start: int,
+        table_blocks: int,
+        root_block: int,
+        features: int = 0,
+        label: str = "",
+        journal_start: int = 0,
+        journal_blocks: int = 0,
+        items: int = 0,
+    ) -> None:
+        self.version = version
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.table_start = table_start
+        self.table_blocks = table_blocks
+        self.root_block = root_block
+        self.features = features
+        self.label = label
+        self.journal_start = journal_start
+        self.journal_blocks = journal_blocks
+        self.items = items
+
+    @staticmethod
+    def legacy() -> Superblock:
+        """The geometry of a version 1 volume."""
+        return Superblock(1, BLOCK_SIZE, NUM_BLOCKS, 0, FILE_TABLE_BLOCKS, ROOT_BLOCK)
+
+    @staticmethod
+    def create(
+        num_blocks: int,
+        block_size: int,
+        label: str = "",
+        features: int = 0,
+        journal_blocks: int = 0,
+    ) -> Superblock:
+        """Lay out a new version 2 volume: the superblock, then the filetable,
+        then the journal if it has one, then the root directory, which is the
+        only item it holds."""
+        if block_size < MIN_BLOCK_SIZE or block_size & (block_size - 1):
+            raise ValueError(
+                f"Blocks must be a power of two, at least {MIN_BLOCK_SIZE} bytes"
+            )
+        if len(label.encode("utf-8")) > LABEL_SIZE:
+            raise ValueError(f"The label must be at most {LABEL_SIZE} bytes")
+        if journal_blocks:
+            if journal_blocks < MIN_JOURNAL_BLOCKS:
+                raise ValueError(
+                    f"The journal must be at least {MIN_JOURNAL_BLOCKS} blocks"
+                )
+            features |= FEATURE_JOURNAL
+        features |= FEATURE_ITEM_COUNT
+        table_blocks = (num_blocks * 4 + block_size - 1) // block_size
+        if (
+            num_blocks < table_blocks + journal_blocks + 2
+            or num_blocks >= WIDE_RESERVED_SPACE
+        ):
+            raise ValueError(f"Cannot make a volume of {num_blocks} blocks")
+        journal_start = 1 + table_blocks
+        return Superblock(
+            2,
+            block_size,
+            num_blocks,
+            1,
+            table_blocks,
+            journal_start + journal_blocks,
+            features,
+            label,
+            journal_start if journal_blocks else 0,
+            journal_blocks,
+            1,
+        )
+
+    @staticmethod
+    def decode(data: bytes) -> Optional[Superblock]:
+        """Read a superblock from the start of block 0, or None if there is not
+        one there."""
+        if len(data) < SUPERBLOCK_STRUCT.size:
+            return None
+        (
+            magic,
+            version,
+            block_size,
+            num_blocks,
+            table_start,
+            table_blocks,
+            root_block,
+            features,
+            label,
+            journal_start,
+            journal_blocks,
+        ) = SUPERBLOCK_STRUCT.unpack_from(data, 0)
+        if magic != SUPERBLOCK_MAGIC:
+            return None
+        items = 0
+        if features & FEATURE_ITEM_COUNT and len(data) >= SUPERBLOCK_SIZE:
+            (items,) = ITEM_COUNT_STRUCT.unpack_from(data, SUPERBLOCK_STRUCT.size)
+        return Superblock(
+            version,
+            block_size,
+            num_blocks,
+            table_start,
+            table_blocks,
+            root_block,
+            features,
+            label.rstrip(b"\0").decode("utf-8"),
+            journal_start,
+            journal_blocks,
+            items,
+        )
+
+    def encode(self) -> bytearray:
+        data = bytearray(
+            SUPERBLOCK_STRUCT.pack(
+                SUPERBLOCK_MAGIC,
+                self.version,
+                self.block_size,
+                self.num_blocks,
+                self.table_start,
+                self.table_blocks,
+                self.root_block,
+                self.features,
+                self.label.encode("utf-8"),
+                self.journal_start,
+                self.journal_blocks,
+            )
+        )
+        if self.has_feature(FEATURE_ITEM_COUNT):
+            data += ITEM_COUNT_STRUCT.pack(self.items)
+        return data
+
+    def has_feature(self, feature: int) -> bool:
+        return self.features & feature == feature
+
+    @property
+    def pointer_width(self) -> int:
+        """Bytes in a filetable entry."""
+        return 1 if self.version == 1 else 4
+
+    @property
+    def end_of_file(self) -> int:
+        return END_OF_FILE if self.version == 1 else WIDE_END_OF_FILE
+
+    @property
+    def free_space(self) -> int:
+        return FREE_SPACE if self.version == 1 else WIDE_FREE_SPACE
+
+    @property
+    def reserved_space(self) -> int:
+        return RESERVED_SPACE if self.version == 1 else WIDE_RESERVED_SPACE
+
+    @property
+    def header_size(self) -> int:
+        """Bytes of metadata at the start of every file, before its content."""
+        return END_OF_METADATA if self.version == 1 else WIDE_HEADER_SIZE
+
+    @property
+    def image_size(self) -> int:
+        return self.num_blocks * self.block_size
@@ -10,11 +10,14 @@
 # of this material is strictly forbidden unless prior written permission is
 # obtained from the author.
 # ************************************************************************
+from typing import Optional
+
+from disktools import get_superblock
 
 
 class DirFactory(object):
-    def __init__(self, index: int = 1) -> None:
-        self.index = index
+    def __init__(self, index: Optional[int] = None) -> None:
+        self.index = get_superblock().root_block if index is None else index
 
     def construct(self):
         from structures.Directory import Directory
@@ -24,4 +27,4 @@ class DirFactory(object):
     def root(self):
         from structures.Directory import Directory
 
-        return Directory(1)
+        return Directory(get_superblock().root_block)
@@ -14,7 +14,6 @@
 from errno import EINVAL
 
 import structures.Directory
-from constants import END_OF_METADATA, START_OF_METADATA
 from fuse import FuseOSError
 from structures.AbstractItem import AbstractItem
 from structures.factories.MetadataFactory import MetadataFactory
@@ -29,8 +28,7 @@ class ItemFactory(object):
 
     def create(self) -> AbstractItem:
         data = FileTable().read_block(self.block_index)
-        metadata = data[START_OF_METADATA:END_OF_METADATA]
-        item_type = MetadataFactory().set_with_bytes(metadata).construct().TYPE
+        item_type = MetadataFactory().set_with_bytes(data).construct().TYPE
 
         if item_type == 0:
             return structures.Directory.Directory(self.block_index)
@@ -11,7 +11,7 @@
 # obtained from the author.
 # ************************************************************************
 
-from disktools import bytes_to_int, bytes_to_str, str_to_bytes, int_to_bytes
+from disktools import Block
 from structures.Metadata import Metadata
 from typing import Optional
 
@@ -70,31 +70,34 @@ class MetadataFactory(object):
         self.type = TYPE
         return self
 
-    def set_with_bytes(self, metadata_bytes: bytearray):
-        self.name = bytes_to_str(metadata_bytes[0:16])
-        self.size = bytes_to_int(metadata_bytes[16:18])
-        self.nlinks = bytes_to_int(metadata_bytes[18:19])
-        self.mode = bytes_to_int(metadata_bytes[19:21])
-        self.uid = bytes_to_int(metadata_bytes[21:23])
-        self.gid = bytes_to_int(metadata_bytes[23:25])
-        self.ctime = bytes_to_int(metadata_bytes[25:29])
-        self.mtime = bytes_to_int(metadata_bytes[29:33])
-        self.atime = bytes_to_int(metadata_bytes[33:37])
-        self.location = bytes_to_int(metadata_bytes[37:38])
-        self.type = bytes_to_int(metadata_bytes[38:39])
+    def set_with_bytes(self, metadata_bytes: Block):
+        metadata = Metadata.build_metadata(metadata_bytes)
+        self.name = metadata.NAME
+        self.size = metadata.SIZE
+        self.nlinks = metadata.NLINKS
+        self.mode = metadata.MODE
+        self.uid = metadata.UID
+        self.gid = metadata.GID
+        self.ctime = metadata.CTIME
+        self.mtime = metadata.MTIME
+        self.atime = metadata.ATIME
+        self.location = metadata.LOCATION
+        self.type = metadata.TYPE
         return self
 
     def construct(self) -> Metadata:
         return Metadata.build_metadata(
-            str_to_bytes(self.name or "", 16)
-            + int_to_bytes(self.size or 0, 2)
-            + int_to_bytes(self.nlinks or 0, 1)
-            + int_to_bytes(self.mode or 0, 2)
-            + int_to_bytes(self.uid or 0, 2)
-            + int_to_bytes(self.gid or 0, 2)
-            + int_to_bytes(self.ctime or 0, 4)
-            + int_to_bytes(self.mtime or 0, 4)
-            + int_to_bytes(self.atime or 0, 4)
-            + int_to_bytes(self.location or 0, 1)
-            + int_to_bytes(self.type or 0, 1)
+            Metadata(
+                MODE=self.mode,
+                UID=self.uid,
+                GID=self.gid,
+                NLINKS=self.nlinks,
+                SIZE=self.size,
+                CTIME=self.ctime,
+                MTIME=self.mtime,
+                ATIME=self.atime,
+                LOCATION=self.location,
+                NAME=self.name,
+                TYPE=self.type,
+            ).form_bytes()
         )
\ No newline at end of file
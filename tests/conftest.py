@@ -0,0 +1,96 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+
+"""Fixtures shared by the tests: a small journalled volume in a temporary
+directory, and helpers to mount it and to copy it as a crash would leave it."""
+
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+from typing import Any, Iterator, List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from disktools import get_device, unmount_device  # noqa: E402
+from format import format_image  # noqa: E402
+from small import Small  # noqa: E402
+from structures.Journal import Journal  # noqa: E402
+from structures.Superblock import FEATURE_EXTENTS, Superblock  # noqa: E402
+
+BLOCKS = 2048
+BLOCK_SIZE = 512
+JOURNAL_BLOCKS = 64
+
+
+@pytest.fixture
+def image(tmp_path) -> Iterator[str]:
+    """The path of a freshly formatted volume."""
+    path = str(tmp_path / "disk")
+    format_image(
+        Superblock.create(
+            BLOCKS,
+            BLOCK_SIZE,
+            label="test",
+            features=FEATURE_EXTENTS,
+            journal_blocks=JOURNAL_BLOCKS,
+        ),
+        path,
+    )
+    yield path
+    unmount_device()
+
+
+def mount(path: str) -> Small:
+    """Mount the volume at path. The journal only commits when asked to, so a
+    test decides what is on disk when it takes a copy."""
+    fs = Small("file", 0, path)
+    fs.init("/")
+    device = get_device()
+    if isinstance(device, Journal):
+        device.stopped.set()
+    return fs
+
+
+def crash_copy(path: str, to: str) -> None:
+    """Copy the image as a crash would leave it: with everything written to the
+    device so far, and nothing still held by the journal."""
+    shutil.copyfile(path, to)
+
+
+@contextmanager
+def crash_when_logged(path: str, to: str) -> Iterator[None]:
+    """Copy the image at path to to as a crash would leave it once the mounted
+    journal has logged its next transaction, but before writing it home."""
+    journal = get_device()
+    assert isinstance(journal, Journal)
+    inner: Any = journal.device
+    write_blocks = inner.write_blocks
+    logged: List[bool] = []
+
+    def crash_once_logged(writes: Any) -> None:
+        writes = list(writes)
+        write_blocks(writes)
+        if writes and writes[0][0] == journal.log_start and not logged:
+            logged.append(True)
+            crash_copy(path, to)
+
+    inner.write_blocks = crash_once_logged
+    try:
+        yield
+    finally:
+        del inner.write_blocks
+    assert logged
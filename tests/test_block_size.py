@@ -0,0 +1,76 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+
+"""Block sizes: new volumes only take powers of two, and volumes made with
+any other size before that was checked still keep their filetable intact."""
+
+import argparse
+
+import pytest
+from conftest import mount
+
+import fsck
+from disktools import unmount_device
+from format import format_image
+from mkfs import parse_block_size
+from structures.Superblock import FEATURE_EXTENTS, Superblock
+
+
+@pytest.mark.parametrize("block_size", [0, 64, 130, 1000, 4097])
+def test_create_rejects_odd_block_sizes(block_size):
+    with pytest.raises(ValueError):
+        Superblock.create(2048, block_size)
+
+
+@pytest.mark.parametrize("block_size", [128, 512, 4096])
+def test_create_takes_powers_of_two(block_size):
+    assert Superblock.create(2048, block_size).block_size == block_size
+
+
+def test_mkfs_rejects_odd_block_sizes():
+    assert parse_block_size("1K") == 1024
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_block_size("130")
+
+
+@pytest.mark.parametrize("block_size", [130, 250])
+def test_table_survives_unaligned_block_size(tmp_path, block_size, monkeypatch):
+    # laid out as Superblock.create would have before it checked the size
+    superblock = Superblock.create(2048, 256, features=FEATURE_EXTENTS)
+    superblock.block_size = block_size
+    superblock.table_blocks = (2048 * 4 + block_size - 1) // block_size
+    superblock.root_block = 1 + superblock.table_blocks
+    path = str(tmp_path / "disk")
+    format_image(superblock, path)
+
+    fs = mount(path)
+    for index in range(30):
+        fs("create", f"/f{index}", 0o644)
+        fs("write", f"/f{index}", bytes([index]) * (index * 97), 0, 0)
+    for index in range(0, 30, 3):
+        fs("unlink", f"/f{index}")
+    fs.destroy("/")
+
+    fs = mount(path)
+    for index in range(30):
+        if index % 3:
+            data = fs("read", f"/f{index}", 4096, 0, 0)
+            assert data == bytes([index]) * (index * 97)
+    fs.destroy("/")
+
+    monkeypatch.setattr("sys.argv", ["fsck.py", path])
+    with pytest.raises(SystemExit) as exited:
+        fsck.main()
+    unmount_device()
+    assert exited.value.code == fsck.CLEAN
@@ -0,0 +1,116 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+
+from errno import ENOSPC
+
+import pytest
+
+import structures.DirectoryTable
+from structures.DirectoryTable import DirectoryTable, name_hash
+
+VERSION = 2
+
+
+def colliding(count: int, num_slots: int) -> list:
+    """Names whose home is the same slot of a table of num_slots."""
+    found = []
+    index = 0
+    while len(found) < count:
+        name = f"n{index}"
+        if name_hash(name) % num_slots == 0:
+            found.append(name)
+        index += 1
+    return found
+
+
+def table_of(names) -> DirectoryTable:
+    table = DirectoryTable(version=VERSION)
+    for (location, name) in enumerate(names, 100):
+        table.insert(name, location, 1)
+    return table
+
+
+def test_insert_and_lookup():
+    table = table_of(["a", "b", "c"])
+    assert table.lookup("b") == (101, 1)
+    assert table.lookup("d") is None
+    assert table.count == 3
+
+
+def test_insert_replaces_same_name():
+    table = table_of(["a"])
+    table.insert("a", 500, 0)
+    assert table.lookup("a") == (500, 0)
+    assert table.count == 1
+
+
+def test_remove_closes_the_gap():
+    # a table this big is not grown by three entries
+    table = DirectoryTable([None] * 16, VERSION)
+    names = colliding(3, 16)
+    for (location, name) in enumerate(names, 200):
+        table.insert(name, location, 1)
+    removed = table.remove(200)
+    assert removed is not None and removed[3] == names[0]
+    assert table.remove(200) is None
+    assert [table.lookup(name) for name in names[1:]] == [(201, 1), (202, 1)]
+
+
+def test_grow_keeps_every_entry():
+    names = [f"file{index}" for index in range(100)]
+    table = table_of(names)
+    assert len(table.slots) >= len(names) / structures.DirectoryTable.MAX_LOAD
+    for (location, name) in enumerate(names, 100):
+        assert table.lookup(name) == (location, 1)
+
+
+def test_round_trip_and_probe():
+    names = [f"file{index}" for index in range(40)]
+    content = table_of(names).to_bytes()
+    table = DirectoryTable.from_bytes(content, VERSION)
+    entry = table.entry.size
+    start = len(content) - len(table.slots) * entry
+
+    def read_slots(index: int) -> bytes:
+        return bytes(content[start + index * entry : start + (index + 1) * entry])
+
+    for (location, name) in enumerate(names, 100):
+        assert table.lookup(name) == (location, 1)
+        assert DirectoryTable.probe(name, len(table.slots), read_slots, VERSION) == (
+            location,
+            1,
+        )
+    assert DirectoryTable.probe("missing", len(table.slots), read_slots, VERSION) is None
+
+
+def test_only_changed_slots_are_written():
+    table = DirectoryTable.from_bytes(table_of(["a", "b"]).to_bytes(), VERSION)
+    assert table.changed_slots() == {}
+    table.remove(100)
+    changed = table.changed_slots()
+    assert changed is not None and len(changed) >= 1
+    table.saved()
+    assert table.changed_slots() == {}
+    for index in range(len(table.slots)):
+        table.insert(f"more{index}", 300 + index, 1)
+    # grown, so it has to be written whole
+    assert table.changed_slots() is None
+
+
+def test_full_directory_raises_enospc(monkeypatch):
+    monkeypatch.setattr(structures.DirectoryTable, "MAX_SLOTS", 8)
+    table = table_of([f"f{index}" for index in range(6)])
+    with pytest.raises(IOError) as raised:
+        table.insert("one too many", 999, 1)
+    assert raised.value.errno == ENOSPC
@@ -0,0 +1,81 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+
+"""fsck only reads the image unless told to repair it."""
+
+import struct
+
+import pytest
+from conftest import crash_when_logged, mount
+
+import fsck
+from disktools import unmount_device
+from structures.Superblock import SUPERBLOCK_SIZE, Superblock
+
+
+def run_fsck(monkeypatch, *args: str) -> int:
+    monkeypatch.setattr("sys.argv", ["fsck.py", *args])
+    with pytest.raises(SystemExit) as exited:
+        fsck.main()
+    unmount_device()
+    return exited.value.code
+
+
+def contents(path: str) -> bytes:
+    with open(path, "rb") as image:
+        return image.read()
+
+
+def test_clean_volume(image, monkeypatch):
+    fs = mount(image)
+    fs("mkdir", "/d", 0o755)
+    fs("create", "/d/f", 0o644)
+    fs.destroy("/")
+    assert run_fsck(monkeypatch, image) == fsck.CLEAN
+
+
+def test_check_reports_a_leak_and_repair_frees_it(image, monkeypatch):
+    with open(image, "rb") as disk:
+        superblock = Superblock.decode(disk.read(SUPERBLOCK_SIZE))
+    assert superblock is not None
+    # an entry for a block nothing refers to
+    leaked = superblock.num_blocks - 1
+    with open(image, "r+b") as disk:
+        disk.seek(superblock.table_start * superblock.block_size + leaked * 4)
+        disk.write(struct.pack(">I", superblock.end_of_file))
+    before = contents(image)
+
+    assert run_fsck(monkeypatch, image) == fsck.UNREPAIRED
+    assert contents(image) == before
+    assert run_fsck(monkeypatch, "--repair", image) == fsck.REPAIRED
+    assert run_fsck(monkeypatch, image) == fsck.CLEAN
+
+
+def test_check_leaves_a_dirty_journal_for_repair(image, tmp_path, monkeypatch):
+    fs = mount(image)
+    fs("create", "/f", 0o644)
+    crashed = str(tmp_path / "crashed")
+    with crash_when_logged(image, crashed):
+        fs("fsync", "/f", 0, 0)
+    fs.destroy("/")
+    before = contents(crashed)
+
+    assert run_fsck(monkeypatch, crashed) == fsck.UNREPAIRED
+    assert contents(crashed) == before
+    assert run_fsck(monkeypatch, "--repair", crashed) == fsck.REPAIRED
+    assert run_fsck(monkeypatch, crashed) == fsck.CLEAN
+
+    remounted = mount(crashed)
+    assert "f" in [entry[0] for entry in remounted("readdir", "/", 0)]
+    remounted.destroy("/")
@@ -0,0 +1,76 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+
+"""Crash consistency: after a crash, a remount sees each operation whole or
+not at all."""
+
+from conftest import crash_copy, crash_when_logged, mount
+
+from disktools import get_device
+
+DATA = b"keep me " * 2000
+
+
+def names(fs) -> list:
+    return sorted(entry[0] for entry in fs("readdir", "/", 0))
+
+
+def write_file(fs, path: str, data: bytes) -> None:
+    fs("create", path, 0o644)
+    fs("write", path, data, 0, 0)
+
+
+def test_uncommitted_unlink_leaves_the_file(image, tmp_path):
+    fs = mount(image)
+    write_file(fs, "/keep", DATA)
+    fs("fsync", "/keep", 0, 0)
+    fs("unlink", "/keep")
+    # a new file may not be given the blocks the unlink let go of
+    write_file(fs, "/other", b"x" * len(DATA))
+    crashed = str(tmp_path / "crashed")
+    crash_copy(image, crashed)
+    fs.destroy("/")
+
+    remounted = mount(crashed)
+    assert "keep" in names(remounted)
+    assert remounted("read", "/keep", len(DATA), 0, 0) == DATA
+    remounted.destroy("/")
+
+
+def test_committed_unlink_is_kept(image, tmp_path):
+    fs = mount(image)
+    write_file(fs, "/gone", DATA)
+    fs("unlink", "/gone")
+    fs("fsync", "/", 0, 0)
+    crashed = str(tmp_path / "crashed")
+    crash_copy(image, crashed)
+    fs.destroy("/")
+
+    remounted = mount(crashed)
+    assert "gone" not in names(remounted)
+    remounted.destroy("/")
+
+
+def test_logged_transaction_is_replayed(image, tmp_path):
+    fs = mount(image)
+    write_file(fs, "/logged", DATA)
+    crashed = str(tmp_path / "crashed")
+    with crash_when_logged(image, crashed):
+        fs("fsync", "/logged", 0, 0)
+    fs.destroy("/")
+
+    remounted = mount(crashed)
+    assert get_device().stats()["replayed"] == 1
+    assert remounted("read", "/logged", len(DATA), 0, 0) == DATA
+    remounted.destroy("/")
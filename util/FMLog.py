@@ -11,7 +11,13 @@
 # obtained from the author.
 # ************************************************************************
 
-from typing import Any
+import atexit
+import os
+import random
+import sys
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Any, Deque, List, Optional, Tuple, Union
 
 
 class Colors:
@@ -38,31 +44,210 @@ class Colors:
     B_Default = "\x1b[49m"
 
 
+# Levels, lowest first. A message is kept if its level is at least the
+# threshold, and otherwise costs only the comparison.
+TRACE = 5
+DEBUG = 10
+INFO = 20
+SUCCESS = 25
+WARN = 30
+ERROR = 40
+CRITICAL = 50
+
+LEVELS = {
+    "trace": TRACE,
+    "debug": DEBUG,
+    "info": INFO,
+    "success": SUCCESS,
+    "warn": WARN,
+    "error": ERROR,
+    "critical": CRITICAL,
+}
+
+COLORS = {
+    TRACE: Colors.F_Cyan,
+    DEBUG: Colors.F_LightGray,
+    INFO: Colors.F_Green,
+    SUCCESS: Colors.F_Magenta,
+    WARN: Colors.F_Yellow,
+    ERROR: Colors.F_Red,
+    CRITICAL: Colors.F_Red + Colors.B_White,
+}
+
+# Messages waiting to be written; past this, the oldest are dropped
+RING_SIZE = 4096
+
+# Seconds to wait at exit for the messages still waiting
+DRAIN_TIMEOUT = 1.0
+
+# Arguments of these types are left for the writing thread to format, as they
+# cannot change before it does. Anything else is formatted when logged.
+IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+Record = Tuple[int, Any, Tuple[Any, ...]]
+
+
+def _text(message: Any, args: Tuple[Any, ...]) -> str:
+    try:
+        return str(message) % args if args else str(message)
+    except Exception:
+        try:
+            return f"{message!r} {args!r}"
+        except Exception as e:
+            return f"unprintable log message: {e!r}"
+
+
+def _format(level: int, message: Any, args: Tuple[Any, ...]) -> str:
+    text = _text(message, args)
+    return f"{COLORS[level]}{text}{Colors.F_Default}{Colors.B_Default}"
+
+
+class _Sink(object):
+    """Writes messages from a thread of its own, so logging never waits on
+    the terminal. Messages are formatted there too, from a ring that drops
+    the oldest when writing falls behind, counting how many, unless their
+    arguments could change first (see IMMUTABLE). Nothing a message does
+    stops the thread."""
+
+    def __init__(self, capacity: int = RING_SIZE) -> None:
+        self.records: Deque[Record] = deque()
+        self.capacity = capacity
+        self.dropped = 0
+        self.writing = False
+        self.condition = Condition(Lock())
+        self.thread: Optional[Thread] = None
+
+    def put(self, level: int, message: Any, args: Tuple[Any, ...]) -> None:
+        if type(message) is not str or not all(type(a) in IMMUTABLE for a in args):
+            (message, args) = (_text(message, args), ())
+        with self.condition:
+            if len(self.records) >= self.capacity:
+                self.records.popleft()
+                self.dropped += 1
+            self.records.append((level, message, args))
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="fmfs-log", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.records:
+                    self.condition.wait()
+                batch = list(self.records)
+                self.records.clear()
+                dropped = self.dropped
+                self.dropped = 0
+                self.writing = True
+            try:
+                lines: List[str] = []
+                if dropped:
+                    lines.append(_format(WARN, "%d log messages dropped", (dropped,)))
+                lines.extend(_format(*record) for record in batch)
+                sys.stderr.write("\n".join(lines) + "\n")
+                sys.stderr.flush()
+            except Exception:
+                pass
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def drain(self, timeout: Optional[float] = None) -> None:
+        """Wait until the messages so far have been written."""
+        with self.condition:
+            if self.thread is None:
+                return
+            self.condition.wait_for(
+                lambda: not self.records and not self.writing, timeout
+            )
+
+
+_sink = _Sink()
+atexit.register(_sink.drain, DRAIN_TIMEOUT)
+
+
 class FMLog:
+    """Logging for the filesystem. Messages are %-formatted with their
+    arguments only if their level is enabled, and then by the writing thread,
+    so a disabled message on a hot path costs one comparison. The level starts
+    as FMFS_LOG_LEVEL, or info, and can be changed while mounted."""
+
+    level = LEVELS.get(os.environ.get("FMFS_LOG_LEVEL", "").lower(), INFO)
+    # the fraction of operations traced whatever the level
+    sample_rate = 0.0
+
+    @staticmethod
+    def set_level(level: Union[int, str]) -> None:
+        FMLog.level = LEVELS[level.lower()] if isinstance(level, str) else level
+
+    @staticmethod
+    def step_level(steps: int) -> int:
+        """Move the level steps towards more (negative) or less (positive)
+        output, returning the new one."""
+        ordered = sorted(LEVELS.values())
+        index = min(
+            (i for (i, level) in enumerate(ordered) if level >= FMLog.level),
+            default=len(ordered) - 1,
+        )
+        FMLog.level = ordered[max(0, min(len(ordered) - 1, index + steps))]
+        return FMLog.level
+
+    @staticmethod
+    def enabled(level: int) -> bool:
+        return level >= FMLog.level
+
+    @staticmethod
+    def set_sampling(rate: float) -> None:
+        FMLog.sample_rate = max(0.0, min(1.0, rate))
+
+    @staticmethod
+    def sampled() -> bool:
+        """Whether to trace this operation."""
+        rate = FMLog.sample_rate
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+    @staticmethod
+    def sample(m: Any, *args: Any) -> None:
+        """Log the trace of a sampled operation, whatever the level."""
+        _sink.put(TRACE, m, args)
+
+    @staticmethod
+    def flush() -> None:
+        _sink.drain()
+
     @staticmethod
-    def debug(m: Any) -> None:
-        print(f"{Colors.F_LightGray}{m}{Colors.F_Default}")
+    def debug(m: Any, *args: Any) -> None:
+        if DEBUG >= FMLog.level:
+            _sink.put(DEBUG, m, args)
 
     @staticmethod
-    def info(m: Any) -> None:
-        print(f"{Colors.F_Green}{m}{Colors.F_Default}")
+    def info(m: Any, *args: Any) -> None:
+        if INFO >= FMLog.level:
+            _sink.put(INFO, m, args)
 
     @staticmethod
-    def success(m: Any) -> None:
-        print(f"{Colors.F_Magenta}{m}{Colors.F_Default}")
+    def success(m: Any, *args: Any) -> None:
+        if SUCCESS >= FMLog.level:
+            _sink.put(SUCCESS, m, args)
 
     @staticmethod
-    def trace(m: Any) -> None:
-        print(f"{Colors.F_Cyan}{m}{Colors.F_Default}")
+    def trace(m: Any, *args: Any) -> None:
+        if TRACE >= FMLog.level:
+            _sink.put(TRACE, m, args)
 
     @staticmethod
-    def warn(m: Any) -> None:
-        print(f"{Colors.F_Yellow}{m}{Colors.F_Default}")
+    def warn(m: Any, *args: Any) -> None:
+        if WARN >= FMLog.level:
+            _sink.put(WARN, m, args)
 
     @staticmethod
-    def error(m: Any) -> None:
-        print(f"{Colors.F_Red}{m}{Colors.F_Default}")
+    def error(m: Any, *args: Any) -> None:
+        if ERROR >= FMLog.level:
+            _sink.put(ERROR, m, args)
 
     @staticmethod
-    def critical(m: Any) -> None:
-        print(f"{Colors.F_Red}{Colors.B_White}{m}{Colors.F_Default}{Colors.B_Default}")
\ No newline at end of file
+    def critical(m: Any, *args: Any) -> None:
+        if CRITICAL >= FMLog.level:
+            _sink.put(CRITICAL, m, args)
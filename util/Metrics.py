@@ -0,0 +1,100 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from threading import Lock
+from typing import Any, Dict, List
+
+# Latencies are counted in power of two buckets of microseconds: bucket i holds
+# those under 2**i us, and the last holds everything slower
+BUCKETS = 32
+
+
+class Histogram(object):
+    """Counts of latencies, bucketed by their order of magnitude."""
+
+    def __init__(self) -> None:
+        self.buckets: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, percent: float) -> int:
+        """An upper bound, in microseconds, on the given percentile."""
+        wanted = self.count * percent / 100
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return 1 << bucket
+        return 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        last = max((i for (i, count) in enumerate(self.buckets) if count), default=0)
+        return {
+            "count": self.count,
+            "mean_us": round(self.total * 1e6 / self.count, 1) if self.count else 0,
+            "p50_us": self.percentile(50),
+            "p90_us": self.percentile(90),
+            "p99_us": self.percentile(99),
+            # upper bound of each bucket in microseconds, and its count
+            "buckets": {str(1 << i): self.buckets[i] for i in range(last + 1)},
+        }
+
+
+class Metrics(object):
+    """Counters and latency histograms, by name, shared between threads.
+    Names are dotted, the first part saying what is being measured."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": dict(sorted(self.counters.items())),
+                "latency": {
+                    name: histogram.snapshot()
+                    for (name, histogram) in sorted(self.histograms.items())
+                },
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """The metrics of this process."""
+    return _metrics
@@ -0,0 +1,89 @@
+# ************************************************************************
+#
+# Copyright 2021 Fraser McCallum.
+# All Rights Reserved.
+#
+# NOTICE: All information contained herein is, and remains the property of
+# Fraser McCallum (the author) and his affiliates, if any. The intellectual and
+# technical concepts contained herein are proprietary to the author, and are
+# protected by copyright law. Dissemination of this information or reproduction
+# of this material is strictly forbidden unless prior written permission is
+# obtained from the author.
+# ************************************************************************
+
+from contextlib import contextmanager
+from threading import Condition, get_ident
+from typing import Dict, Iterator, Optional
+
+
+class RWLock(object):
+    """A reader/writer lock. Any number of threads may read at once, and a
+    writer has the lock to itself. Waiting writers hold off new readers, so a
+    steady stream of reads cannot starve them. A thread may take the lock again
+    while holding it, and a writer may also read, but a reader cannot upgrade
+    to writing."""
+
+    def __init__(self) -> None:
+        self.condition = Condition()
+        self.readers: Dict[int, int] = {}
+        self.writer: Optional[int] = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        me = get_ident()
+        with self.condition:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers[me] = 1
+
+    def release_read(self) -> None:
+        me = get_ident()
+        with self.condition:
+            depth = self.readers[me] - 1
+            if depth:
+                self.readers[me] = depth
+            else:
+                del self.readers[me]
+                self.condition.notify_all()
+
+    def acquire_write(self) -> None:
+        me = get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("Cannot upgrade a read lock to a write lock")
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self) -> None:
+        with self.condition:
+            self.writer_depth -= 1
+            if not self.writer_depth:
+                self.writer = None
+                self.condition.notify_all()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()